@@ -1,6 +1,5 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
-from werkzeug.security import check_password_hash, generate_password_hash
 import os
 import logging
 from models import ATM, User, SessionLocal, create_tables
@@ -9,7 +8,8 @@ import atexit
 import jwt
 import datetime
 import random
-import smtplib
+import hmac
+import itertools
 from email.message import EmailMessage
 from urllib.parse import unquote
 from dotenv import load_dotenv
@@ -18,7 +18,20 @@ from sqlalchemy import text
 from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
 from sqlalchemy.sql import func
 from models import UserPreferences, SessionLocal
-from recommendation import get_atm_recommendations_for_user
+from recommendation import get_atm_recommendations_for_user, get_atm_fleet, recommendation_cache_stats
+from recommendation import ATMRecommendationEngine, MAX_BATCH_SIZE
+from atm_snapshot import get_atm_snapshot
+from preferences import get_compiled_preferences, invalidate_preferences, preferences_cache_stats
+from atm_views import (atms_in_bbox, get_atm_stats_payload, get_atms_payload, get_serialized_atms,
+                       match_preferences, parse_viewport, serialize_atm, serialize_filtered_atms)
+from atm_changes import changes_since
+from clustering import MAX_ZOOM, clusters_in_bbox, get_clusters_payload
+from atm_stream import StreamFilter, broadcaster, parse_filter_values, stream_events
+from http_cache import prepared_json_response
+from auth import authenticate_request, require_auth, token_cache_stats
+from mailer import mailer
+from password_hashing import HashingBusy, password_hasher
+from geocoding import coordinates_cache, geocode_executor
 
 # class UserPreferences(Base):
 #     __tablename__ = 'user_preferences'
@@ -45,9 +58,15 @@ app = Flask(__name__)
 SECRET_KEY = os.getenv("SECRET_KEY")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 
+# Service key for partner/offline batch recommendation calls on behalf of any user
+BATCH_API_KEY = os.getenv("BATCH_API_KEY")
+
+# Clients may reuse /api/atms for this long, then revalidate with If-None-Match
+ATMS_CACHE_MAX_AGE = int(os.getenv("ATMS_CACHE_MAX_AGE", "30"))
+ATMS_CACHE_CONTROL = f"public, max-age={ATMS_CACHE_MAX_AGE}, must-revalidate"
+
 # Email config
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
-EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 
 # Configure Flask for production
 app.config['ENV'] = os.getenv('FLASK_ENV', 'production')
@@ -56,12 +75,13 @@ app.config['DEBUG'] = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
 # Configure CORS for production
 if app.config['ENV'] == 'production':
     # Restrict CORS to your domain in production
-    CORS(app, origins=['https://neighbourhood-app.duckdns.org'])
+    CORS(app, origins=['https://neighbourhood-app.duckdns.org'], expose_headers=['X-ATM-Change-Seq'])
 else:
     # Allow all origins in development
     CORS(app, origins=["http://localhost:3000", "http://127.0.0.1:3000"], 
          methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
-         allow_headers=['Content-Type', 'Authorization'])
+         allow_headers=['Content-Type', 'Authorization'],
+         expose_headers=['X-ATM-Change-Seq'])
 
 # Initialize database
 create_tables()
@@ -72,10 +92,19 @@ scheduler = start_scheduler()
 # Shut down scheduler when app exits
 atexit.register(lambda: scheduler.shutdown())
 
+# Give queued emails (OTP codes) a moment to go out before the process exits
+atexit.register(lambda: mailer.wait_idle(timeout=10))
+
 # Helper functions for authentication
 def generate_otp():
     return f"{random.randint(100000, 999999)}"
 
+def busy_response():
+    """503 for when the password hashing pool is saturated or a hash timed out (HashingBusy)"""
+    response = jsonify({"error": "Server busy, please try again"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 def send_otp_email(receiver_email, otp):
     try:
         msg = EmailMessage()
@@ -88,14 +117,10 @@ def send_otp_email(receiver_email, otp):
     
         msg.set_content(f"Welcome to The Neighborhood!\n\nYour 6-digit OTP verification code is: {otp}\n\nThis code will expire in 10 minutes.\n\nIf you didn't request this code, please ignore this email.\n\nBest regards,\nThe Neighborhood Team")
 
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            smtp.send_message(msg)
-        
-        logger.info(f"Email sent successfully to {receiver_email}")
-        return True
+        # Delivered by the background mail senders so the request doesn't wait on SMTP
+        return mailer.enqueue(msg)
     except Exception as e:
-        logger.error(f"Email sending failed: {str(e)}")
+        logger.error(f"Email queueing failed: {str(e)}")
         logger.error(f"Error type: {type(e).__name__}")
         return False
 
@@ -104,6 +129,20 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'message': 'API is running'})
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """In-process cache and worker metrics for this API worker"""
+    return jsonify({
+        'pid': os.getpid(),
+        'recommendation_cache': recommendation_cache_stats(),
+        'preferences_cache': preferences_cache_stats(),
+        'token_cache': token_cache_stats(),
+        'mail': mailer.stats(),
+        'password_hashing': password_hasher.stats(),
+        'geocoding': geocode_executor.stats(),
+        'geocoding_cache': coordinates_cache.stats()
+    })
+
 # Authentication endpoints
 @app.route('/login', methods=['POST'])
 def login():
@@ -125,7 +164,7 @@ def login():
             if not user:
                 return jsonify({"error": "Invalid email or password"}), 401
 
-            if check_password_hash(user.Password_Hash, password):
+            if password_hasher.verify_password(user.Password_Hash, password):
                 token = jwt.encode({
                     "user_id": user.UserId,
                     "email": email,
@@ -139,28 +178,16 @@ def login():
         finally:
             db.close()
 
+    except HashingBusy:
+        return busy_response()
     except Exception as e:
         logger.error(f"Login error: {str(e)}")
         return jsonify({"error": "Login failed"}), 500
 
 @app.route('/verify-token', methods=['GET'])
+@require_auth
 def verify_token():
-    token = request.headers.get("Authorization")
-
-    if not token:
-        return jsonify({"error": "Token missing"}), 401
-
-    try:
-        # Remove 'Bearer ' prefix if present
-        if token.startswith('Bearer '):
-            token = token[7:]
-            
-        decoded = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-        return jsonify({"valid": True, "user_id": decoded["user_id"]}), 200
-    except jwt.ExpiredSignatureError:
-        return jsonify({"error": "Token expired"}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({"error": "Invalid token"}), 401
+    return jsonify({"valid": True, "user_id": g.user_id}), 200
 
 @app.route('/update_password', methods=["POST"])
 def update_password():
@@ -184,7 +211,7 @@ def update_password():
             return jsonify({"error": "Password must be at least 6 characters long"}), 400
 
         # Hash the new password
-        hashed_password = generate_password_hash(new_password)
+        hashed_password = password_hasher.hash_password(new_password)
 
         db = SessionLocal()
         try:
@@ -203,6 +230,8 @@ def update_password():
         finally:
             db.close()
 
+    except HashingBusy:
+        return busy_response()
     except Exception as e:
         logger.error(f"Error in update_password: {str(e)}")
         return jsonify({"error": "Password update failed"}), 500
@@ -244,7 +273,7 @@ def signup():
             return jsonify({'error': 'Password must be at least 6 characters long'}), 400
 
         # Hash password
-        hashed_pw = generate_password_hash(password)
+        hashed_pw = password_hasher.hash_password(password)
         
         # Generate OTP and expiration
         otp = generate_otp()
@@ -289,6 +318,8 @@ def signup():
         finally:
             db.close()
                 
+    except HashingBusy:
+        return busy_response()
     except Exception as e:
         logger.error(f"Server error: {str(e)}")
         return jsonify({'error': 'Server error occurred'}), 500
@@ -394,64 +425,131 @@ def confirm_otp(otp, email):
 
 @app.route('/api/atms', methods=['GET'])
 def get_atms():
-    """Get all ATM data"""
+    """Get all ATM data, or only the ATMs in a viewport with bbox=minLng,minLat,maxLng,maxLat (and limit)"""
     try:
-        db = SessionLocal()
         try:
-            atms = db.query(ATM).all()
-
-            atm_list = []
-            for atm in atms:
-                # Map database fields to frontend expected format
-                atm_data = {
-                    'id': atm.id,
-                    'bank': map_location_to_bank(atm.location),  # We'll need to infer bank from location
-                    'bankName': get_bank_full_name(map_location_to_bank(atm.location)),
-                    'type': 'ATM' if not atm.deposit_available else 'ABM',
-                    'lat': atm.latitude,
-                    'lng': atm.longitude,
-                    'withdrawalFee': get_withdrawal_fee(map_location_to_bank(atm.location)),
-                    'depositFee': get_deposit_fee(map_location_to_bank(atm.location)),
-                    'lowOnCash': is_low_on_cash(atm.last_used),
-                    'functional': atm.status.upper() == 'WORKING',
-                    'supportsCurrency': 'JMD',  # Default to JMD for Jamaica
-                    'address': f"{atm.location}, {atm.parish}",
-                    'location': atm.location,
-                    'parish': atm.parish,
-                    'geocodingFailed': atm.geocoding_failed,
-                    'lastUpdated': atm.updated_at.isoformat() if atm.updated_at else None
-                }
-                atm_list.append(atm_data)
+            bbox, limit = parse_viewport(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        snapshot = get_atm_snapshot()
+
+        if bbox is None and limit is None:
+            # Serialized (and compressed) once per ATM data version
+            payload = get_atms_payload(snapshot)
+            response = prepared_json_response(payload, ATMS_CACHE_CONTROL)
+        else:
+            # Viewport lookups go through the fleet's spatial index
+            serialized = get_serialized_atms(snapshot)
+            if bbox is not None:
+                positions = atms_in_bbox(get_atm_fleet(snapshot), bbox, limit)
+            else:
+                positions = range(min(limit, len(serialized)))
+            response = jsonify([serialized[i] for i in positions])
 
-            return jsonify(atm_list)
-        finally:
-            db.close()
+        # Where /api/atms/changes should continue from
+        response.headers['X-ATM-Change-Seq'] = str(snapshot.change_seq)
+        return response
 
     except Exception as e:
         logger.error(f"Error fetching ATMs: {e}")
         return jsonify({'error': 'Failed to fetch ATM data'}), 500
 
-@app.route('/api/atms/stats', methods=['GET'])
-def get_atm_stats():
-    """Get ATM statistics"""
+@app.route('/api/atms/changes', methods=['GET'])
+def get_atm_changes():
+    """ATMs added, updated or removed since a change sequence (see X-ATM-Change-Seq on /api/atms)"""
     try:
+        since = request.args.get('since', type=int)
+        if since is None:
+            return jsonify({"error": "since must be a change sequence number"}), 400
+        
+        snapshot = get_atm_snapshot()
+        
         db = SessionLocal()
         try:
-            total_atms = db.query(ATM).count()
-            working_atms = db.query(ATM).filter(ATM.status == 'WORKING').count()
-            geocoding_failed = db.query(ATM).filter(ATM.geocoding_failed == True).count()
-
-            stats = {
-                'total': total_atms,
-                'working': working_atms,
-                'not_working': total_atms - working_atms,
-                'geocoding_failed': geocoding_failed,
-                'last_updated': get_last_update_time()
-            }
-
-            return jsonify(stats)
+            changes = changes_since(db, snapshot, since)
         finally:
             db.close()
+        
+        # A resync response tells the client to fetch /api/atms again
+        if not changes['resync']:
+            changes['added'] = [serialize_atm(atm) for atm in changes['added']]
+            changes['updated'] = [serialize_atm(atm) for atm in changes['updated']]
+        
+        return jsonify(changes)
+    
+    except Exception as e:
+        logger.error(f"Error fetching ATM changes: {e}")
+        return jsonify({'error': 'Failed to fetch ATM changes'}), 500
+
+@app.route('/api/atms/stream', methods=['GET'])
+def stream_atm_changes():
+    """
+    Server-Sent Events stream of ATM changes, optionally limited with bank and
+    parish query parameters. Reconnecting clients resume from Last-Event-ID
+    """
+    try:
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            return jsonify({"error": "Last-Event-ID must be a change sequence number"}), 400
+        
+        stream_filter = StreamFilter(
+            banks=parse_filter_values(request.args.getlist('bank')),
+            parishes=parse_filter_values(request.args.getlist('parish'))
+        )
+        
+        subscriber = broadcaster.subscribe()
+        if subscriber is None:
+            return jsonify({"error": "Too many open streams, poll /api/atms/changes instead"}), 503
+        
+        response = Response(stream_events(subscriber, stream_filter, last_event_id),
+                            mimetype='text/event-stream')
+        response.call_on_close(lambda: broadcaster.unsubscribe(subscriber))
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+        return response
+    
+    except Exception as e:
+        logger.error(f"Error opening ATM stream: {e}")
+        return jsonify({'error': 'Failed to open ATM stream'}), 500
+
+@app.route('/api/atms/clusters', methods=['GET'])
+def get_atm_clusters():
+    """ATM clusters for a map zoom level, optionally only those in bbox=minLng,minLat,maxLng,maxLat"""
+    try:
+        zoom = request.args.get('zoom', type=int)
+        if zoom is None or not 0 <= zoom <= MAX_ZOOM:
+            return jsonify({'error': f'zoom must be an integer between 0 and {MAX_ZOOM}'}), 400
+        
+        try:
+            bbox, _ = parse_viewport(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        snapshot = get_atm_snapshot()
+        
+        if bbox is None:
+            # Whole zoom levels are serialized once per ATM data version
+            return prepared_json_response(get_clusters_payload(snapshot, zoom), ATMS_CACHE_CONTROL)
+        
+        response = jsonify(clusters_in_bbox(snapshot, zoom, bbox))
+        response.headers['Cache-Control'] = ATMS_CACHE_CONTROL
+        return response
+    
+    except Exception as e:
+        logger.error(f"Error fetching ATM clusters: {e}")
+        return jsonify({'error': 'Failed to fetch ATM clusters'}), 500
+
+@app.route('/api/atms/stats', methods=['GET'])
+def get_atm_stats():
+    """Get ATM statistics, with per-parish and per-bank breakdowns"""
+    try:
+        # Aggregated once per ATM data version
+        payload = get_atm_stats_payload(get_atm_snapshot())
+        
+        return prepared_json_response(payload, ATMS_CACHE_CONTROL)
 
     except Exception as e:
         logger.error(f"Error fetching ATM stats: {e}")
@@ -459,32 +557,10 @@ def get_atm_stats():
 
 # API Endpoint: Save user preferences
 @app.route('/api/user-preferences', methods=['POST'])
+@require_auth
 def save_user_preferences():
     try:
-        # Get token from Authorization header
-        token = request.headers.get("Authorization")
-        logger.debug(f"Received token: {token}")  # Debug line
-        if not token:
-            logger.debug("No token provided")  # Debug line
-            return jsonify({"error": "Authorization token required"}), 401
-            
-        # Remove 'Bearer ' prefix if present
-        if token.startswith('Bearer '):
-            token = token[7:]
-        
-        logger.debug(f"Token after Bearer removal: {token}")  # Debug line
-
-        # Verify token and get user info
-        try:
-            decoded = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            logger.debug(f"Decoded token: {decoded}")  # Debug line
-            user_id = decoded["user_id"]
-        except jwt.ExpiredSignatureError:
-            logger.debug("Token expired")  # Debug line
-            return jsonify({"error": "Token expired"}), 401
-        except jwt.InvalidTokenError:
-            logger.debug(f"Invalid token error: {str(e)}")  # Debug line
-            return jsonify({"error": "Invalid token"}), 401
+        user_id = g.user_id
         
         # Get request data
         data = request.get_json()
@@ -524,6 +600,7 @@ def save_user_preferences():
                 logger.info(f"Created new preferences for user {user_id}")
             
             db.commit()
+            invalidate_preferences(user_id)
             
             return jsonify({
                 "success": True,
@@ -539,25 +616,10 @@ def save_user_preferences():
 
 # API Endpoint: Get user preferences
 @app.route('/api/user-preferences', methods=['GET'])
+@require_auth
 def get_user_preferences():
     try:
-        # Get token from Authorization header
-        token = request.headers.get("Authorization")
-        if not token:
-            return jsonify({"error": "Authorization token required"}), 401
-            
-        # Remove 'Bearer ' prefix if present
-        if token.startswith('Bearer '):
-            token = token[7:]
-        
-        # Verify token and get user info
-        try:
-            decoded = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            user_id = decoded["user_id"]
-        except jwt.ExpiredSignatureError:
-            return jsonify({"error": "Token expired"}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({"error": "Invalid token"}), 401
+        user_id = g.user_id
         
         db = SessionLocal()
         try:
@@ -584,85 +646,47 @@ def get_user_preferences():
 
 # API Endpoint: Get filtered ATMs based on user preferences
 @app.route('/api/atms/filtered', methods=['GET'])
+@require_auth
 def get_filtered_atms():
     try:
-        # Get token from Authorization header
-        token = request.headers.get("Authorization")
-        if not token:
-            return jsonify({"error": "Authorization token required"}), 401
-            
-        # Remove 'Bearer ' prefix if present
-        if token.startswith('Bearer '):
-            token = token[7:]
-        
-        # Verify token and get user info
-        try:
-            decoded = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            user_id = decoded["user_id"]
-        except jwt.ExpiredSignatureError:
-            return jsonify({"error": "Token expired"}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({"error": "Invalid token"}), 401
+        user_id = g.user_id
         
         # Get user location from query parameters
         user_lat = request.args.get('lat', type=float)
         user_lng = request.args.get('lng', type=float)
         
+        # Optional viewport (bbox=minLng,minLat,maxLng,maxLat) and result limit
+        try:
+            bbox, limit = parse_viewport(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         db = SessionLocal()
         try:
-            # Get user preferences
-            preferences = db.query(UserPreferences).filter(UserPreferences.user_id == user_id).first()
+            # Get user preferences (cached, compiled form)
+            preferences = get_compiled_preferences(user_id, db)
+            
+            # Get all ATMs, with the spatial index used for radius lookups
+            fleet = get_atm_fleet()
             
             if not preferences:
                 # If no preferences, return all ATMs
                 logger.info(f"No preferences found for user {user_id}, returning all ATMs")
-                atms = db.query(ATM).all()
+                positions = None
             else:
-                # Get all ATMs
-                atms = db.query(ATM).all()
-                
                 # Filter ATMs based on preferences
-                atms = filter_atms_by_preferences(atms, preferences, user_lat, user_lng)
+                positions = match_preferences(fleet, preferences, user_lat, user_lng)
             
-            # Convert to API format (same as your existing /api/atms endpoint)
-            atm_list = []
-            for atm in atms:
-                bank = get_bank_from_location(atm.location)
-                
-                atm_data = {
-                    "id": atm.id,
-                    "address": f"{atm.location}, {atm.parish}",
-                    "bank": bank,
-                    "bankName": f"{bank} Bank" if bank != "Unknown" else "Unknown Bank",
-                    "depositFee": 75,  # You might want to make this dynamic
-                    "functional": atm.status == "WORKING",
-                    "geocodingFailed": bool(atm.geocoding_failed),
-                    "lastUpdated": atm.updated_at.isoformat() if atm.updated_at else None,
-                    "lat": float(atm.latitude) if atm.latitude else None,
-                    "lng": float(atm.longitude) if atm.longitude else None,
-                    "location": atm.location,
-                    "lowOnCash": False,  # You might want to make this dynamic
-                    "parish": atm.parish,
-                    "supportsCurrency": "JMD",  # Default as per your requirement
-                    "type": "ATM",
-                    "withdrawalFee": 150,  # You might want to make this dynamic
-                    "supportsDeposit": bool(atm.deposit_available),
-                    "supportsWithdrawal": True  # All ATMs support withdrawal
-                }
-                
-                # Add distance if user location provided
-                if user_lat and user_lng and atm.latitude and atm.longitude:
-                    try:
-                        distance = calculate_distance(user_lat, user_lng, float(atm.latitude), float(atm.longitude))
-                        atm_data["distance"] = round(distance, 2)
-                    except (ValueError, TypeError):
-                        pass
-                
-                atm_list.append(atm_data)
+            if bbox is not None:
+                # Without a user location the limit keeps the ATMs nearest the middle of the viewport
+                positions = atms_in_bbox(fleet, bbox, None if user_lat and user_lng else limit, positions)
             
-            # Sort by distance if available
-            if user_lat and user_lng:
-                atm_list.sort(key=lambda x: x.get('distance', float('inf')))
+            atms = fleet.atms if positions is None else [fleet.atms[i] for i in positions]
+            
+            # Convert to API format, closest first when a location was given
+            atm_list = serialize_filtered_atms(atms, user_lat, user_lng)
+            if limit is not None:
+                atm_list = atm_list[:limit]
             
             logger.info(f"Returning {len(atm_list)} filtered ATMs for user {user_id}")
             return jsonify(atm_list), 200
@@ -675,6 +699,7 @@ def get_filtered_atms():
         return jsonify({"error": "Failed to get filtered ATMs"}), 500
 
 @app.route('/api/recommendations', methods=['GET'])
+@require_auth
 def get_recommendations():
     """
     Get personalized ATM recommendations for the authenticated user
@@ -687,23 +712,7 @@ def get_recommendations():
     - JSON object with top 3 ATM recommendations
     """
     try:
-        # Verify authentication
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({"error": "Authorization token required"}), 401
-        
-        # Remove 'Bearer ' prefix if present
-        if token.startswith('Bearer '):
-            token = token[7:]
-        
-        # Verify token and get user info
-        try:
-            decoded = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            user_id = decoded["user_id"]
-        except jwt.ExpiredSignatureError:
-            return jsonify({"error": "Token expired"}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({"error": "Invalid token"}), 401
+        user_id = g.user_id
         
         # Get user location from query parameters
         user_lat = request.args.get('lat', type=float)
@@ -762,7 +771,105 @@ def get_recommendations():
         }), 500
 
 
+@app.route('/api/recommendations/batch', methods=['POST'])
+def get_batch_recommendations():
+    """
+    ATM recommendations for many (user, location) pairs in one call
+    
+    Authentication:
+    - X-API-Key header matching BATCH_API_KEY: requests may name any user_id
+    - Bearer token: requests are for the token's user (many locations)
+    
+    Body:
+    - requests: list of {"user_id": int (optional with a token), "lat": float, "lng": float}
+    - limit (int, optional): recommendations per request, 1-10 (default 3)
+    
+    Returns:
+    - JSON object with one result per request, in request order
+    """
+    try:
+        # Verify authentication
+        api_key = request.headers.get('X-API-Key')
+        token_user_id = None
+        
+        if api_key:
+            if not BATCH_API_KEY or not hmac.compare_digest(api_key, BATCH_API_KEY):
+                return jsonify({"error": "Invalid API key"}), 401
+        else:
+            error = authenticate_request()
+            if error is not None:
+                return error
+            token_user_id = g.user_id
+        
+        data = request.get_json(silent=True)
+        if not data or not isinstance(data.get('requests'), list):
+            return jsonify({"error": "A 'requests' list is required"}), 400
+        
+        items = data['requests']
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({
+                "error": "Batch too large",
+                "message": f"At most {MAX_BATCH_SIZE} requests are allowed per batch"
+            }), 413
+        
+        limit = data.get('limit', 3)
+        if not isinstance(limit, int) or not (1 <= limit <= 10):
+            return jsonify({"error": "limit must be an integer between 1 and 10"}), 400
+        
+        batch = []
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                return jsonify({"error": f"Request {i} must be an object"}), 400
+            
+            user_id = item.get('user_id', token_user_id)
+            if token_user_id is not None and user_id != token_user_id:
+                return jsonify({"error": f"Request {i} is for another user"}), 403
+            if not isinstance(user_id, int):
+                return jsonify({"error": f"Request {i} requires an integer user_id"}), 400
+            
+            try:
+                user_lat = float(item['lat'])
+                user_lng = float(item['lng'])
+            except (KeyError, TypeError, ValueError):
+                return jsonify({"error": f"Request {i} requires numeric lat and lng"}), 400
+            
+            # Validate coordinates
+            if not (-90 <= user_lat <= 90) or not (-180 <= user_lng <= 180):
+                return jsonify({
+                    "error": "Invalid coordinates",
+                    "message": f"Request {i}: latitude must be between -90 and 90, longitude between -180 and 180"
+                }), 400
+            
+            batch.append((user_id, user_lat, user_lng))
+        
+        engine = ATMRecommendationEngine()
+        results = engine.get_batch_recommendations(batch, limit=limit)
+        
+        return jsonify({
+            "results": [
+                {
+                    "user_id": user_id,
+                    "lat": user_lat,
+                    "lng": user_lng,
+                    "recommendations": recommendations,
+                    "count": len(recommendations)
+                }
+                for (user_id, user_lat, user_lng), recommendations in zip(batch, results)
+            ],
+            "count": len(results),
+            "timestamp": datetime.datetime.now().isoformat()
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error in batch recommendations endpoint: {e}")
+        return jsonify({
+            "error": "Failed to generate recommendations",
+            "message": "An internal error occurred while generating batch recommendations"
+        }), 500
+
+
 @app.route('/api/recommendations/debug', methods=['GET'])
+@require_auth
 def debug_recommendations():
     """
     Debug endpoint to see detailed recommendation scoring
@@ -772,19 +879,7 @@ def debug_recommendations():
         return jsonify({"error": "Debug endpoint not available in production"}), 404
     
     try:
-        # Verify authentication
-        token = request.headers.get('Authorization')
-        if not token:
-            return jsonify({"error": "Authorization token required"}), 401
-        
-        if token.startswith('Bearer '):
-            token = token[7:]
-        
-        try:
-            decoded = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            user_id = decoded["user_id"]
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
-            return jsonify({"error": "Invalid or expired token"}), 401
+        user_id = g.user_id
         
         # Get user location
         user_lat = request.args.get('lat', type=float)
@@ -799,22 +894,17 @@ def debug_recommendations():
         
         db = SessionLocal()
         try:
-            # Get user preferences
-            preferences = db.query(UserPreferences).filter(
-                UserPreferences.user_id == user_id
-            ).first()
+            # Get user preferences (cached, compiled form)
+            preferences = get_compiled_preferences(user_id, db)
             
             if not preferences:
                 return jsonify({"error": "No user preferences found"}), 404
             
-            # Get all ATMs for debugging
-            atms = db.query(ATM).filter(
-                and_(
-                    ATM.latitude.isnot(None),
-                    ATM.longitude.isnot(None),
-                    ATM.geocoding_failed == False
-                )
-            ).limit(20).all()  # Limit for debug purposes
+            # Get ATMs with coordinates for debugging
+            atms = itertools.islice((
+                atm for atm in get_atm_snapshot().atms
+                if atm.latitude is not None and atm.longitude is not None and atm.geocoding_failed == False
+            ), 20)  # Limit for debug purposes
             
             debug_data = []
             for atm in atms:
@@ -829,7 +919,7 @@ def debug_recommendations():
                         'atm_id': atm.id,
                         'location': atm.location,
                         'distance_km': round(distance_km, 2),
-                        'bank': engine.get_bank_from_location(atm.location),
+                        'bank': atm.bank,
                         'status': atm.status,
                         'deposit_available': bool(atm.deposit_available),
                         'last_used': atm.last_used,
@@ -848,7 +938,13 @@ def debug_recommendations():
             
             return jsonify({
                 "debug_data": debug_data,
-                "user_preferences": preferences.to_dict(),
+                "user_preferences": {
+                    "user_id": preferences.user_id,
+                    "preferred_banks": sorted(preferences.banks),
+                    "transaction_types": sorted(preferences.transaction_types),
+                    "max_radius_km": preferences.max_radius_km,
+                    "preferred_currency": preferences.preferred_currency
+                },
                 "user_location": {"lat": user_lat, "lng": user_lng},
                 "scoring_weights": engine.WEIGHTS,
                 "timestamp": datetime.datetime.now().isoformat()
@@ -861,267 +957,6 @@ def debug_recommendations():
         logger.error(f"Error in debug recommendations endpoint: {e}")
         return jsonify({"error": "Debug failed", "message": str(e)}), 500
 
-# Helper function to extract bank from location prefix
-def get_bank_from_location(location):
-    """Extract bank name from location prefix"""
-    if not location:
-        return 'Unknown'
-    
-    location_lower = location.lower()
-    if location_lower.startswith('sbj_'):
-        return 'Sagicor'
-    elif location_lower.startswith('ncb_'):
-        return 'NCB'
-    elif location_lower.startswith('scotia_'):
-        return 'Scotia'
-    elif location_lower.startswith('jmmb_'):
-        return 'JMMB'
-    elif location_lower.startswith('cibc_'):
-        return 'CIBC'
-    else:
-        return 'Unknown'
-
-# Helper function to calculate distance between two points
-def calculate_distance(lat1, lng1, lat2, lng2):
-    """Calculate distance between two points in kilometers using Haversine formula"""
-    import math
-    
-    R = 6371  # Earth's radius in kilometers
-    
-    # Convert latitude and longitude from degrees to radians
-    lat1_rad = math.radians(lat1)
-    lng1_rad = math.radians(lng1)
-    lat2_rad = math.radians(lat2)
-    lng2_rad = math.radians(lng2)
-    
-    # Differences
-    dlat = lat2_rad - lat1_rad
-    dlng = lng2_rad - lng1_rad
-    
-    # Haversine formula
-    a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlng/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    
-    return R * c
-
-# Helper function to filter ATMs based on user preferences
-def filter_atms_by_preferences(atms, preferences, user_lat=None, user_lng=None):
-    """Filter ATMs based on user preferences with fallback logic"""
-    
-    if not atms:
-        return []
-    
-    try:
-        preferred_banks = json.loads(preferences.preferred_banks) if isinstance(preferences.preferred_banks, str) else preferences.preferred_banks
-        transaction_types = json.loads(preferences.transaction_types) if isinstance(preferences.transaction_types, str) else preferences.transaction_types
-    except (json.JSONDecodeError, AttributeError):
-        logger.error("Error parsing user preferences JSON")
-        return atms  # Return all ATMs if parsing fails
-    
-    max_radius = preferences.max_radius_km
-    preferred_currency = preferences.preferred_currency
-    
-    # Helper function to check if ATM matches transaction requirements
-    def matches_transaction_requirements(atm, transaction_types):
-        if 'both' in transaction_types:
-            return True
-        
-        supports_withdrawal = True  # All ATMs support withdrawal
-        supports_deposit = atm.deposit_available == 1
-        
-        if 'withdrawal' in transaction_types and 'deposit' in transaction_types:
-            return True
-        elif 'withdrawal' in transaction_types:
-            return supports_withdrawal
-        elif 'deposit' in transaction_types:
-            return supports_deposit
-        
-        return True
-    
-    # Helper function to check if ATM is within radius
-    def within_radius(atm, user_lat, user_lng, max_radius):
-        if not user_lat or not user_lng or not atm.latitude or not atm.longitude:
-            return True  # Include if we can't calculate distance
-        
-        try:
-            distance = calculate_distance(user_lat, user_lng, float(atm.latitude), float(atm.longitude))
-            return distance <= max_radius
-        except (ValueError, TypeError):
-            return True
-    
-    # Filter with priority fallback logic
-    filtered_results = []
-    
-    # Priority 1: Exact match (Bank + Transaction + Radius + Currency)
-    if user_lat and user_lng:
-        for atm in atms:
-            bank = get_bank_from_location(atm.location)
-            
-            # Check bank preference
-            bank_match = 'Any' in preferred_banks or bank in preferred_banks
-            
-            # Check transaction requirements
-            transaction_match = matches_transaction_requirements(atm, transaction_types)
-            
-            # Check radius
-            radius_match = within_radius(atm, user_lat, user_lng, max_radius)
-            
-            # Check currency (currently all ATMs are JMD)
-            currency_match = preferred_currency == 'JMD'  # Since all are JMD for now
-            
-            if bank_match and transaction_match and radius_match and currency_match:
-                filtered_results.append(atm)
-        
-        if filtered_results:
-            logger.info(f"Found {len(filtered_results)} ATMs with exact match")
-            return filtered_results
-    
-    # Priority 2: Bank + Radius (ignore transaction type)
-    if user_lat and user_lng:
-        for atm in atms:
-            bank = get_bank_from_location(atm.location)
-            bank_match = 'Any' in preferred_banks or bank in preferred_banks
-            radius_match = within_radius(atm, user_lat, user_lng, max_radius)
-            
-            if bank_match and radius_match:
-                filtered_results.append(atm)
-        
-        if filtered_results:
-            logger.info(f"Found {len(filtered_results)} ATMs with bank + radius match")
-            return filtered_results
-    
-    # Priority 3: Bank + Transaction (ignore radius)
-    for atm in atms:
-        bank = get_bank_from_location(atm.location)
-        bank_match = 'Any' in preferred_banks or bank in preferred_banks
-        transaction_match = matches_transaction_requirements(atm, transaction_types)
-        
-        if bank_match and transaction_match:
-            filtered_results.append(atm)
-    
-    if filtered_results:
-        logger.info(f"Found {len(filtered_results)} ATMs with bank + transaction match")
-        return filtered_results
-    
-    # Priority 4: Bank only
-    for atm in atms:
-        bank = get_bank_from_location(atm.location)
-        bank_match = 'Any' in preferred_banks or bank in preferred_banks
-        
-        if bank_match:
-            filtered_results.append(atm)
-    
-    if filtered_results:
-        logger.info(f"Found {len(filtered_results)} ATMs with bank match only")
-        return filtered_results
-    
-    # Priority 5: Radius only (if user location available)
-    if user_lat and user_lng:
-        for atm in atms:
-            if within_radius(atm, user_lat, user_lng, max_radius):
-                filtered_results.append(atm)
-        
-        if filtered_results:
-            logger.info(f"Found {len(filtered_results)} ATMs within radius")
-            return filtered_results
-    
-    # Fallback: Return all ATMs
-    logger.info(f"No matches found, returning all {len(atms)} ATMs")
-    return atms
-
-
-# Helper functions for ATM data
-def map_location_to_bank(location):
-    """Map location to bank based on common patterns"""
-    location_lower = location.lower()
-
-    if 'scotia' in location_lower or 'bns' in location_lower:
-        return 'BNS'
-    elif 'ncb' in location_lower or 'national commercial' in location_lower:
-        return 'NCB'
-    elif 'jmmb' in location_lower:
-        return 'JMMB'
-    elif 'cibc' in location_lower or 'firstcaribbean' in location_lower:
-        return 'CIBC'
-    elif 'jamaica national' in location_lower or ' jn ' in location_lower:
-        return 'JN'
-    elif 'sbj' in location_lower:
-        return 'Sagicor'
-    else:
-        # Default to NCB for unknown locations
-        return 'NCB'
-
-def get_bank_full_name(bank_code):
-    """Get full bank name from code"""
-    bank_names = {
-        'BNS': 'Bank of Nova Scotia',
-        'NCB': 'National Commercial Bank',
-        'JMMB': 'Jamaica Money Market Brokers',
-        'CIBC': 'CIBC FirstCaribbean',
-        'JN': 'Jamaica National',
-        'FCIB': 'First Caribbean International Bank',
-        'Sagicor': 'Sagicor Bank'
-    }
-    return bank_names.get(bank_code, 'Unknown Bank')
-
-def get_withdrawal_fee(bank_code):
-    """Get typical withdrawal fees by bank (in JMD)"""
-    fees = {
-        'BNS': 150,
-        'NCB': 100,
-        'JMMB': 200,
-        'CIBC': 175,
-        'JN': 125,
-        'FCIB': 175,
-        'Sagicor': 150
-    }
-    return fees.get(bank_code, 150)
-
-def get_deposit_fee(bank_code):
-    """Get typical deposit fees by bank (in JMD)"""
-    fees = {
-        'BNS': 75,
-        'NCB': 50,
-        'JMMB': 100,
-        'CIBC': 85,
-        'JN': 60,
-        'FCIB': 85,
-        'Sagicor': 75
-    }
-    return fees.get(bank_code, 75)
-
-def is_low_on_cash(last_used_str):
-    """Determine if ATM is low on cash based on last used time"""
-    if not last_used_str:
-        return False
-
-    try:
-        # Parse HH:MM:SS format and convert to minutes
-        time_parts = last_used_str.split(':')
-        hours = int(time_parts[0])
-        minutes = int(time_parts[1])
-        total_minutes = hours * 60 + minutes
-
-        # Consider low on cash if last used more than 2 hours ago
-        return total_minutes > 120
-    except:
-        return False
-
-def get_last_update_time():
-    """Get the timestamp of the most recent update"""
-    try:
-        db = SessionLocal()
-        try:
-            latest_atm = db.query(ATM).order_by(ATM.updated_at.desc()).first()
-
-            if latest_atm and latest_atm.updated_at:
-                return latest_atm.updated_at.isoformat()
-            return None
-        finally:
-            db.close()
-    except:
-        return None
-
 # Error handlers for better debugging
 @app.errorhandler(404)
 def not_found(error):
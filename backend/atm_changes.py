@@ -0,0 +1,98 @@
+# atm_changes.py - Change sequence for incremental ATM updates
+
+import os
+import logging
+from typing import Any, Dict, Iterable, Tuple
+from sqlalchemy import func, insert
+from models import ATMChange
+
+logger = logging.getLogger(__name__)
+
+CHANGE_ADDED = 'added'
+CHANGE_UPDATED = 'updated'
+
+# ATM fields whose changes clients need to hear about
+TRACKED_FIELDS = ('location', 'bank', 'parish', 'deposit_available', 'status', 'last_used',
+                  'latitude', 'longitude', 'geocoding_failed')
+
+# Number of most recent change rows kept; clients further behind must resync
+ATM_CHANGES_RETENTION = int(os.getenv('ATM_CHANGES_RETENTION', '50000'))
+
+# A delta touching more ATMs than this is answered with a resync instead
+ATM_CHANGES_MAX_ATMS = int(os.getenv('ATM_CHANGES_MAX_ATMS', '5000'))
+
+
+def tracked_state(atm) -> Tuple:
+    """Values of the tracked fields, to compare an ATM before and after ingestion"""
+    return tuple(getattr(atm, field) for field in TRACKED_FIELDS)
+
+def record_atm_changes(db, atm_ids: Iterable[int], change_type: str):
+    """Append one change per ATM with a single multi-row insert, as part of the caller's transaction"""
+    rows = [{'atm_id': atm_id, 'change_type': change_type} for atm_id in atm_ids]
+    if rows:
+        db.execute(insert(ATMChange), rows)
+
+def prune_atm_changes(db) -> int:
+    """Drop all but the ATM_CHANGES_RETENTION most recent changes; the newest row is always kept"""
+    db.flush()  # Count changes recorded earlier in this transaction
+    latest = db.query(func.max(ATMChange.seq)).scalar()
+    if latest is None:
+        return 0
+
+    deleted = db.query(ATMChange).filter(
+        ATMChange.seq <= latest - max(ATM_CHANGES_RETENTION, 1)
+    ).delete(synchronize_session=False)
+    if deleted:
+        logger.info(f"Pruned {deleted} old ATM changes")
+    return deleted
+
+def read_change_range(db) -> Tuple[int, int]:
+    """
+    (floor, seq): changes after floor up to seq are all still stored.
+    Clients holding a sequence below floor have missed pruned changes
+    """
+    oldest, latest = db.query(func.min(ATMChange.seq), func.max(ATMChange.seq)).one()
+    if latest is None:
+        return 0, 0
+    return oldest - 1, latest
+
+def changes_since(db, snapshot, since: int) -> Dict[str, Any]:
+    """
+    ATMs added, updated and removed after change sequence since, as of the
+    snapshot. The response tells the client to resync when since can't be served.
+    Change writers hold the data version row lock (lock_data_version) from
+    their first insert to commit, so no lower seq can commit after seq is served
+    """
+    seq = snapshot.change_seq
+    if since < snapshot.change_floor or since > seq:
+        return {'seq': seq, 'resync': True}
+
+    result = {'seq': seq, 'resync': False, 'added': [], 'updated': [], 'removed': []}
+    if since == seq:
+        return result  # Client is up to date
+
+    rows = db.query(ATMChange.atm_id, ATMChange.change_type).filter(
+        ATMChange.seq > since,
+        ATMChange.seq <= seq
+    ).all()
+
+    # Clients never saw ATMs added within the range, whatever happened to them afterwards
+    added = set()
+    changed = set()
+    for atm_id, change_type in rows:
+        changed.add(atm_id)
+        if change_type == CHANGE_ADDED:
+            added.add(atm_id)
+
+    if len(changed) > ATM_CHANGES_MAX_ATMS:
+        return {'seq': seq, 'resync': True}
+
+    for atm_id in sorted(changed):
+        atm = snapshot.by_id.get(atm_id)
+        if atm is None:
+            result['removed'].append(atm_id)
+        elif atm_id in added:
+            result['added'].append(atm)
+        else:
+            result['updated'].append(atm)
+    return result
@@ -0,0 +1,196 @@
+# atm_snapshot.py - Versioned, process-wide in-memory snapshot of the ATM table
+
+import os
+import time
+import threading
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Optional
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import ATM, DataVersion, SessionLocal
+from banks import classify_bank
+from atm_changes import read_change_range
+
+logger = logging.getLogger(__name__)
+
+# Name of the data_versions row bumped whenever ingestion commits ATM changes
+ATM_DATA_VERSION = 'atms'
+
+# How often (in seconds) a process checks the version row for new ATM data
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv('ATM_SNAPSHOT_CHECK_INTERVAL', '5'))
+
+
+def parse_time_of_day(value: Optional[str]) -> Optional[int]:
+    """Seconds since midnight for an HH:MM:SS string, or None if it is missing or malformed"""
+    if not value:
+        return None
+
+    try:
+        time_parts = value.split(':')
+        if len(time_parts) != 3:
+            return None
+        hour, minute, second = (int(part) for part in time_parts)
+    except (ValueError, AttributeError):
+        return None
+
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        return None
+    return hour * 3600 + minute * 60 + second
+
+
+@dataclass(frozen=True, slots=True)
+class ATMRecord:
+    """Immutable copy of an ATM row, detached from any database session"""
+    id: int
+    atm_id: str
+    location: Optional[str]
+    parish: Optional[str]
+    deposit_available: Optional[bool]
+    status: Optional[str]
+    last_used: Optional[str]
+    latitude: Optional[float]
+    longitude: Optional[float]
+    geocoding_failed: Optional[bool]
+    bank: str
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    last_used_seconds: Optional[int]  # last_used parsed once, as seconds since midnight
+
+    @classmethod
+    def from_model(cls, atm: ATM) -> 'ATMRecord':
+        return cls(
+            id=atm.id,
+            atm_id=atm.atm_id,
+            location=atm.location,
+            parish=atm.parish,
+            deposit_available=atm.deposit_available,
+            status=atm.status,
+            last_used=atm.last_used,
+            latitude=atm.latitude,
+            longitude=atm.longitude,
+            geocoding_failed=atm.geocoding_failed,
+            bank=atm.bank or classify_bank(atm.location),  # Rows not yet re-ingested have no bank
+            created_at=atm.created_at,
+            updated_at=atm.updated_at,
+            last_used_seconds=parse_time_of_day(atm.last_used)
+        )
+
+
+class ATMSnapshot:
+    """
+    Immutable view of every ATM at one data version, ordered by id.
+    Structures derived from the ATMs (scoring columns, indexes, payloads) are
+    built on first use and live exactly as long as the snapshot.
+    change_seq is the last ATM change included; changes after change_floor
+    are still available for incremental updates
+    """
+
+    def __init__(self, version: int, atms, change_seq: int = 0, change_floor: int = 0):
+        self.version = version
+        self.change_seq = change_seq
+        self.change_floor = change_floor
+        self.atms = tuple(atms)
+        self.by_id = {atm.id: atm for atm in self.atms}
+        self._derived = {}
+        self._derived_lock = threading.RLock()  # Builders may use other derived structures
+
+    def __len__(self) -> int:
+        return len(self.atms)
+
+    def derived(self, name: str, build: Callable[[], Any]) -> Any:
+        """Return the structure registered under name, building it once on first use"""
+        try:
+            return self._derived[name]
+        except KeyError:
+            pass
+
+        with self._derived_lock:
+            if name not in self._derived:
+                self._derived[name] = build()
+            return self._derived[name]
+
+
+def read_data_version(db, name: str) -> int:
+    """Current value of a data version counter (0 if it was never bumped)"""
+    row = db.query(DataVersion.version).filter(DataVersion.name == name).first()
+    return row[0] if row else 0
+
+def lock_data_version(db, name: str):
+    """
+    Lock a data version row until the caller's transaction ends. Writers that
+    record ATM changes take it first, so change seqs commit in order.
+    A missing row is created with an insert that ignores an existing one, so
+    writers racing to create it both end up waiting on the same row lock
+    """
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name == 'mysql':
+        stmt = mysql_insert(DataVersion).values(name=name, version=0)
+        stmt = stmt.on_duplicate_key_update(name=stmt.inserted.name)
+    else:
+        # SQLite and PostgreSQL (benchmarks, local development)
+        insert = postgresql_insert if dialect_name == 'postgresql' else sqlite_insert
+        stmt = insert(DataVersion).values(name=name, version=0).on_conflict_do_nothing(index_elements=['name'])
+    db.execute(stmt)
+    db.query(DataVersion.name).filter(DataVersion.name == name).with_for_update().one()
+
+def bump_data_version(db, name: str):
+    """Increment a data version counter as part of the caller's transaction"""
+    updated = db.query(DataVersion).filter(DataVersion.name == name).update(
+        {DataVersion.version: DataVersion.version + 1},
+        synchronize_session=False
+    )
+    if not updated:
+        db.add(DataVersion(name=name, version=1))
+
+
+_snapshot = None
+_checked_at = 0.0
+_snapshot_lock = threading.Lock()
+
+def load_atm_snapshot(db) -> ATMSnapshot:
+    """Read the ATM table into a new snapshot; one transaction keeps the version, change range and rows consistent"""
+    version = read_data_version(db, ATM_DATA_VERSION)
+    change_floor, change_seq = read_change_range(db)
+    atms = db.query(ATM).order_by(ATM.id).all()
+    return ATMSnapshot(version, [ATMRecord.from_model(atm) for atm in atms], change_seq, change_floor)
+
+def get_atm_snapshot() -> ATMSnapshot:
+    """
+    Return the process-wide ATM snapshot.
+    The version row is consulted at most once per SNAPSHOT_CHECK_INTERVAL and
+    the ATM table is only re-read when the version has moved
+    """
+    global _snapshot, _checked_at
+
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked_at < SNAPSHOT_CHECK_INTERVAL:
+        return snapshot
+
+    with _snapshot_lock:
+        if _snapshot is not None and time.monotonic() - _checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return _snapshot
+
+        db = SessionLocal()
+        try:
+            version = read_data_version(db, ATM_DATA_VERSION)
+            if _snapshot is None or version != _snapshot.version:
+                _snapshot = load_atm_snapshot(db)
+                logger.info(f"Loaded ATM snapshot version {_snapshot.version} with {len(_snapshot)} ATMs")
+            _checked_at = time.monotonic()
+        except Exception as e:
+            if _snapshot is None:
+                raise
+            _checked_at = time.monotonic()
+            logger.error(f"Failed to refresh ATM snapshot, serving version {_snapshot.version}: {e}")
+        finally:
+            db.close()
+
+        return _snapshot
+
+def invalidate_atm_snapshot():
+    """Make the next get_atm_snapshot call in this process check the version row"""
+    global _checked_at
+    _checked_at = 0.0
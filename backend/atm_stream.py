@@ -0,0 +1,211 @@
+# atm_stream.py - Server-Sent Events push of ATM changes to open maps
+
+import os
+import json
+import time
+import queue
+import threading
+import logging
+from typing import Any, Dict, Iterator, Optional
+from models import SessionLocal
+from atm_snapshot import SNAPSHOT_CHECK_INTERVAL, get_atm_snapshot
+from atm_changes import changes_since
+from atm_views import serialize_atm
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keep-alive comments on idle streams (proxies drop silent connections)
+STREAM_HEARTBEAT_SECONDS = float(os.getenv('STREAM_HEARTBEAT_SECONDS', '15'))
+
+# Open streams allowed per worker process; beyond this clients get a 503 and keep polling
+STREAM_MAX_CONNECTIONS = int(os.getenv('STREAM_MAX_CONNECTIONS', '1000'))
+
+# Undelivered events buffered per stream before a slow client is told to resync
+STREAM_QUEUE_SIZE = 100
+
+# Browsers reconnect after this many milliseconds when a stream drops
+STREAM_RETRY_MS = 5000
+
+
+def format_event(data: str, event: Optional[str] = None, event_id: Optional[int] = None) -> str:
+    """One SSE message; data must be a single line (compact JSON is)"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {data}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class StreamFilter:
+    """Optional per-connection bank and parish restriction"""
+
+    def __init__(self, banks=None, parishes=None):
+        self.banks = frozenset(banks or ())
+        self.parishes = frozenset(parishes or ())
+
+    def __bool__(self) -> bool:
+        return bool(self.banks or self.parishes)
+
+    def matches(self, atm: Dict[str, Any]) -> bool:
+        return ((not self.banks or atm['bank'] in self.banks) and
+                (not self.parishes or atm['parish'] in self.parishes))
+
+
+def delta_event(delta: Dict[str, Any], stream_filter: StreamFilter) -> str:
+    """
+    A 'changes' event for one subscriber. ATMs that no longer match the
+    filter are sent as removed so the client drops them
+    """
+    if not stream_filter:
+        return format_event(json.dumps(delta, separators=(',', ':')), 'changes', delta['seq'])
+
+    filtered = {'seq': delta['seq'], 'added': [], 'updated': [], 'removed': list(delta['removed'])}
+    for kind in ('added', 'updated'):
+        for atm in delta[kind]:
+            if stream_filter.matches(atm):
+                filtered[kind].append(atm)
+            elif kind == 'updated':
+                filtered['removed'].append(atm['id'])
+    return format_event(json.dumps(filtered, separators=(',', ':')), 'changes', delta['seq'])
+
+def resync_event(seq: int) -> str:
+    """Tell the client its view can't be patched and it should reload /api/atms"""
+    return format_event(json.dumps({'seq': seq}), 'resync', seq)
+
+def serialized_changes(snapshot, since: int) -> Dict[str, Any]:
+    """changes_since with the ATMs already in /api/atms format"""
+    db = SessionLocal()
+    try:
+        changes = changes_since(db, snapshot, since)
+    finally:
+        db.close()
+
+    if not changes['resync']:
+        changes['added'] = [serialize_atm(atm) for atm in changes['added']]
+        changes['updated'] = [serialize_atm(atm) for atm in changes['updated']]
+    return changes
+
+
+class ChangeBroadcaster:
+    """
+    Per-process fan-out of ATM change deltas to open streams.
+    A single watcher thread follows the process-wide ATM snapshot (which
+    notices ingestion commits through the data version row) and hands each
+    new delta, serialized once, to every subscriber's queue
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.seq = None  # Last change sequence delivered to subscribers
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._pid = None
+
+    def subscribe(self) -> Optional[queue.Queue]:
+        """New subscriber queue, or None when this process is at STREAM_MAX_CONNECTIONS"""
+        with self._lock:
+            if len(self.subscribers) >= STREAM_MAX_CONNECTIONS:
+                return None
+            if self.seq is None:
+                # Start from before any subscriber reads its catch-up snapshot, so nothing falls in between
+                self.seq = get_atm_snapshot().change_seq
+            subscriber = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+            self.subscribers.add(subscriber)
+            self._ensure_watcher()
+            return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def _ensure_watcher(self):
+        # Gunicorn forks workers from a preloaded app, so a thread started
+        # before the fork doesn't exist in this process
+        if self._watcher is not None and self._watcher.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._watcher = threading.Thread(target=self._watch, name='atm-change-broadcaster', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"ATM change broadcaster failed: {e}")
+            time.sleep(SNAPSHOT_CHECK_INTERVAL)
+
+    def poll(self):
+        """Publish whatever changed since the last delta"""
+        snapshot = get_atm_snapshot()
+        if snapshot.change_seq == self.seq:
+            return
+
+        if snapshot.change_seq < self.seq:
+            delta = {'seq': snapshot.change_seq, 'resync': True}  # Change log was reset
+        else:
+            delta = serialized_changes(snapshot, self.seq)
+        self.seq = snapshot.change_seq
+        self.publish(delta)
+
+    def publish(self, delta: Dict[str, Any]):
+        with self._lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(delta)
+            except queue.Full:
+                # The client fell too far behind; drop the backlog and have it reload
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait({'seq': delta['seq'], 'resync': True})
+
+        logger.info(f"Published ATM changes up to {delta['seq']} to {len(subscribers)} streams")
+
+
+broadcaster = ChangeBroadcaster()
+
+def parse_filter_values(values) -> list:
+    """Query values given repeated and/or comma separated (?bank=NCB&bank=JN or ?bank=NCB,JN)"""
+    return [value.strip() for item in values for value in item.split(',') if value.strip()]
+
+def stream_events(subscriber: queue.Queue, stream_filter: StreamFilter,
+                  last_event_id: Optional[int]) -> Iterator[str]:
+    """
+    SSE body for one client: catch-up from last_event_id (or the current
+    sequence), then live deltas and heartbeats until the client disconnects
+    """
+    try:
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+
+        snapshot = get_atm_snapshot()
+        if last_event_id is None:
+            # Fresh connection: the client loads /api/atms and continues from here
+            yield format_event(json.dumps({'seq': snapshot.change_seq}), 'sync', snapshot.change_seq)
+            seq = snapshot.change_seq
+        else:
+            changes = serialized_changes(snapshot, last_event_id)
+            if changes['resync']:
+                yield resync_event(changes['seq'])
+            elif changes['seq'] != last_event_id:
+                yield delta_event(changes, stream_filter)
+            seq = changes['seq']
+
+        while True:
+            try:
+                delta = subscriber.get(timeout=STREAM_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+
+            if delta['resync']:
+                seq = delta['seq']
+                yield resync_event(seq)
+            elif delta['seq'] > seq:  # Older deltas were covered by the catch-up
+                seq = delta['seq']
+                yield delta_event(delta, stream_filter)
+    finally:
+        broadcaster.unsubscribe(subscriber)
@@ -0,0 +1,324 @@
+# atm_views.py - ATM filtering and API serialization shared by the endpoints and benchmarks
+
+import math
+import logging
+import numpy as np
+from http_cache import PreparedJSON
+from spatial_index import haversine_km
+
+logger = logging.getLogger(__name__)
+
+# Helper function to calculate distance between two points
+def calculate_distance(lat1, lng1, lat2, lng2):
+    """Calculate distance between two points in kilometers using Haversine formula"""
+    R = 6371  # Earth's radius in kilometers
+    
+    # Convert latitude and longitude from degrees to radians
+    lat1_rad = math.radians(lat1)
+    lng1_rad = math.radians(lng1)
+    lat2_rad = math.radians(lat2)
+    lng2_rad = math.radians(lng2)
+    
+    # Differences
+    dlat = lat2_rad - lat1_rad
+    dlng = lng2_rad - lng1_rad
+    
+    # Haversine formula
+    a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlng/2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    
+    return R * c
+
+# Fallback tiers of match_preferences, best first
+MATCH_TIERS = [
+    'exact match',                # Bank + Transaction + Radius + Currency
+    'bank + radius match',        # Ignore transaction type
+    'bank + transaction match',   # Ignore radius
+    'bank match only',
+    'radius only',                # Only if user location available
+]
+
+# Helper function to filter ATMs based on user preferences
+def match_preferences(fleet, preferences, user_lat=None, user_lng=None) -> np.ndarray:
+    """
+    Positions of the fleet ATMs that satisfy compiled user preferences, with fallback logic.
+    Every predicate is evaluated once over the fleet's columns, each ATM is
+    assigned the best tier it qualifies for, and the positions of the best
+    non-empty tier are returned in fleet order
+    """
+    
+    count = len(fleet)
+    if not count:
+        return np.array([], dtype=np.int64)
+    
+    if not preferences.valid:
+        return np.arange(count)  # Return all ATMs if the stored preferences could not be parsed
+    
+    has_location = bool(user_lat and user_lng)
+    
+    # Check bank preference
+    if preferences.any_bank:
+        bank_match = np.ones(count, dtype=bool)
+    else:
+        bank_match = fleet.bank_mask(preferences.banks)
+    
+    # Check transaction requirements; all ATMs support withdrawal
+    if preferences.deposit_only:
+        transaction_match = fleet.deposit
+    else:
+        transaction_match = np.ones(count, dtype=bool)
+    
+    # Check radius through the fleet's spatial index.
+    # ATMs whose distance can't be calculated are included
+    radius_match = np.zeros(count, dtype=bool)
+    if has_location:
+        positions, _ = fleet.index.within_radius(user_lat, user_lng, preferences.max_radius_km)
+        radius_match[positions] = True
+        radius_match |= ~fleet.has_coordinates
+    
+    # Check currency (currently all ATMs are JMD)
+    currency_match = preferences.preferred_currency == 'JMD'
+    
+    tiers = np.select(
+        [
+            has_location & bank_match & transaction_match & radius_match & currency_match,
+            has_location & bank_match & radius_match,
+            bank_match & transaction_match,
+            bank_match,
+            has_location & radius_match,
+        ],
+        np.arange(len(MATCH_TIERS)),
+        default=len(MATCH_TIERS)
+    )
+    
+    best = int(tiers.min())
+    if best == len(MATCH_TIERS):
+        # Fallback: Return all ATMs
+        logger.info(f"No matches found, returning all {count} ATMs")
+        return np.arange(count)
+    
+    positions = np.flatnonzero(tiers == best)
+    logger.info(f"Found {len(positions)} ATMs with {MATCH_TIERS[best]}")
+    return positions
+
+def filter_atms_by_preferences(fleet, preferences, user_lat=None, user_lng=None):
+    """ATMs of an ATMFleet that satisfy compiled user preferences, see match_preferences"""
+    atms = fleet.atms
+    return [atms[i] for i in match_preferences(fleet, preferences, user_lat, user_lng)]
+
+
+# Viewport queries: bbox=minLng,minLat,maxLng,maxLat and an optional limit
+def parse_viewport(args):
+    """
+    (bbox, limit) from request arguments, bbox as (min_lat, min_lng, max_lat, max_lng).
+    Either is None when not given; raises ValueError when malformed
+    """
+    bbox = None
+    value = args.get('bbox')
+    if value:
+        try:
+            min_lng, min_lat, max_lng, max_lat = (float(part) for part in value.split(','))
+        except ValueError:
+            raise ValueError("bbox must be minLng,minLat,maxLng,maxLat")
+        if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lng <= max_lng <= 180):
+            raise ValueError("bbox must be minLng,minLat,maxLng,maxLat with min <= max")
+        bbox = (min_lat, min_lng, max_lat, max_lng)
+    
+    limit = None
+    value = args.get('limit')
+    if value:
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValueError("limit must be a positive integer")
+    
+    return bbox, limit
+
+def atms_in_bbox(fleet, bbox, limit=None, positions=None) -> np.ndarray:
+    """
+    Positions of fleet ATMs inside bbox, looked up through the spatial index
+    and optionally restricted to positions. With a limit, the ATMs closest to
+    the centre of the box are kept. Returned in fleet order
+    """
+    min_lat, min_lng, max_lat, max_lng = bbox
+    found = fleet.index.within_bbox(min_lat, min_lng, max_lat, max_lng)
+    if positions is not None:
+        found = np.intersect1d(found, positions, assume_unique=True)
+    
+    if limit is not None and len(found) > limit:
+        distances = haversine_km((min_lat + max_lat) / 2, (min_lng + max_lng) / 2,
+                                 fleet.lat[found], fleet.lng[found])
+        found = np.sort(found[np.argsort(distances, kind='stable')[:limit]])
+    return found
+
+
+# Helper functions for ATM data
+def get_bank_full_name(bank_code):
+    """Get full bank name from code"""
+    bank_names = {
+        'BNS': 'Bank of Nova Scotia',
+        'Scotia': 'Bank of Nova Scotia',
+        'NCB': 'National Commercial Bank',
+        'JMMB': 'Jamaica Money Market Brokers',
+        'CIBC': 'CIBC FirstCaribbean',
+        'JN': 'Jamaica National',
+        'FCIB': 'First Caribbean International Bank',
+        'Sagicor': 'Sagicor Bank'
+    }
+    return bank_names.get(bank_code, 'Unknown Bank')
+
+def get_withdrawal_fee(bank_code):
+    """Get typical withdrawal fees by bank (in JMD)"""
+    fees = {
+        'BNS': 150,
+        'Scotia': 150,
+        'NCB': 100,
+        'JMMB': 200,
+        'CIBC': 175,
+        'JN': 125,
+        'FCIB': 175,
+        'Sagicor': 150
+    }
+    return fees.get(bank_code, 150)
+
+def get_deposit_fee(bank_code):
+    """Get typical deposit fees by bank (in JMD)"""
+    fees = {
+        'BNS': 75,
+        'Scotia': 75,
+        'NCB': 50,
+        'JMMB': 100,
+        'CIBC': 85,
+        'JN': 60,
+        'FCIB': 85,
+        'Sagicor': 75
+    }
+    return fees.get(bank_code, 75)
+
+def is_low_on_cash(last_used_str):
+    """Determine if ATM is low on cash based on last used time"""
+    if not last_used_str:
+        return False
+
+    try:
+        # Parse HH:MM:SS format and convert to minutes
+        time_parts = last_used_str.split(':')
+        hours = int(time_parts[0])
+        minutes = int(time_parts[1])
+        total_minutes = hours * 60 + minutes
+
+        # Consider low on cash if last used more than 2 hours ago
+        return total_minutes > 120
+    except:
+        return False
+
+
+def serialize_atm(atm):
+    """Map an ATM to the /api/atms format expected by the frontend"""
+    return {
+        'id': atm.id,
+        'bank': atm.bank,
+        'bankName': get_bank_full_name(atm.bank),
+        'type': 'ATM' if not atm.deposit_available else 'ABM',
+        'lat': atm.latitude,
+        'lng': atm.longitude,
+        'withdrawalFee': get_withdrawal_fee(atm.bank),
+        'depositFee': get_deposit_fee(atm.bank),
+        'lowOnCash': is_low_on_cash(atm.last_used),
+        'functional': bool(atm.status) and atm.status.upper() == 'WORKING',
+        'supportsCurrency': 'JMD',  # Default to JMD for Jamaica
+        'address': f"{atm.location}, {atm.parish}",
+        'location': atm.location,
+        'parish': atm.parish,
+        'geocodingFailed': atm.geocoding_failed,
+        'lastUpdated': atm.updated_at.isoformat() if atm.updated_at else None
+    }
+
+def get_serialized_atms(snapshot):
+    """serialize_atm for every ATM of a snapshot (in snapshot order), computed on first use"""
+    return snapshot.derived('serialized_atms', lambda: [serialize_atm(atm) for atm in snapshot.atms])
+
+def get_atms_payload(snapshot) -> PreparedJSON:
+    """The /api/atms response body for a snapshot, serialized on first use"""
+    return snapshot.derived('atms_payload', lambda: PreparedJSON(get_serialized_atms(snapshot)))
+
+def compute_atm_stats(atms):
+    """Totals, last update time and per-parish / per-bank breakdowns for a set of ATMs"""
+    def counts():
+        return {'total': 0, 'working': 0, 'not_working': 0}
+    
+    totals = counts()
+    geocoding_failed = 0
+    last_updated = None
+    by_parish = {}
+    by_bank = {}
+    
+    for atm in atms:
+        working = bool(atm.status) and atm.status.upper() == 'WORKING'
+        for group in (totals,
+                      by_parish.setdefault(atm.parish or 'Unknown', counts()),
+                      by_bank.setdefault(atm.bank, counts())):
+            group['total'] += 1
+            group['working' if working else 'not_working'] += 1
+        
+        if atm.geocoding_failed:
+            geocoding_failed += 1
+        if atm.updated_at and (last_updated is None or atm.updated_at > last_updated):
+            last_updated = atm.updated_at
+    
+    return {
+        **totals,
+        'geocoding_failed': geocoding_failed,
+        'last_updated': last_updated.isoformat() if last_updated else None,
+        'by_parish': by_parish,
+        'by_bank': by_bank
+    }
+
+def get_atm_stats_payload(snapshot) -> PreparedJSON:
+    """The /api/atms/stats response body for a snapshot, computed on first use"""
+    return snapshot.derived('stats_payload', lambda: PreparedJSON(compute_atm_stats(snapshot.atms)))
+
+def serialize_filtered_atms(atms, user_lat=None, user_lng=None):
+    """Map filtered ATMs to the /api/atms/filtered format, closest first when a location is given"""
+    atm_list = []
+    for atm in atms:
+        bank = atm.bank
+        
+        atm_data = {
+            "id": atm.id,
+            "address": f"{atm.location}, {atm.parish}",
+            "bank": bank,
+            "bankName": f"{bank} Bank" if bank != "Unknown" else "Unknown Bank",
+            "depositFee": 75,  # You might want to make this dynamic
+            "functional": atm.status == "WORKING",
+            "geocodingFailed": bool(atm.geocoding_failed),
+            "lastUpdated": atm.updated_at.isoformat() if atm.updated_at else None,
+            "lat": float(atm.latitude) if atm.latitude else None,
+            "lng": float(atm.longitude) if atm.longitude else None,
+            "location": atm.location,
+            "lowOnCash": False,  # You might want to make this dynamic
+            "parish": atm.parish,
+            "supportsCurrency": "JMD",  # Default as per your requirement
+            "type": "ATM",
+            "withdrawalFee": 150,  # You might want to make this dynamic
+            "supportsDeposit": bool(atm.deposit_available),
+            "supportsWithdrawal": True  # All ATMs support withdrawal
+        }
+        
+        # Add distance if user location provided
+        if user_lat and user_lng and atm.latitude and atm.longitude:
+            try:
+                distance = calculate_distance(user_lat, user_lng, float(atm.latitude), float(atm.longitude))
+                atm_data["distance"] = round(distance, 2)
+            except (ValueError, TypeError):
+                pass
+        
+        atm_list.append(atm_data)
+    
+    # Sort by distance if available
+    if user_lat and user_lng:
+        atm_list.sort(key=lambda x: x.get('distance', float('inf')))
+    
+    return atm_list
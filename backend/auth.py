@@ -0,0 +1,81 @@
+# auth.py - JWT authentication shared by the API endpoints
+
+import os
+import time
+import logging
+from functools import wraps
+from typing import Any, Dict
+import jwt
+from dotenv import load_dotenv
+from flask import g, jsonify, request
+from cache import LRUCache
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+
+# Tokens already verified by this process, kept until they expire.
+# Map polling repeats the same token, so most requests skip signature checks
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '10000'))
+
+_token_cache = LRUCache(TOKEN_CACHE_SIZE)
+
+
+def decode_token(token: str) -> Dict[str, Any]:
+    """
+    Verified claims of a JWT. Raises jwt.ExpiredSignatureError or
+    jwt.InvalidTokenError like jwt.decode
+    """
+    claims = _token_cache.get(token)
+    if claims is not None:
+        return claims
+
+    claims = jwt.decode(token, SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    if 'user_id' not in claims:
+        raise jwt.InvalidTokenError("Token has no user_id")
+
+    # Only tokens with an expiry are cached, and never past it
+    expires_in = claims.get('exp', 0) - time.time()
+    if expires_in > 0:
+        _token_cache.set(token, claims, ttl=expires_in)
+    return claims
+
+def authenticate_request():
+    """
+    Verify the request's Bearer token and set g.user_id.
+    Returns None on success, otherwise the (response, status) to send
+    """
+    token = request.headers.get('Authorization')
+    if not token:
+        return jsonify({"error": "Authorization token required"}), 401
+
+    # Remove 'Bearer ' prefix if present
+    if token.startswith('Bearer '):
+        token = token[7:]
+
+    try:
+        claims = decode_token(token)
+    except jwt.ExpiredSignatureError:
+        return jsonify({"error": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"error": "Invalid token"}), 401
+
+    g.user_id = claims['user_id']
+    g.token_claims = claims
+    return None
+
+def require_auth(view):
+    """Endpoint decorator: reject requests without a valid token, otherwise expose g.user_id"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        error = authenticate_request()
+        if error is not None:
+            return error
+        return view(*args, **kwargs)
+    return wrapper
+
+def token_cache_stats():
+    return _token_cache.stats()
@@ -0,0 +1,58 @@
+# banks.py - Bank classification for ATM locations
+
+import re
+
+# Location prefixes added by the per-bank feed ingestion (e.g. "sbj_" for Sagicor)
+BANK_PREFIXES = {
+    'Sagicor': ['sbj_'],
+    'NCB': ['ncb_'],
+    'Scotia': ['scotia_'],
+    'JMMB': ['jmmb_'],
+    'CIBC': ['cibc_'],
+}
+
+# Bank names that may appear anywhere in a location string
+BANK_PATTERNS = {
+    'NCB': ['NCB', 'NATIONAL COMMERCIAL BANK'],
+    'Scotia': ['BNS', 'BANK OF NOVA SCOTIA', 'SCOTIABANK', 'SCOTIA'],
+    'JMMB': ['JMMB', 'JAMAICA MONEY MARKET'],
+    'CIBC': ['CIBC', 'FIRSTCARIBBEAN'],
+    'JN': ['JN BANK', 'JAMAICA NATIONAL'],
+    'FCIB': ['FCIB'],
+    'Sagicor': ['SAGICOR'],
+}
+
+
+def _compile_classifier():
+    """
+    Build one case-insensitive regex for every prefix and pattern.
+    Prefixes are tried first; otherwise the bank named earliest in the location wins
+    """
+    alternatives = []
+    banks = []
+    for bank, prefixes in BANK_PREFIXES.items():
+        for prefix in prefixes:
+            alternatives.append(f"^({re.escape(prefix)})")
+            banks.append(bank)
+    # Longer patterns first so e.g. SCOTIABANK is preferred over SCOTIA at the same position
+    patterns = sorted(
+        ((pattern, bank) for bank, names in BANK_PATTERNS.items() for pattern in names),
+        key=lambda item: -len(item[0])
+    )
+    for pattern, bank in patterns:
+        alternatives.append(f"({re.escape(pattern)})")
+        banks.append(bank)
+
+    return re.compile('|'.join(alternatives), re.IGNORECASE), banks
+
+_classifier, _classifier_banks = _compile_classifier()
+
+def classify_bank(location):
+    """Bank code for an ATM location string, 'Unknown' if no bank can be identified"""
+    if not location:
+        return 'Unknown'
+
+    match = _classifier.search(location)
+    if not match:
+        return 'Unknown'
+    return _classifier_banks[match.lastindex - 1]
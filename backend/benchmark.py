@@ -0,0 +1,336 @@
+# benchmark.py - Latency/throughput benchmarks for recommendations, filtering and ATM serialization
+#
+# Usage:
+#   python benchmark.py                            # 1k, 10k, 100k and 1M ATM fleets, in memory
+#   python benchmark.py --sizes 1000,10000 --sqlite
+#   python benchmark.py --compare benchmark_results/<earlier run>.json
+#
+# Fleets are synthetic and never touch the production database: ATMs are
+# scattered around the parish centres and held in an in-memory ATMSnapshot,
+# or round-tripped through an embedded SQLite file with --sqlite.
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+# geocoding builds its Google Maps client at import; the benchmark only reads PARISH_DEFAULTS
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'AIzaBenchmarkPlaceholderKey')
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, ATM, ATMChange, DataVersion, UserPreferences
+from geocoding import PARISH_DEFAULTS
+from atm_snapshot import ATMRecord, ATMSnapshot, load_atm_snapshot, parse_time_of_day
+from preferences import compile_preferences
+from recommendation import ATMRecommendationEngine, get_atm_fleet
+from atm_views import filter_atms_by_preferences, serialize_atm, serialize_filtered_atms
+from http_cache import PreparedJSON
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+# Location prefixes/names picked so banks.classify_bank spreads ATMs over every bank
+BANK_LOCATIONS = {
+    'NCB': 'NCB {place}',
+    'Scotia': 'Scotiabank {place}',
+    'JMMB': 'JMMB {place}',
+    'CIBC': 'CIBC FirstCaribbean {place}',
+    'JN': 'JN Bank {place}',
+    'Sagicor': 'sbj_{place}',
+}
+PLACES = ['Half Way Tree', 'New Kingston', 'Liguanea', 'Portmore', 'Spanish Town',
+          'May Pen', 'Mandeville', 'Montego Bay', 'Ocho Rios', 'Negril', 'Port Antonio']
+
+PREFERRED_BANKS = [['Any'], ['NCB'], ['Scotia'], ['Sagicor', 'JMMB'], ['CIBC', 'JN'], ['FCIB']]
+TRANSACTION_TYPES = [['both'], ['withdrawal'], ['deposit'], ['withdrawal', 'deposit']]
+
+
+def synthetic_atms(count: int, rng: random.Random):
+    """ATM records scattered around the parish centres, roughly like the real feed"""
+    parishes = list(PARISH_DEFAULTS.items())
+    banks = list(BANK_LOCATIONS.items())
+    updated_at = datetime(2024, 1, 1, 12, 0, 0)
+
+    atms = []
+    for i in range(count):
+        parish, (lat, lng) = parishes[i % len(parishes)]
+        bank, template = banks[rng.randrange(len(banks))]
+        location = template.format(place=rng.choice(PLACES))
+        geocoding_failed = rng.random() < 0.02
+        last_used = None
+        if rng.random() < 0.9:
+            last_used = f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}"
+
+        atms.append(ATMRecord(
+            id=i + 1,
+            atm_id=f"bench_{i + 1}",
+            location=location,
+            parish=parish,
+            deposit_available=rng.random() < 0.4,
+            status='WORKING' if rng.random() < 0.85 else 'NOT WORKING',
+            last_used=last_used,
+            latitude=None if geocoding_failed else lat + rng.gauss(0, 0.05),
+            longitude=None if geocoding_failed else lng + rng.gauss(0, 0.05),
+            geocoding_failed=geocoding_failed,
+            bank=bank,
+            created_at=updated_at,
+            updated_at=updated_at,
+            last_used_seconds=parse_time_of_day(last_used)
+        ))
+    return atms
+
+def synthetic_preferences(count: int, rng: random.Random):
+    """Compiled preferences for count users with a mix of banks, transaction types and radii"""
+    return [
+        compile_preferences(UserPreferences(
+            user_id=user_id,
+            preferred_banks=json.dumps(rng.choice(PREFERRED_BANKS)),
+            transaction_types=json.dumps(rng.choice(TRANSACTION_TYPES)),
+            max_radius_km=rng.choice([1, 2, 5, 10, 20]),
+            preferred_currency='JMD'
+        ))
+        for user_id in range(1, count + 1)
+    ]
+
+def synthetic_locations(count: int, rng: random.Random):
+    """User locations near the parish centres"""
+    parishes = list(PARISH_DEFAULTS.values())
+    locations = []
+    for _ in range(count):
+        lat, lng = rng.choice(parishes)
+        locations.append((lat + rng.gauss(0, 0.03), lng + rng.gauss(0, 0.03)))
+    return locations
+
+
+def sqlite_snapshot(atms, path: str) -> ATMSnapshot:
+    """Write the ATMs to an embedded SQLite database and load a snapshot back from it"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine, tables=[ATM.__table__, ATMChange.__table__, DataVersion.__table__])
+    Session = sessionmaker(bind=engine)
+
+    db = Session()
+    try:
+        columns = ['id', 'atm_id', 'location', 'parish', 'deposit_available', 'status', 'last_used',
+                   'latitude', 'longitude', 'geocoding_failed', 'bank', 'created_at', 'updated_at']
+        for start in range(0, len(atms), 10000):
+            db.bulk_insert_mappings(ATM, [
+                {column: getattr(atm, column) for column in columns}
+                for atm in atms[start:start + 10000]
+            ])
+        db.commit()
+        return load_atm_snapshot(db)
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def summarize(name: str, fleet_size: int, latencies, items: int = 1):
+    """Latency percentiles (ms) and throughput for one benchmark"""
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    total_seconds = latencies.sum() / 1000
+    return {
+        'benchmark': name,
+        'fleet_size': fleet_size,
+        'iterations': len(latencies),
+        'mean_ms': round(float(latencies.mean()), 4),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 4),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 4),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 4),
+        'max_ms': round(float(latencies.max()), 4),
+        'throughput_per_s': round(len(latencies) * items / total_seconds, 2) if total_seconds else None
+    }
+
+def timed(fn, args_list):
+    """Call fn once per argument tuple, returning per-call latencies in seconds"""
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def run_fleet(size: int, args, rng: random.Random):
+    """Every benchmark for one fleet size"""
+    results = []
+    engine = ATMRecommendationEngine()
+
+    atms = synthetic_atms(size, rng)
+
+    start = time.perf_counter()
+    if args.sqlite:
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = sqlite_snapshot(atms, os.path.join(tmp, 'benchmark.db'))
+    else:
+        snapshot = ATMSnapshot(1, atms)
+    results.append(summarize('snapshot_load', size, [time.perf_counter() - start]))
+
+    start = time.perf_counter()
+    fleet = get_atm_fleet(snapshot)
+    fleet.wait
+    results.append(summarize('fleet_build', size, [time.perf_counter() - start]))
+
+    preferences = synthetic_preferences(args.users, rng)
+    locations = synthetic_locations(args.requests, rng)
+    calls = [(preferences[i % len(preferences)], lat, lng) for i, (lat, lng) in enumerate(locations)]
+
+    results.append(summarize('recommendations', size, timed(
+        lambda prefs, lat, lng: engine.get_recommendations(prefs.user_id, lat, lng, limit=args.limit,
+                                                           preferences=prefs, snapshot=snapshot),
+        calls
+    )))
+
+    # The same requests through the batch path, args.batch_size per call;
+    # throughput is per request so it compares directly with 'recommendations'
+    batches = [
+        ([(prefs.user_id, lat, lng) for prefs, lat, lng in calls[start:start + args.batch_size]],
+         [prefs for prefs, _, _ in calls[start:start + args.batch_size]])
+        for start in range(0, len(calls), args.batch_size)
+    ]
+    results.append(summarize('batch_recommendations', size, timed(
+        lambda requests, batch_preferences: engine.get_batch_recommendations(
+            requests, limit=args.limit, snapshot=snapshot, preferences=batch_preferences),
+        batches
+    ), items=len(calls) / len(batches)))
+
+    # Batching exists to be cheaper than a loop of single calls; flag regressions
+    single, batch = results[-2]['throughput_per_s'], results[-1]['throughput_per_s']
+    if single and batch and batch < 0.9 * single:
+        print(f"WARNING: batch recommendations ({batch:.0f}/s) are slower than single calls "
+              f"({single:.0f}/s) for {size} ATMs", file=sys.stderr)
+
+    results.append(summarize('filter_atms', size, timed(
+        lambda prefs, lat, lng: filter_atms_by_preferences(fleet, prefs, lat, lng),
+        calls
+    )))
+
+    # Filtering plus the /api/atms/filtered response body
+    filtered_calls = calls[:max(1, args.requests // 10)] if size >= 100000 else calls
+    results.append(summarize('filtered_response', size, timed(
+        lambda prefs, lat, lng: json.dumps(serialize_filtered_atms(
+            filter_atms_by_preferences(fleet, prefs, lat, lng), lat, lng)),
+        filtered_calls
+    )))
+
+    # The full /api/atms body; one pass over the fleet per iteration
+    results.append(summarize('atms_serialization', size, timed(
+        lambda: json.dumps([serialize_atm(atm) for atm in snapshot.atms]),
+        [()] * args.serialization_iterations
+    ), items=size))
+
+    # Building the cached /api/atms payload (identity and gzip), done once per data version
+    results.append(summarize('atms_payload_build', size, timed(
+        lambda: PreparedJSON([serialize_atm(atm) for atm in snapshot.atms]).encoded('gzip'),
+        [()] * args.serialization_iterations
+    ), items=size))
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    """Human-readable table; with a baseline, p50/p95 ratios (new / old) are shown too"""
+    previous = {}
+    for row in (baseline or {}).get('results', []):
+        previous[(row['benchmark'], row['fleet_size'])] = row
+
+    header = f"{'benchmark':<20}{'fleet':>10}{'iters':>7}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'per s':>14}"
+    if baseline:
+        header += f"{'p50 x':>9}{'p95 x':>9}"
+    print(header)
+    for row in results:
+        line = (f"{row['benchmark']:<20}{row['fleet_size']:>10}{row['iterations']:>7}"
+                f"{row['p50_ms']:>12.3f}{row['p95_ms']:>12.3f}{row['p99_ms']:>12.3f}"
+                f"{row['throughput_per_s'] or 0:>14.1f}")
+        old = previous.get((row['benchmark'], row['fleet_size']))
+        if old and old['p50_ms'] and old['p95_ms']:
+            line += f"{row['p50_ms'] / old['p50_ms']:>9.2f}{row['p95_ms'] / old['p95_ms']:>9.2f}"
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ATM recommendations, filtering and serialization")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated fleet sizes')
+    parser.add_argument('--requests', type=int, default=200, help='Requests timed per benchmark')
+    parser.add_argument('--users', type=int, default=1000, help='Synthetic users with preferences')
+    parser.add_argument('--limit', type=int, default=3, help='Recommendations per request')
+    parser.add_argument('--batch-size', type=int, default=100, help='Requests per batch recommendation call')
+    parser.add_argument('--serialization-iterations', type=int, default=5,
+                        help='Full /api/atms serializations timed per fleet')
+    parser.add_argument('--sqlite', action='store_true',
+                        help='Load each fleet through an embedded SQLite database instead of memory')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Result file (default: benchmark_results/<timestamp>-<commit>.json)')
+    parser.add_argument('--compare', help='Earlier result file to compare against')
+    args = parser.parse_args(argv)
+
+    # Per-request info logging would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+
+    results = []
+    for size in sizes:
+        print(f"Benchmarking {size} ATMs...", file=sys.stderr)
+        results.extend(run_fleet(size, args, rng))
+
+    commit = git_commit()
+    now = datetime.now(timezone.utc)
+    report = {
+        'commit': commit,
+        'timestamp': now.isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'storage': 'sqlite' if args.sqlite else 'memory',
+        'parameters': {
+            'requests': args.requests,
+            'users': args.users,
+            'limit': args.limit,
+            'batch_size': args.batch_size,
+            'serialization_iterations': args.serialization_iterations,
+            'seed': args.seed
+        },
+        'results': results
+    }
+
+    output = args.output
+    if not output:
+        os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
+        name = f"{now.strftime('%Y%m%dT%H%M%SZ')}-{(commit or 'unknown')[:10]}.json"
+        output = os.path.join(DEFAULT_OUTPUT_DIR, name)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
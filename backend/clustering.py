@@ -0,0 +1,111 @@
+# clustering.py - Zoom-level ATM clusters for the map, built once per ATM snapshot
+
+import os
+import math
+import numpy as np
+from typing import Any, Dict, List
+from recommendation import get_atm_fleet
+from spatial_index import GridIndex
+from http_cache import PreparedJSON
+
+# Clusters are the ATMs sharing a square of this many screen pixels (256px web map tiles).
+# Squares halve in size with every zoom level, so each cluster splits cleanly into
+# clusters of the next level and the levels form a hierarchy
+CLUSTER_CELL_PX = 64
+
+# Above this zoom every ATM is returned on its own
+CLUSTER_MAX_ZOOM = int(os.getenv('CLUSTER_MAX_ZOOM', '16'))
+MAX_ZOOM = 22
+
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def mercator(lat: np.ndarray, lng: np.ndarray):
+    """Web mercator coordinates scaled to [0, 1] (x east, y south)"""
+    sin_lat = np.sin(np.radians(np.clip(lat, -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)))
+    x = (lng + 180) / 360
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return np.clip(x, 0, 1), np.clip(y, 0, 1)
+
+
+class ClusterLevel:
+    """
+    Clusters of located ATMs at one zoom level, with working / not working /
+    deposit-capable counts and a spatial index over the cluster centres
+    """
+
+    def __init__(self, fleet, zoom: int):
+        self.zoom = zoom
+        positions = np.flatnonzero(fleet.has_coordinates)
+        lat = fleet.lat[positions]
+        lng = fleet.lng[positions]
+
+        if zoom > CLUSTER_MAX_ZOOM:
+            keys = positions
+            members = np.arange(len(positions))
+        else:
+            cells = (2 ** zoom) * 256 // CLUSTER_CELL_PX
+            x, y = mercator(lat, lng)
+            cell_x = np.minimum(np.floor(x * cells), cells - 1).astype(np.int64)
+            cell_y = np.minimum(np.floor(y * cells), cells - 1).astype(np.int64)
+            keys, members = np.unique(cell_y * cells + cell_x, return_inverse=True)
+            members = members.reshape(-1)
+
+        self.keys = keys
+        self.count = np.bincount(members, minlength=len(keys))
+        self.lat = np.bincount(members, weights=lat, minlength=len(keys)) / self.count
+        self.lng = np.bincount(members, weights=lng, minlength=len(keys)) / self.count
+        self.working = np.bincount(members, weights=fleet.working[positions], minlength=len(keys)).astype(np.int64)
+        self.deposit = np.bincount(members, weights=fleet.deposit[positions], minlength=len(keys)).astype(np.int64)
+
+        # The ATM behind each single-ATM cluster
+        self.atm_ids = np.full(len(keys), -1, dtype=np.int64)
+        self.atm_ids[members] = [fleet.atms[i].id for i in positions]
+
+        self.index = GridIndex(self.lat, self.lng)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def serialize(self, selection=None) -> List[Dict[str, Any]]:
+        """Clusters (all, or those at the selected positions) in API format"""
+        if selection is None:
+            selection = range(len(self.keys))
+
+        clusters = []
+        for i in selection:
+            count = int(self.count[i])
+            cluster = {
+                'id': f"{self.zoom}:{int(self.keys[i])}",
+                'lat': float(self.lat[i]),
+                'lng': float(self.lng[i]),
+                'count': count,
+                'working': int(self.working[i]),
+                'notWorking': count - int(self.working[i]),
+                'deposit': int(self.deposit[i])
+            }
+            if count == 1:
+                cluster['atmId'] = int(self.atm_ids[i])
+            clusters.append(cluster)
+        return clusters
+
+
+def get_cluster_level(snapshot, zoom: int) -> ClusterLevel:
+    """Clusters for a zoom level of an ATM snapshot, built on first use"""
+    zoom = min(zoom, CLUSTER_MAX_ZOOM + 1)  # Every level above the maximum is the same
+    return snapshot.derived(f'clusters:{zoom}', lambda: ClusterLevel(get_atm_fleet(snapshot), zoom))
+
+def get_clusters_payload(snapshot, zoom: int) -> PreparedJSON:
+    """The /api/atms/clusters response for a whole zoom level, serialized on first use"""
+    return snapshot.derived(f'clusters_payload:{zoom}', lambda: PreparedJSON({
+        'zoom': zoom,
+        'clusters': get_cluster_level(snapshot, zoom).serialize()
+    }))
+
+def clusters_in_bbox(snapshot, zoom: int, bbox) -> Dict[str, Any]:
+    """Clusters of a zoom level whose centres lie in bbox (min_lat, min_lng, max_lat, max_lng)"""
+    level = get_cluster_level(snapshot, zoom)
+    return {
+        'zoom': zoom,
+        'clusters': level.serialize(level.index.within_bbox(*bbox))
+    }
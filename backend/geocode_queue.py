@@ -0,0 +1,176 @@
+# geocode_queue.py - Persistent geocoding work queue, drained outside the ingestion transaction
+
+import os
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Set, Tuple
+from sqlalchemy import insert
+from models import ATM, GeocodeJob, SessionLocal
+from geocoding import coordinates_cache, geocode_executor
+from atm_snapshot import ATM_DATA_VERSION, bump_data_version, invalidate_atm_snapshot, lock_data_version
+from atm_changes import CHANGE_UPDATED, record_atm_changes
+
+logger = logging.getLogger(__name__)
+
+# Jobs claimed per drain pass
+GEOCODE_BATCH_SIZE = int(os.getenv('GEOCODE_BATCH_SIZE', '50'))
+
+# Seconds between drain passes of the scheduler job / standalone worker; a
+# scheduled pass keeps claiming batches for at most this long
+GEOCODE_DRAIN_SECONDS = int(os.getenv('GEOCODE_DRAIN_SECONDS', '30'))
+
+# A claimed job is invisible to other workers for this long; if its worker
+# dies the job becomes due again afterwards
+GEOCODE_LEASE_SECONDS = int(os.getenv('GEOCODE_LEASE_SECONDS', '300'))
+
+# Failed jobs are retried after GEOCODE_RETRY_SECONDS, doubling per attempt up to GEOCODE_RETRY_MAX_SECONDS
+GEOCODE_RETRY_SECONDS = int(os.getenv('GEOCODE_RETRY_SECONDS', '300'))
+GEOCODE_RETRY_MAX_SECONDS = int(os.getenv('GEOCODE_RETRY_MAX_SECONDS', '21600'))
+
+
+def pending_geocode_atm_ids(db) -> Set[str]:
+    """atm_ids that already have a geocode job"""
+    return {atm_id for atm_id, in db.query(GeocodeJob.atm_id)}
+
+def enqueue_geocode_jobs(db, jobs: Iterable[Tuple[str, str, str]]) -> int:
+    """
+    Add (atm_id, location, parish) jobs with a single multi-row insert as part
+    of the caller's transaction, due immediately. Callers skip ATMs that already have a job
+    """
+    now = datetime.utcnow()
+    rows = [{'atm_id': atm_id, 'location': location, 'parish': parish, 'attempts': 0, 'not_before': now}
+            for atm_id, location, parish in jobs]
+    if rows:
+        db.execute(insert(GeocodeJob), rows)
+    return len(rows)
+
+def claim_geocode_jobs(limit: int = GEOCODE_BATCH_SIZE):
+    """
+    Lease up to limit due jobs to this worker and return their
+    (id, atm_id, location, parish, attempts). Rows locked by another
+    worker's claim are skipped
+    """
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        jobs = db.query(GeocodeJob).filter(
+            GeocodeJob.not_before <= now
+        ).order_by(GeocodeJob.not_before).limit(limit).with_for_update(skip_locked=True).all()
+
+        claimed = []
+        for job in jobs:
+            job.not_before = now + timedelta(seconds=GEOCODE_LEASE_SECONDS)
+            claimed.append((job.id, job.atm_id, job.location, job.parish, job.attempts))
+        db.commit()
+        return claimed
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def complete_geocode_jobs(results) -> int:
+    """
+    Write geocoding results back in one transaction: coordinates onto the
+    ATMs (with change feed entries), finished jobs deleted, failed jobs
+    rescheduled with backoff. Returns the number of ATMs whose location data changed
+    """
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        jobs = {job.id: job for job in db.query(GeocodeJob).filter(
+            GeocodeJob.id.in_([job[0] for job, _ in results]))}
+        atms = {atm.atm_id: atm for atm in db.query(ATM).filter(
+            ATM.atm_id.in_([job[1] for job, _ in results]))}
+
+        changed_ids = []
+        for (job_id, atm_id, location, parish, attempts), (lat, lng, failed) in results:
+            job = jobs.get(job_id)
+            atm = atms.get(atm_id)
+
+            if atm is not None and (atm.latitude, atm.longitude, atm.geocoding_failed) != (lat, lng, failed):
+                atm.latitude = lat
+                atm.longitude = lng
+                atm.geocoding_failed = failed
+                changed_ids.append(atm.id)
+
+            if job is None:
+                continue
+            if atm is None or not failed:
+                db.delete(job)
+            else:
+                # Keep the job so ingestion doesn't queue the ATM again; retry it later
+                delay = min(GEOCODE_RETRY_SECONDS * 2 ** attempts, GEOCODE_RETRY_MAX_SECONDS)
+                job.attempts = attempts + 1
+                job.not_before = now + timedelta(seconds=delay)
+                job.last_error = f"Geocoding failed for {location}, {parish}"
+
+        if changed_ids:
+            lock_data_version(db, ATM_DATA_VERSION)
+            record_atm_changes(db, changed_ids, CHANGE_UPDATED)
+            bump_data_version(db, ATM_DATA_VERSION)
+        db.commit()
+        return len(changed_ids)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def drain_geocode_batch(limit: int = GEOCODE_BATCH_SIZE, warm_cache: bool = True) -> int:
+    """
+    Geocode one batch of due jobs; returns the number of jobs processed.
+    warm_cache loads the geocoding cache table before geocoding
+    """
+    try:
+        jobs = claim_geocode_jobs(limit)
+        if not jobs:
+            return 0
+
+        if warm_cache:
+            # Cached locations then resolve without a query per address
+            coordinates_cache.warm()
+
+        # No session or transaction is open while the geocoder works
+        coordinates = geocode_executor.geocode_all([
+            (location, parish, atm_id) for _, atm_id, location, parish, _ in jobs
+        ])
+        results = list(zip(jobs, coordinates))
+        coordinates_cache.flush()
+
+        changed = complete_geocode_jobs(results)
+        if changed:
+            invalidate_atm_snapshot()
+        logger.info(f"Geocoded {len(jobs)} queued ATMs, {changed} changed")
+        return len(jobs)
+    except Exception as e:
+        logger.error(f"Error draining geocode queue: {e}")
+        return 0
+
+def drain_geocode_queue(limit: int = GEOCODE_BATCH_SIZE,
+                        max_seconds: Optional[float] = GEOCODE_DRAIN_SECONDS) -> int:
+    """
+    Geocode batches of due jobs until one comes back short, for at most
+    max_seconds (None: no limit; the geocoder's rate limiter paces the batches).
+    The geocoding cache is warmed once per run, by the first batch with jobs.
+    Returns the number of jobs processed
+    """
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+    processed = 0
+    while True:
+        batch = drain_geocode_batch(limit, warm_cache=processed == 0)
+        processed += batch
+        if batch < limit or (deadline is not None and time.monotonic() >= deadline):
+            return processed
+
+def run_geocode_worker():
+    """Standalone worker: drain the queue until it is empty, then wait for more"""
+    logger.info("Geocode worker started")
+    while True:
+        drain_geocode_queue(max_seconds=None)
+        time.sleep(GEOCODE_DRAIN_SECONDS)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_geocode_worker()
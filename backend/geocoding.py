@@ -1,9 +1,14 @@
 import googlemaps
 import os
+import time
+import threading
 import logging
-from typing import Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
 from datetime import datetime
+from sqlalchemy import insert
 from models import GeocodingCache, GeocodingFailure, SessionLocal
+from cache import LRUCache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -12,6 +17,19 @@ logger = logging.getLogger(__name__)
 # Initialize Google Maps client
 gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
 
+# Geocoding API requests per second (and burst) allowed per process; keep under the provider quota
+GEOCODE_RATE_PER_SECOND = float(os.getenv('GEOCODE_RATE_PER_SECOND', '40'))
+GEOCODE_BURST = int(os.getenv('GEOCODE_BURST', '10'))
+
+# Concurrent geocoding lookups per process
+GEOCODE_WORKERS = int(os.getenv('GEOCODE_WORKERS', '8'))
+
+# Lookups queued or running before submitters have to wait
+GEOCODE_MAX_PENDING = int(os.getenv('GEOCODE_MAX_PENDING', '200'))
+
+# Geocoded locations kept in memory per process
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', '20000'))
+
 # Default coordinates for parishes in Jamaica (center points)
 PARISH_DEFAULTS = {
     'Kingston': (17.9970, -76.7936),
@@ -30,46 +48,134 @@ PARISH_DEFAULTS = {
     'St Thomas': (17.9000, -76.3500)
 }
 
+class TokenBucket:
+    """Thread-safe token bucket: rate tokens per second, at most capacity saved up"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+api_rate_limiter = TokenBucket(GEOCODE_RATE_PER_SECOND, GEOCODE_BURST)
+
+class CoordinatesCache:
+    """
+    In-process LRU in front of the geocoding_cache table. warm() loads the
+    whole table in one query; newly geocoded coordinates are held until
+    flush() writes them in a single insert
+    """
+
+    def __init__(self, maxsize: int = GEOCODE_CACHE_SIZE):
+        self.entries = LRUCache(maxsize)
+        self.db_lookups = 0
+        self._complete = False  # Entries hold the whole table, so a miss needs no query
+        self._pending = {}  # location -> (parish, lat, lng) not yet in the table
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """Load every cached location with one SELECT"""
+        db = SessionLocal()
+        try:
+            rows = db.query(GeocodingCache.location, GeocodingCache.parish,
+                            GeocodingCache.latitude, GeocodingCache.longitude).all()
+        finally:
+            db.close()
+
+        for location, parish, lat, lng in rows:
+            self.entries.set((location, parish), (lat, lng))
+        # Below maxsize the LRU evicted nothing, so every row is in memory
+        self._complete = len(self.entries) < self.entries.maxsize
+        logger.info(f"Warmed geocoding cache with {len(rows)} locations")
+
+    def get(self, location: str, parish: str) -> Optional[Tuple[float, float]]:
+        coords = self.entries.get((location, parish))
+        if coords is not None or self._complete:
+            return coords
+
+        # Not warmed, or the table doesn't fit: fall back to the table
+        self.db_lookups += 1
+        db = SessionLocal()
+        try:
+            cache_entry = db.query(GeocodingCache).filter(
+                GeocodingCache.location == location,
+                GeocodingCache.parish == parish
+            ).first()
+        finally:
+            db.close()
+
+        if cache_entry:
+            coords = (cache_entry.latitude, cache_entry.longitude)
+            self.entries.set((location, parish), coords)
+        return coords
+
+    def add(self, location: str, parish: str, lat: float, lng: float):
+        self.entries.set((location, parish), (lat, lng))
+        if len(self.entries) >= self.entries.maxsize:
+            self._complete = False  # Further adds evict entries that only the table still has
+        with self._lock:
+            self._pending[location] = (parish, lat, lng)
+
+    def flush(self) -> int:
+        """Insert the coordinates added since the last flush; returns rows written"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        db = SessionLocal()
+        try:
+            # Another process may have cached some of these already (location is unique)
+            existing = {location for location, in db.query(GeocodingCache.location).filter(
+                GeocodingCache.location.in_(list(pending)))}
+            rows = [{'location': location, 'parish': parish, 'latitude': lat, 'longitude': lng}
+                    for location, (parish, lat, lng) in pending.items() if location not in existing]
+            if rows:
+                db.execute(insert(GeocodingCache), rows)
+            db.commit()
+            logger.info(f"Cached coordinates for {len(rows)} locations")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Failed to cache coordinates: {e}")
+            db.rollback()
+            with self._lock:
+                # Keep them for the next flush, behind anything added meanwhile
+                self._pending = {**pending, **self._pending}
+            return 0
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.entries.stats()
+        stats['db_lookups'] = self.db_lookups
+        stats['pending_inserts'] = len(self._pending)
+        return stats
+
+
+coordinates_cache = CoordinatesCache()
+
 def get_cached_coordinates(location: str, parish: str) -> Optional[Tuple[float, float]]:
     """Get coordinates from cache if available"""
-    db = SessionLocal()
-    try:
-        cache_entry = db.query(GeocodingCache).filter(
-            GeocodingCache.location == location,
-            GeocodingCache.parish == parish
-        ).first()
-        
-        if cache_entry:
-            return (cache_entry.latitude, cache_entry.longitude)
-        return None
-    finally:
-        db.close()
+    return coordinates_cache.get(location, parish)
 
 def cache_coordinates(location: str, parish: str, lat: float, lng: float):
-    """Cache coordinates for future use"""
-    db = SessionLocal()
-    try:
-        # Check if already exists
-        existing = db.query(GeocodingCache).filter(
-            GeocodingCache.location == location,
-            GeocodingCache.parish == parish
-        ).first()
-        
-        if not existing:
-            cache_entry = GeocodingCache(
-                location=location,
-                parish=parish,
-                latitude=lat,
-                longitude=lng
-            )
-            db.add(cache_entry)
-            db.commit()
-            logger.info(f"Cached coordinates for {location}, {parish}")
-    except Exception as e:
-        logger.error(f"Failed to cache coordinates: {e}")
-        db.rollback()
-    finally:
-        db.close()
+    """Cache coordinates for future use (written to the table on the next flush)"""
+    coordinates_cache.add(location, parish, lat, lng)
 
 def log_geocoding_failure(atm_id: str, location: str, parish: str, error: str):
     """Log geocoding failure for retry later"""
@@ -102,10 +208,12 @@ def log_geocoding_failure(atm_id: str, location: str, parish: str, error: str):
     finally:
         db.close()
 
-def get_parish_default_coordinates(parish: str) -> Tuple[float, float]:
-    """Get default coordinates for a parish"""
+def get_parish_default_coordinates(parish: Optional[str]) -> Tuple[float, float]:
+    """Get default coordinates for a parish (St Andrew when it is missing or unknown)"""
     # Clean parish name and try to match
-    parish_clean = parish.strip().title()
+    parish_clean = (parish or '').strip().title()
+    if not parish_clean:
+        return PARISH_DEFAULTS['St Andrew']
     
     # Try exact match first
     if parish_clean in PARISH_DEFAULTS:
@@ -136,7 +244,8 @@ def geocode_location(location: str, parish: str, atm_id: str) -> Tuple[float, fl
         search_query = f"{location}, {parish}, Jamaica"
         logger.info(f"Geocoding: {search_query}")
         
-        # Geocode with Google Maps
+        # Geocode with Google Maps, within the API quota
+        api_rate_limiter.acquire()
         geocode_result = gmaps.geocode(search_query)
         
         if geocode_result and len(geocode_result) > 0:
@@ -168,28 +277,110 @@ def geocode_location(location: str, parish: str, atm_id: str) -> Tuple[float, fl
         default_coords = get_parish_default_coordinates(parish)
         return default_coords[0], default_coords[1], True
 
-def retry_failed_geocoding():
-    """Retry geocoding for previously failed locations"""
-    db = SessionLocal()
-    try:
-        # Get failures that haven't been retried too many times (max 3 retries)
-        failures = db.query(GeocodingFailure).filter(
-            GeocodingFailure.retry_count < 3
-        ).all()
-        
-        for failure in failures:
-            logger.info(f"Retrying geocoding for ATM {failure.atm_id}")
-            lat, lng, failed = geocode_location(failure.location, failure.parish, failure.atm_id)
-            
-            if not failed:
-                # Success! Remove from failures table
-                db.delete(failure)
-                logger.info(f"Successfully geocoded ATM {failure.atm_id} on retry")
-            # If still failed, the log_geocoding_failure function will increment retry count
-        
-        db.commit()
-    except Exception as e:
-        logger.error(f"Error during retry geocoding: {e}")
-        db.rollback()
-    finally:
-        db.close()
+
+class GeocodingExecutor:
+    """
+    Geocodes on a thread pool. Lookups of a (location, parish) already in
+    flight share its future, and submit blocks while max_pending lookups
+    are outstanding. The geocoder and an extra rate limiter can be injected
+    (e.g. a fake geocoder with artificial latency)
+    """
+
+    def __init__(self, geocoder: Optional[Callable[[str, str, str], Tuple[float, float, bool]]] = None,
+                 workers: int = GEOCODE_WORKERS, max_pending: int = GEOCODE_MAX_PENDING,
+                 rate_limiter: Optional[TokenBucket] = None):
+        self.geocoder = geocoder or geocode_location
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rate_limiter = rate_limiter
+        self.submitted = 0
+        self.deduplicated = 0
+        self.completed = 0
+        self._in_flight = {}  # (location, parish) -> Future
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def submit(self, location: str, parish: str, atm_id: str) -> Future:
+        """Future of (latitude, longitude, geocoding_failed) for a location"""
+        key = (location, parish)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future
+
+        self._slots.acquire()  # Backpressure: wait until a lookup finishes
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._slots.release()
+                self.deduplicated += 1
+                return future
+
+            try:
+                future = self._get_pool().submit(self._geocode, location, parish, atm_id)
+            except Exception:
+                self._slots.release()  # Nothing will finish to give the slot back
+                raise
+            self._in_flight[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda _: self._finish(key))
+        return future
+
+    def geocode_all(self, lookups) -> list:
+        """
+        Geocode (location, parish, atm_id) lookups concurrently, returning their
+        results in order. A lookup that raises gets its parish default, marked
+        failed, without affecting the others
+        """
+        futures = []
+        for location, parish, atm_id in lookups:
+            try:
+                futures.append(self.submit(location, parish, atm_id))
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+                futures.append(future)
+
+        results = []
+        for (location, parish, atm_id), future in zip(lookups, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"Geocoding {location}, {parish} for ATM {atm_id} failed: {e}")
+                default_coords = get_parish_default_coordinates(parish)
+                results.append((default_coords[0], default_coords[1], True))
+        return results
+
+    def _geocode(self, location: str, parish: str, atm_id: str):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return self.geocoder(location, parish, atm_id)
+
+    def _finish(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            self.completed += 1
+        self._slots.release()
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        # Gunicorn forks workers from a preloaded app; threads don't survive the fork
+        if self._pool is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='geocoder')
+        return self._pool
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'in_flight': len(self._in_flight),
+                'submitted': self.submitted,
+                'deduplicated': self.deduplicated,
+                'completed': self.completed
+            }
+
+
+geocode_executor = GeocodingExecutor()
@@ -1,13 +1,32 @@
 # Gunicorn configuration file for production
 
+import os
+
 # Server socket
 bind = "0.0.0.0:5000"
 backlog = 2048
 
 # Worker processes
 workers = 4
-worker_class = "sync"
-worker_connections = 1000
+# Threaded workers by default: numpy scoring, payload compression and snapshot
+# rebuilds are CPU-bound and never yield, so under gevent one heavy request
+# would stall every other request and open stream on its worker. Each open
+# /api/atms/stream holds a thread here, so streams get at most half of them;
+# clients over the limit get a 503 and fall back to polling
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+if worker_class == "gevent":
+    # Opt-in, e.g. for a separate deployment that only serves /api/atms/stream:
+    # streams become cheap greenlets, worker_connections bounds them.
+    # preload_app imports the app in the master, before the gevent worker
+    # patches anything. Patch here first so the locks, threads and sockets
+    # created at import (snapshot, broadcaster, DB pool, scheduler, mailer)
+    # cooperate with greenlets
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+    from gevent import monkey
+    monkey.patch_all()
+else:
+    os.environ.setdefault("STREAM_MAX_CONNECTIONS", str(max(threads // 2, 1)))
 timeout = 30
 keepalive = 2
 
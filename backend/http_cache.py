@@ -0,0 +1,86 @@
+# http_cache.py - Pre-serialized JSON responses with compression and ETag validation
+
+import gzip
+import json
+import hashlib
+import threading
+from typing import Any, Optional
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; clients fall back to gzip
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Higher qualities take seconds on a full fleet for little gain
+
+# Content codings we can serve, in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+class PreparedJSON:
+    """
+    A JSON document serialized once, with a strong ETag derived from its
+    bytes. Compressed variants are produced on first request and reused
+    """
+
+    def __init__(self, data: Any):
+        # Same output as jsonify in production (sorted keys, compact separators)
+        self.body = (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def variant_etag(self, encoding: Optional[str]) -> str:
+        """Each content coding is a different representation, so it gets its own tag"""
+        return self.etag if encoding is None else f"{self.etag}-{encoding}"
+
+    def encoded(self, encoding: Optional[str]) -> bytes:
+        """Body in the given content coding (None for identity)"""
+        if encoding is None:
+            return self.body
+
+        body = self._encoded.get(encoding)
+        if body is None:
+            with self._lock:
+                body = self._encoded.get(encoding)
+                if body is None:
+                    if encoding == 'br':
+                        body = brotli.compress(self.body, quality=BROTLI_QUALITY)
+                    else:
+                        body = gzip.compress(self.body, compresslevel=GZIP_LEVEL)
+                    self._encoded[encoding] = body
+        return body
+
+
+def negotiate_encoding() -> Optional[str]:
+    """Best content coding accepted by the current request, None for identity"""
+    accepted = request.accept_encodings
+    for encoding in ENCODINGS:
+        if accepted[encoding]:
+            return encoding
+    return None
+
+def prepared_json_response(prepared: PreparedJSON, cache_control: str) -> Response:
+    """
+    Serve a PreparedJSON for the current request, answering 304 Not Modified
+    when If-None-Match already names any variant of it. If-None-Match uses weak
+    comparison, so W/ tags (as proxies that recompress hand them back) match too
+    """
+    encoding = negotiate_encoding()
+
+    if_none_match = request.if_none_match
+    if if_none_match and (if_none_match.star_tag or any(
+            if_none_match.contains_weak(prepared.variant_etag(variant))
+            for variant in (None,) + ENCODINGS)):
+        response = Response(status=304)
+    else:
+        response = Response(prepared.encoded(encoding), mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(prepared.variant_etag(encoding))
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,234 @@
+# mailer.py - Outbound mail queue delivered by background senders over a reused SMTP connection
+
+import os
+import time
+import heapq
+import queue
+import smtplib
+import itertools
+import threading
+import logging
+from email.message import EmailMessage
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Point these at a local stand-in (e.g. `python -m aiosmtpd -n -l localhost:1025`,
+# with SMTP_SSL=false) to exercise delivery without a real mailbox
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465"))
+SMTP_SSL = os.getenv("SMTP_SSL", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "20"))
+
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
+EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+
+# Messages waiting for delivery per worker process; beyond this enqueue refuses new mail
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", "1000"))
+
+# Sender threads per worker process, each with its own SMTP connection
+MAIL_SENDERS = int(os.getenv("MAIL_SENDERS", "2"))
+
+# Messages a sender takes off the queue at once and sends over one connection
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", "20"))
+
+# Delivery attempts per message; retries wait MAIL_RETRY_BACKOFF, then double each time
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_RETRY_BACKOFF = float(os.getenv("MAIL_RETRY_BACKOFF", "2"))
+
+# Connections unused for this long are closed (servers drop idle sessions anyway)
+SMTP_IDLE_SECONDS = float(os.getenv("SMTP_IDLE_SECONDS", "60"))
+
+# Failures that won't go away by sending again
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPNotSupportedError)
+
+
+class SMTPConnection:
+    """An authenticated SMTP session, opened on first use and reopened after errors or idling"""
+
+    def __init__(self, host: str, port: int, use_ssl: bool,
+                 username: Optional[str], password: Optional[str]):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self._smtp = None
+        self._last_used = 0.0
+
+    def send(self, msg: EmailMessage):
+        self.close_if_idle()
+        if self._smtp is None:
+            self._open()
+        try:
+            self._smtp.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+
+    def _open(self):
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            if self.password:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        logger.info(f"Opened SMTP connection to {self.host}:{self.port}")
+
+    def close_if_idle(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > SMTP_IDLE_SECONDS:
+            self.close()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            self._smtp.close()
+        self._smtp = None
+
+
+class Mailer:
+    """
+    Per-process outbound mail queue. Request handlers enqueue and return;
+    sender threads deliver in batches over their own reused SMTP connection,
+    retrying failed messages with exponential backoff
+    """
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, use_ssl: bool = SMTP_SSL,
+                 username: Optional[str] = EMAIL_ADDRESS, password: Optional[str] = EMAIL_PASSWORD,
+                 senders: int = MAIL_SENDERS, queue_size: int = MAIL_QUEUE_SIZE):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.senders = senders
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+        self._retries = []  # Heap of (due, tiebreak, attempt, message)
+        self._retry_order = itertools.count()
+        self._pending = 0  # Messages accepted but not yet sent or given up on
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._threads = []
+        self._pid = None
+
+    def enqueue(self, msg: EmailMessage) -> bool:
+        """Queue a message for delivery; False when the queue is full"""
+        self._ensure_senders()
+        with self._lock:
+            try:
+                self.queue.put_nowait((1, msg))
+            except queue.Full:
+                self.rejected += 1
+                logger.error(f"Mail queue full, dropping message to {msg['To']}")
+                return False
+            self._pending += 1
+        return True
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Block until every accepted message was sent or given up on; False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'queued': self.queue.qsize(),
+                'retrying': len(self._retries),
+                'sent': self.sent,
+                'retried': self.retried,
+                'failed': self.failed,
+                'rejected': self.rejected
+            }
+
+    def _ensure_senders(self):
+        # Gunicorn forks workers from a preloaded app, so threads started
+        # before the fork don't exist in this process
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._threads = []
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.senders:
+                thread = threading.Thread(target=self._run, name=f'mail-sender-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _next_batch(self, timeout: float):
+        """Up to MAIL_BATCH_SIZE (attempt, message) pairs: retries that are due, then new mail"""
+        batch = []
+        with self._lock:
+            now = time.monotonic()
+            while self._retries and self._retries[0][0] <= now and len(batch) < MAIL_BATCH_SIZE:
+                _, _, attempt, msg = heapq.heappop(self._retries)
+                batch.append((attempt, msg))
+            if self._retries:
+                timeout = min(timeout, max(self._retries[0][0] - now, 0))
+
+        if not batch:
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                return batch
+        while len(batch) < MAIL_BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        connection = SMTPConnection(self.host, self.port, self.use_ssl, self.username, self.password)
+        while True:
+            batch = self._next_batch(SMTP_IDLE_SECONDS)
+            connection.close_if_idle()
+            for attempt, msg in batch:
+                self._deliver(connection, attempt, msg)
+
+    def _deliver(self, connection: SMTPConnection, attempt: int, msg: EmailMessage):
+        try:
+            connection.send(msg)
+        except Exception as e:
+            if isinstance(e, PERMANENT_ERRORS) or attempt >= MAIL_MAX_ATTEMPTS:
+                logger.error(f"Email to {msg['To']} failed after {attempt} attempts: {type(e).__name__}: {e}")
+                self._finish(failed=True)
+                return
+
+            connection.close()
+            delay = MAIL_RETRY_BACKOFF * 2 ** (attempt - 1)
+            logger.warning(f"Email to {msg['To']} failed ({type(e).__name__}: {e}), retrying in {delay:.0f}s")
+            with self._lock:
+                self.retried += 1
+                heapq.heappush(self._retries, (time.monotonic() + delay, next(self._retry_order), attempt + 1, msg))
+            return
+
+        logger.info(f"Email sent successfully to {msg['To']}")
+        self._finish(failed=False)
+
+    def _finish(self, failed: bool):
+        with self._idle:
+            if failed:
+                self.failed += 1
+            else:
+                self.sent += 1
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+
+mailer = Mailer()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, Float, Boolean, DateTime, Text, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
@@ -27,6 +27,8 @@ class ATM(Base):
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
     geocoding_failed = Column(Boolean, default=False)
+    bank = Column(String(20), nullable=True, index=True)  # Classified once at ingestion (see banks.classify_bank)
+    content_hash = Column(String(40), nullable=True)  # Fingerprint of the feed record (see scheduler.content_fingerprint)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -58,13 +60,56 @@ class GeocodingFailure(Base):
     __tablename__ = "geocoding_failures"
     
     id = Column(Integer, primary_key=True, index=True)
+    atm_id = Column(String(50), nullable=True, index=True)
     location = Column(String(255))
     parish = Column(String(100))
     error_message = Column(Text)
     retry_count = Column(Integer, default=0)
+    last_retry = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
+class GeocodeJob(Base):
+    """
+    Persistent queue of ATMs waiting for coordinates. Ingestion adds jobs in
+    its own transaction; geocode_queue workers claim due jobs, geocode outside
+    any transaction and write the coordinates back
+    """
+    __tablename__ = "geocode_jobs"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    atm_id = Column(String(50), unique=True, nullable=False, index=True)  # atms.atm_id
+    location = Column(String(255))  # Feed location, without the sbj_ prefix
+    parish = Column(String(100))
+    attempts = Column(Integer, nullable=False, default=0)
+    not_before = Column(DateTime, nullable=False, index=True)  # Due time; pushed back while claimed or after a failure
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class DataVersion(Base):
+    """
+    Monotonic version counters for data sets that are cached in memory.
+    Ingestion bumps a counter in the same transaction as its writes so every
+    process can tell when its cached copy is out of date
+    """
+    __tablename__ = "data_versions"
+    
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class ATMChange(Base):
+    """
+    Append-only log of ATM changes written by ingestion.
+    seq is the change sequence clients resume from via /api/atms/changes
+    """
+    __tablename__ = "atm_changes"
+    
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    atm_id = Column(Integer, nullable=False)  # atms.id; kept after the ATM is removed
+    change_type = Column(String(10), nullable=False)  # 'added' or 'updated'; ATMs no longer in the table count as removed
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
 class UserPreferences(Base):
     """
     User preferences for ATM filtering
@@ -114,6 +159,29 @@ class UserPreferences(Base):
 def create_tables():
     """Create all tables"""
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+def add_missing_columns():
+    """
+    Add nullable columns introduced after a table was first created, with their indexes.
+    create_all only creates missing tables and never alters existing ones
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                for index in table.indexes:
+                    if column.name in index.columns:
+                        index.create(bind=conn)
 
 def get_db():
     """Get database session"""
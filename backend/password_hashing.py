@@ -0,0 +1,120 @@
+# password_hashing.py - Password hashing in a bounded process pool, off the request workers
+
+import os
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+# Hashing processes per API worker. Each hash keeps a core busy, so this caps
+# how much CPU login/signup bursts can take from map and recommendation traffic
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+
+# Hashes running or waiting per API worker; beyond this requests get a 503
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', '32'))
+
+# Seconds a request waits for its hash before giving up
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))
+
+
+class HashingBusy(Exception):
+    """The hashing pool is at PASSWORD_HASH_MAX_PENDING; the client should retry later"""
+
+
+class HashingTimeout(HashingBusy):
+    """A hash took longer than PASSWORD_HASH_TIMEOUT; answered like HashingBusy"""
+
+
+class PasswordHasher:
+    """
+    Runs generate_password_hash / check_password_hash in worker processes,
+    with at most max_pending hashes queued or running per API worker
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def hash_password(self, password: str) -> str:
+        return self._run(generate_password_hash, password)
+
+    def verify_password(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def _run(self, fn, *args):
+        pool, future = self._submit(fn, args, admit=True)
+        try:
+            return self._result(future)
+        except BrokenProcessPool:
+            # A hashing process died (e.g. killed for memory); replace the pool and try once more
+            logger.warning("Password hashing pool broke, restarting it")
+            self._discard_pool(pool)
+            _, future = self._submit(fn, args, admit=False)
+            return self._result(future)
+
+    def _result(self, future):
+        try:
+            return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+        except FutureTimeout:
+            logger.warning(f"Password hash took over {PASSWORD_HASH_TIMEOUT:.0f}s, giving up on it")
+            raise HashingTimeout() from None
+
+    def _submit(self, fn, args, admit: bool):
+        with self._lock:
+            if admit and self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HashingBusy()
+            pool = self._get_pool()
+            try:
+                future = pool.submit(fn, *args)
+            except BrokenProcessPool:
+                self._pool = None
+                pool = self._get_pool()
+                future = pool.submit(fn, *args)
+            self.pending += 1
+
+        # Counted until the hash really finishes, even if the request stopped waiting for it
+        future.add_done_callback(self._finished)
+        return pool, future
+
+    def _finished(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def _discard_pool(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # Gunicorn forks workers from a preloaded app; each worker needs its own pool
+        if self._pool is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"Started password hashing pool with {self.workers} processes")
+        return self._pool
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,165 @@
+# preferences.py - Compiled, cached user preferences for ATM scoring and filtering
+
+import os
+import json
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+from models import UserPreferences, SessionLocal
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Bounded per-process cache of compiled preferences, keyed by user_id.
+# Saving preferences invalidates the entry in the worker that handled the save;
+# the TTL bounds how long other workers can keep serving the previous version
+PREFERENCES_CACHE_SIZE = int(os.getenv('PREFERENCES_CACHE_SIZE', '10000'))
+PREFERENCES_CACHE_TTL = float(os.getenv('PREFERENCES_CACHE_TTL', '60'))
+
+
+@dataclass(frozen=True)
+class CompiledPreferences:
+    """
+    Decoded form of a UserPreferences row.
+    valid is False when the stored JSON could not be parsed, in which case the
+    bank and transaction fields hold the 'Any' / 'both' defaults
+    """
+    user_id: int
+    banks: frozenset
+    transaction_types: frozenset
+    max_radius_km: int
+    preferred_currency: str
+    version: str  # Content hash; changes whenever the stored preferences change
+    valid: bool = True
+
+    @property
+    def any_bank(self) -> bool:
+        return 'Any' in self.banks
+
+    @property
+    def wants_deposit(self) -> bool:
+        """Deposits count towards the recommendation score"""
+        return 'deposit' in self.transaction_types or 'both' in self.transaction_types
+
+    @property
+    def deposit_only(self) -> bool:
+        """Only deposit-capable ATMs satisfy the transaction requirement"""
+        return ('deposit' in self.transaction_types and
+                'both' not in self.transaction_types and
+                'withdrawal' not in self.transaction_types)
+
+    def matches_bank(self, bank: str) -> bool:
+        return self.any_bank or bank in self.banks
+
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+def compile_preferences(preferences: UserPreferences) -> CompiledPreferences:
+    """Decode the JSON columns of a UserPreferences row once"""
+    digest = hashlib.sha1(json.dumps([
+        preferences.preferred_banks,
+        preferences.transaction_types,
+        preferences.max_radius_km,
+        preferences.preferred_currency
+    ], default=str).encode()).hexdigest()
+
+    valid = True
+    try:
+        preferred_banks = json.loads(preferences.preferred_banks) if isinstance(preferences.preferred_banks, str) else preferences.preferred_banks
+        transaction_types = json.loads(preferences.transaction_types) if isinstance(preferences.transaction_types, str) else preferences.transaction_types
+        preferred_banks = _as_list(preferred_banks)
+        transaction_types = _as_list(transaction_types)
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        logger.error(f"Error parsing preferences JSON for user {preferences.user_id}")
+        preferred_banks = ['Any']
+        transaction_types = ['both']
+        valid = False
+
+    return CompiledPreferences(
+        user_id=preferences.user_id,
+        banks=frozenset(preferred_banks),
+        transaction_types=frozenset(transaction_types),
+        max_radius_km=preferences.max_radius_km,
+        preferred_currency=preferences.preferred_currency,
+        version=digest,
+        valid=valid
+    )
+
+def default_preferences(user_id: int) -> CompiledPreferences:
+    """Preferences used for recommendations when a user never filled in the questionnaire"""
+    return compile_preferences(UserPreferences(
+        user_id=user_id,
+        preferred_banks='["Any"]',
+        transaction_types='["both"]',
+        max_radius_km=10,
+        preferred_currency='JMD'
+    ))
+
+
+_cache = LRUCache(PREFERENCES_CACHE_SIZE, ttl=PREFERENCES_CACHE_TTL)
+_NOT_FOUND = object()  # Cached marker for users without preferences
+
+def get_compiled_preferences(user_id: int, db=None) -> Optional[CompiledPreferences]:
+    """
+    Compiled preferences for a user, or None if they have not saved any.
+    Served from the LRU cache; db is only used (or opened) on a miss
+    """
+    cached = _cache.get(user_id)
+    if cached is not None:
+        return None if cached is _NOT_FOUND else cached
+
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
+    try:
+        row = db.query(UserPreferences).filter(UserPreferences.user_id == user_id).first()
+        compiled = compile_preferences(row) if row else None
+    finally:
+        if own_session:
+            db.close()
+
+    _cache.set(user_id, _NOT_FOUND if compiled is None else compiled)
+    return compiled
+
+def get_compiled_preferences_bulk(user_ids, db=None) -> Dict[int, Optional[CompiledPreferences]]:
+    """
+    Compiled preferences for many users at once, keyed by user_id (None for
+    users without preferences). Cache misses are loaded with a single query
+    """
+    result = {}
+    missing = []
+    for user_id in set(user_ids):
+        cached = _cache.get(user_id)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            result[user_id] = None if cached is _NOT_FOUND else cached
+
+    if not missing:
+        return result
+
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
+    try:
+        rows = db.query(UserPreferences).filter(UserPreferences.user_id.in_(missing)).all()
+    finally:
+        if own_session:
+            db.close()
+
+    found = {row.user_id: compile_preferences(row) for row in rows}
+    for user_id in missing:
+        compiled = found.get(user_id)
+        _cache.set(user_id, _NOT_FOUND if compiled is None else compiled)
+        result[user_id] = compiled
+
+    return result
+
+def invalidate_preferences(user_id: int):
+    """Drop a user's cached preferences after they change"""
+    _cache.pop(user_id)
+
+def preferences_cache_stats():
+    return _cache.stats()
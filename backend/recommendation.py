@@ -1,15 +1,139 @@
 # recommendation.py - ATM Recommendation System for Neighbourhood App
 
+import os
+import copy
 import json
 import math
-from datetime import datetime, timedelta
+import heapq
+import numpy as np
+from datetime import datetime
 from typing import List, Dict, Any, Optional, Tuple
-from sqlalchemy import and_, or_
-from models import ATM, UserPreferences, SessionLocal
+from models import ATM, UserPreferences
+from atm_snapshot import ATMRecord, ATMSnapshot, get_atm_snapshot
+from preferences import CompiledPreferences, get_compiled_preferences, get_compiled_preferences_bulk, default_preferences
+from spatial_index import GridIndex, haversine_km
+from cache import LRUCache
+from banks import classify_bank
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Recommendation result cache. Requests from the same user inside the same
+# location cell share one ranking until the preferences or ATM data change
+RECOMMENDATION_CACHE_SIZE = int(os.getenv('RECOMMENDATION_CACHE_SIZE', '10000'))
+RECOMMENDATION_CACHE_TTL = float(os.getenv('RECOMMENDATION_CACHE_TTL', '120'))
+RECOMMENDATION_CELL_SIZE_DEG = float(os.getenv('RECOMMENDATION_CELL_SIZE_DEG', '0.001'))  # ~110m
+
+# Batch recommendations: maximum requests per call
+MAX_BATCH_SIZE = int(os.getenv('RECOMMENDATION_MAX_BATCH_SIZE', '1000'))
+
+
+class BatchTooLarge(ValueError):
+    """A batch has more than MAX_BATCH_SIZE requests"""
+
+
+def estimate_wait_times(last_used_seconds: np.ndarray, now: datetime) -> np.ndarray:
+    """
+    Vectorized estimate_wait_time over last-used times given as seconds since
+    midnight (negative when unknown). Returns estimated people in queue
+    """
+    now_seconds = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+    minutes_since_last_use = (now_seconds - last_used_seconds) / 60
+    
+    wait = np.select(
+        [minutes_since_last_use <= 10, minutes_since_last_use <= 30, minutes_since_last_use <= 60],
+        [5, 3, 1],  # High, medium and low traffic
+        0           # No wait expected
+    )
+    wait[last_used_seconds < 0] = 0  # No data, assume no wait
+    return wait
+
+
+class ATMFleet:
+    """
+    Column-oriented view of an ATM snapshot used by the vectorized scoring path.
+    Every array attribute is aligned with self.atms, and self.index is a
+    spatial index over the ATMs that have coordinates
+    """
+    
+    def __init__(self, atms: List[ATMRecord]):
+        self.atms = list(atms)
+        self.bank_names = []  # Bank code vocabulary, indexed by self.bank_index
+        bank_lookup = {}
+        
+        latitudes = []
+        longitudes = []
+        bank_index = []
+        eligible = []
+        working = []
+        deposit = []
+        last_used_seconds = []
+        
+        for atm in self.atms:
+            try:
+                lat = float(atm.latitude)
+                lng = float(atm.longitude)
+            except (ValueError, TypeError):
+                lat = lng = math.nan
+            
+            bank = atm.bank
+            if bank not in bank_lookup:
+                bank_lookup[bank] = len(self.bank_names)
+                self.bank_names.append(bank)
+            
+            latitudes.append(lat)
+            longitudes.append(lng)
+            bank_index.append(bank_lookup[bank])
+            # Recommendations only consider geocoded ATMs that are working (or whose status is unknown)
+            eligible.append(atm.geocoding_failed == False and (atm.status is None or atm.status.upper() == 'WORKING'))
+            working.append(bool(atm.status) and atm.status.upper() == 'WORKING')
+            deposit.append(bool(atm.deposit_available))
+            last_used_seconds.append(-1 if atm.last_used_seconds is None else atm.last_used_seconds)
+        
+        self.lat = np.array(latitudes, dtype=np.float64)
+        self.lng = np.array(longitudes, dtype=np.float64)
+        self.located = np.isfinite(self.lat) & np.isfinite(self.lng)
+        # The scalar path treats a zero coordinate as missing when scoring distance
+        self.has_coordinates = self.located & (self.lat != 0) & (self.lng != 0)
+        self.bank_index = np.array(bank_index, dtype=np.int32)
+        self.eligible = np.array(eligible, dtype=bool) & self.located
+        self.working = np.array(working, dtype=bool)
+        self.deposit = np.array(deposit, dtype=bool)
+        self.last_used_seconds = np.array(last_used_seconds, dtype=np.int32)  # -1 when unknown
+        self._wait = (None, None)  # (minute the estimates were computed for, estimates)
+        
+        self.index = GridIndex(self.lat, self.lng)
+    
+    @property
+    def wait(self) -> np.ndarray:
+        """
+        Estimated queue length per ATM, recomputed at most once per minute.
+        Matches ATMRecommendationEngine.estimate_wait_time at the start of the current minute
+        """
+        minute = datetime.now().replace(second=0, microsecond=0)
+        computed_for, wait = self._wait
+        if computed_for != minute:
+            wait = estimate_wait_times(self.last_used_seconds, minute)
+            self._wait = (minute, wait)
+        return wait
+    
+    def __len__(self) -> int:
+        return len(self.atms)
+    
+    def bank_mask(self, banks, positions: np.ndarray = None) -> np.ndarray:
+        """Boolean mask of ATMs (optionally only those at positions) whose bank is in banks"""
+        codes = [i for i, bank in enumerate(self.bank_names) if bank in banks]
+        bank_index = self.bank_index if positions is None else self.bank_index[positions]
+        return np.isin(bank_index, codes)
+
+
+def get_atm_fleet(snapshot: ATMSnapshot = None) -> ATMFleet:
+    """Return the ATMFleet for an ATM snapshot (the current one by default), building it once per snapshot"""
+    if snapshot is None:
+        snapshot = get_atm_snapshot()
+    return snapshot.derived('fleet', lambda: ATMFleet(snapshot.atms))
+
+
 class ATMRecommendationEngine:
     """
     ATM Recommendation Engine that provides intelligent ATM suggestions
@@ -63,30 +187,13 @@ class ATMRecommendationEngine:
         
         return self.earth_radius_km * c
     
+    def haversine_distances(self, lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Vectorized haversine distance from one point to arrays of points"""
+        return haversine_km(lat, lon, lats, lons)
+    
     def get_bank_from_location(self, location: str) -> str:
         """Extract bank name from ATM location string"""
-        if not location:
-            return 'Unknown'
-        
-        location_upper = location.upper()
-        
-        # Check for bank patterns in the location string
-        bank_patterns = {
-            'NCB': ['NCB', 'NATIONAL COMMERCIAL BANK'],
-            'BNS': ['BNS', 'BANK OF NOVA SCOTIA', 'SCOTIABANK'],
-            'JMMB': ['JMMB', 'JAMAICA MONEY MARKET'],
-            'CIBC': ['CIBC', 'FIRSTCARIBBEAN'],
-            'JN': ['JN BANK', 'JAMAICA NATIONAL'],
-            'FCIB': ['FCIB', 'FIRSTCARIBBEAN'],
-            'Sagicor': ['SAGICOR'],
-            'Scotia': ['SCOTIA', 'SCOTIABANK']
-        }
-        
-        for bank, patterns in bank_patterns.items():
-            if any(pattern in location_upper for pattern in patterns):
-                return bank
-        
-        return 'Unknown'
+        return classify_bank(location)
     
     def estimate_wait_time(self, last_used_str: Optional[str]) -> int:
         """
@@ -131,15 +238,20 @@ class ATMRecommendationEngine:
     def calculate_atm_score(self, atm: ATM, user_lat: float, user_lng: float, 
                            preferences: UserPreferences) -> Dict[str, Any]:
         """
-        Calculate a comprehensive score for an ATM based on multiple factors
+        Calculate a comprehensive score for an ATM based on multiple factors.
+        preferences may be a stored row or its compiled form
         """
-        try:
-            # Parse user preferences
-            preferred_banks = json.loads(preferences.preferred_banks) if isinstance(preferences.preferred_banks, str) else preferences.preferred_banks
-            transaction_types = json.loads(preferences.transaction_types) if isinstance(preferences.transaction_types, str) else preferences.transaction_types
-        except (json.JSONDecodeError, AttributeError):
-            preferred_banks = ['Any']
-            transaction_types = ['both']
+        if isinstance(preferences, CompiledPreferences):
+            preferred_banks = preferences.banks
+            transaction_types = preferences.transaction_types
+        else:
+            try:
+                # Parse user preferences
+                preferred_banks = json.loads(preferences.preferred_banks) if isinstance(preferences.preferred_banks, str) else preferences.preferred_banks
+                transaction_types = json.loads(preferences.transaction_types) if isinstance(preferences.transaction_types, str) else preferences.transaction_types
+            except (json.JSONDecodeError, AttributeError):
+                preferred_banks = ['Any']
+                transaction_types = ['both']
         
         # Initialize score components
         scores = {
@@ -224,105 +336,202 @@ class ATMRecommendationEngine:
         
         return scores
     
-    def get_recommendations(self, user_id: int, user_lat: float, user_lng: float, 
-                          limit: int = 3) -> List[Dict[str, Any]]:
+    def score_fleet(self, fleet: ATMFleet, user_lat: float, user_lng: float,
+                    preferences: CompiledPreferences, max_radius: float) -> Dict[str, np.ndarray]:
+        """
+        Score every eligible ATM within max_radius in one vectorized pass.
+        Candidates come from the fleet's spatial index; every returned array is
+        aligned with scores['positions'], which index into the fleet.
+        Produces the same component and total scores as calculate_atm_score
+        """
+        positions, raw_distance_km = fleet.index.within_radius(user_lat, user_lng, max_radius)
+        eligible = fleet.eligible[positions]
+        positions = positions[eligible]
+        has_coordinates = fleet.has_coordinates[positions]
+        distance_km = np.where(has_coordinates, raw_distance_km[eligible], 0.0)
+        
+        # Distance score: closer is better (max 15km for full score)
+        max_reasonable_distance = 15.0
+        distance_score = np.where(
+            has_coordinates & (distance_km <= max_reasonable_distance),
+            1.0 - (distance_km / max_reasonable_distance),
+            0.0
+        )
+        
+        # Bank preference score
+        if preferences.any_bank:
+            bank_match = np.ones(len(positions), dtype=bool)
+        else:
+            bank_match = fleet.bank_mask(preferences.banks, positions)
+        bank_preference_score = np.where(bank_match, 1.0, 0.3)
+        
+        # Functionality score
+        functionality_score = fleet.working[positions].astype(np.float64)
+        
+        # Deposit availability score
+        needs_deposit = preferences.wants_deposit
+        if needs_deposit:
+            deposit_availability_score = fleet.deposit[positions].astype(np.float64)
+        else:
+            deposit_availability_score = np.ones(len(positions), dtype=np.float64)
+        
+        # Wait time score
+        max_wait = 5
+        wait = fleet.wait[positions]
+        wait_time_score = np.where(wait <= max_wait, 1.0 - (wait / max_wait), 0.0)
+        
+        total_score = (
+            distance_score * self.WEIGHTS['distance'] +
+            bank_preference_score * self.WEIGHTS['bank_preference'] +
+            functionality_score * self.WEIGHTS['functionality'] +
+            deposit_availability_score * self.WEIGHTS['deposit_availability'] +
+            wait_time_score * self.WEIGHTS['wait_time']
+        )
+        
+        return {
+            'positions': positions,
+            'distance_km': distance_km,
+            'bank_match': bank_match,
+            'needs_deposit': needs_deposit,
+            'distance_score': distance_score,
+            'bank_preference_score': bank_preference_score,
+            'functionality_score': functionality_score,
+            'deposit_availability_score': deposit_availability_score,
+            'wait_time_score': wait_time_score,
+            'estimated_wait': wait,
+            'total_score': total_score
+        }
+    
+    def build_reasons(self, bank: str, bank_match: bool, working: bool,
+                      needs_deposit: bool, deposit_available: bool, estimated_wait: int) -> List[str]:
+        """Human readable reasons, in the same order calculate_atm_score produces them"""
+        reasons = []
+        
+        if bank_match:
+            reasons.append(f"Matches preferred bank ({bank})")
+        
+        if working:
+            reasons.append("ATM is functional")
+        else:
+            reasons.append("ATM may not be working")
+        
+        if needs_deposit:
+            if deposit_available:
+                reasons.append("Supports deposits")
+            else:
+                reasons.append("Does not support deposits")
+        
+        if estimated_wait == 0:
+            reasons.append("No expected wait time")
+        elif estimated_wait <= 2:
+            reasons.append(f"Short wait (~{estimated_wait} people)")
+        else:
+            reasons.append(f"Longer wait (~{estimated_wait} people)")
+        
+        return reasons
+    
+    def build_recommendation(self, fleet: ATMFleet, scores: Dict[str, np.ndarray], j: int) -> Dict[str, Any]:
+        """Materialize the response object for the j-th scored ATM"""
+        i = scores['positions'][j]
+        atm = fleet.atms[i]
+        bank = fleet.bank_names[fleet.bank_index[i]]
+        estimated_wait = int(scores['estimated_wait'][j])
+        
+        return {
+            'atm_id': atm.id,
+            'atm_data': {
+                'id': atm.id,
+                'location': atm.location,
+                'parish': atm.parish,
+                'lat': float(fleet.lat[i]),
+                'lng': float(fleet.lng[i]),
+                'bank': bank,
+                'bankName': f"{bank} Bank" if bank != "Unknown" else "Unknown Bank",
+                'functional': atm.status == 'WORKING' if atm.status else True,
+                'deposit_available': bool(atm.deposit_available),
+                'withdrawalFee': self.BANK_FEES.get(bank, 200),
+                'depositFee': 75,  # Standard deposit fee
+                'lastUpdated': atm.updated_at.isoformat() if atm.updated_at else None
+            },
+            'recommendation_score': round(float(scores['total_score'][j]), 3),
+            'distance_km': round(float(scores['distance_km'][j]), 2),
+            'estimated_wait_people': estimated_wait,
+            'reasons': self.build_reasons(
+                bank,
+                bool(scores['bank_match'][j]),
+                bool(fleet.working[i]),
+                scores['needs_deposit'],
+                bool(fleet.deposit[i]),
+                estimated_wait
+            ),
+            'score_breakdown': {
+                'distance': round(float(scores['distance_score'][j]), 2),
+                'bank_preference': round(float(scores['bank_preference_score'][j]), 2),
+                'functionality': round(float(scores['functionality_score'][j]), 2),
+                'deposit_availability': round(float(scores['deposit_availability_score'][j]), 2),
+                'wait_time': round(float(scores['wait_time_score'][j]), 2)
+            }
+        }
+    
+    def select_top(self, scores: Dict[str, np.ndarray], limit: int) -> List[int]:
         """
-        Get top ATM recommendations for a user
+        Indices (into the score arrays) of the best `limit` ATMs, ordered by
+        rounded score (highest first), then rounded distance (closest first),
+        then position in the fleet
         """
-        db = SessionLocal()
+        total_score = scores['total_score']
+        if limit <= 0 or not len(total_score):
+            return []
+        
+        # Anything that can reach the top after rounding scores within 0.001 of the k-th best raw score
+        if len(total_score) > limit:
+            threshold = np.partition(total_score, len(total_score) - limit)[len(total_score) - limit]
+            candidates = np.flatnonzero(total_score >= threshold - 0.001)
+        else:
+            candidates = np.arange(len(total_score))
         
+        distance_km = scores['distance_km']
+        return heapq.nsmallest(limit, candidates.tolist(), key=lambda j: (
+            -round(float(total_score[j]), 3),
+            round(float(distance_km[j]), 2),
+            j
+        ))
+    
+    def get_recommendations(self, user_id: int, user_lat: float, user_lng: float, 
+                          limit: int = 3, preferences: CompiledPreferences = None,
+                          snapshot: ATMSnapshot = None) -> List[Dict[str, Any]]:
+        """
+        Get top ATM recommendations for a user.
+        preferences and snapshot default to the user's cached preferences and
+        the current ATM snapshot
+        """
         try:
-            # Get user preferences
-            preferences = db.query(UserPreferences).filter(
-                UserPreferences.user_id == user_id
-            ).first()
+            # Get user preferences (cached, compiled form)
+            if preferences is None:
+                preferences = get_compiled_preferences(user_id)
             
             if not preferences:
                 logger.warning(f"No preferences found for user {user_id}")
-                # Create default preferences
-                preferences = UserPreferences(
-                    user_id=user_id,
-                    preferred_banks='["Any"]',
-                    transaction_types='["both"]',
-                    max_radius_km=10,
-                    preferred_currency='JMD'
-                )
+                # Use default preferences
+                preferences = default_preferences(user_id)
             
             # Get all working ATMs within a reasonable radius
             max_radius = min(preferences.max_radius_km, 20)  # Cap at 20km for performance
             
-            # Get ATMs with valid coordinates and working status
-            atms = db.query(ATM).filter(
-                and_(
-                    ATM.latitude.isnot(None),
-                    ATM.longitude.isnot(None),
-                    ATM.geocoding_failed == False,
-                    or_(ATM.status == 'WORKING', ATM.status.is_(None))  # Include if status is null (assume working)
-                )
-            ).all()
+            fleet = get_atm_fleet(snapshot)
             
-            if not atms:
+            if not fleet.eligible.any():
                 logger.warning("No ATMs found in database")
                 return []
             
-            # Score each ATM
-            scored_atms = []
-            for atm in atms:
-                try:
-                    # Calculate distance first to apply radius filter
-                    distance_km = self.haversine_distance(
-                        user_lat, user_lng, 
-                        float(atm.latitude), float(atm.longitude)
-                    )
-                    
-                    # Skip ATMs outside the user's preferred radius
-                    if distance_km > max_radius:
-                        continue
-                    
-                    # Calculate comprehensive score
-                    scores = self.calculate_atm_score(atm, user_lat, user_lng, preferences)
-                    
-                    # Create recommendation object
-                    recommendation = {
-                        'atm_id': atm.id,
-                        'atm_data': {
-                            'id': atm.id,
-                            'location': atm.location,
-                            'parish': atm.parish,
-                            'lat': float(atm.latitude),
-                            'lng': float(atm.longitude),
-                            'bank': scores['bank'],
-                            'bankName': f"{scores['bank']} Bank" if scores['bank'] != "Unknown" else "Unknown Bank",
-                            'functional': atm.status == 'WORKING' if atm.status else True,
-                            'deposit_available': bool(atm.deposit_available),
-                            'withdrawalFee': self.BANK_FEES.get(scores['bank'], 200),
-                            'depositFee': 75,  # Standard deposit fee
-                            'lastUpdated': atm.updated_at.isoformat() if atm.updated_at else None
-                        },
-                        'recommendation_score': scores['total_score'],
-                        'distance_km': round(scores['distance_km'], 2),
-                        'estimated_wait_people': scores['estimated_wait_people'],
-                        'reasons': scores['reasons'],
-                        'score_breakdown': {
-                            'distance': round(scores['distance_score'], 2),
-                            'bank_preference': round(scores['bank_preference_score'], 2),
-                            'functionality': round(scores['functionality_score'], 2),
-                            'deposit_availability': round(scores['deposit_availability_score'], 2),
-                            'wait_time': round(scores['wait_time_score'], 2)
-                        }
-                    }
-                    
-                    scored_atms.append(recommendation)
-                    
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Error scoring ATM {atm.id}: {e}")
-                    continue
-            
-            # Sort by recommendation score (highest first) then by distance (closest first)
-            scored_atms.sort(key=lambda x: (-x['recommendation_score'], x['distance_km']))
+            # Score every eligible ATM inside the user's preferred radius in one vectorized pass
+            scores = self.score_fleet(fleet, user_lat, user_lng, preferences, max_radius)
             
-            # Return top recommendations
-            recommendations = scored_atms[:limit]
+            # Only the winners are turned into full response objects
+            recommendations = [
+                self.build_recommendation(fleet, scores, j)
+                for j in self.select_top(scores, limit)
+            ]
             
             logger.info(f"Generated {len(recommendations)} recommendations for user {user_id}")
             
@@ -331,15 +540,87 @@ class ATMRecommendationEngine:
         except Exception as e:
             logger.error(f"Error generating recommendations: {e}")
             return []
+
+
+    def get_batch_recommendations(self, requests: List[Tuple[int, float, float]], limit: int = 3,
+                                  snapshot: ATMSnapshot = None,
+                                  preferences: List[CompiledPreferences] = None) -> List[List[Dict[str, Any]]]:
+        """
+        Recommendations for many (user_id, lat, lng) requests, returned in request order.
+        Preferences for every user are loaded with one query (unless given, one
+        per request) and all requests share one ATM snapshot. Each request is
+        scored like a single one, over the ATMs the spatial index finds inside
+        its radius. Raises BatchTooLarge above MAX_BATCH_SIZE requests
+        """
+        if len(requests) > MAX_BATCH_SIZE:
+            raise BatchTooLarge(f"Batch size {len(requests)} exceeds the maximum of {MAX_BATCH_SIZE}")
+        
+        fleet = get_atm_fleet(snapshot)
+        if not requests or not fleet.eligible.any():
+            return [[] for _ in requests]
+        
+        if preferences is None:
+            preferences_by_user = get_compiled_preferences_bulk(user_id for user_id, _, _ in requests)
+            preferences = [preferences_by_user.get(user_id) or default_preferences(user_id)
+                           for user_id, _, _ in requests]
         
-        finally:
-            db.close()
+        # A requests x fleet score matrix does work for every ATM in the country;
+        # after the radius prefilter each request only has a few candidates left
+        results = []
+        for (_, user_lat, user_lng), prefs in zip(requests, preferences):
+            scores = self.score_fleet(fleet, user_lat, user_lng, prefs, min(prefs.max_radius_km, 20))
+            results.append([
+                self.build_recommendation(fleet, scores, j)
+                for j in self.select_top(scores, limit)
+            ])
+        
+        logger.info(f"Generated batch recommendations for {len(requests)} requests")
+        
+        return results
+
+
+_recommendation_cache = LRUCache(RECOMMENDATION_CACHE_SIZE, ttl=RECOMMENDATION_CACHE_TTL)
+
+def recommendation_cache_key(user_id: int, preferences: Optional[CompiledPreferences],
+                             snapshot: ATMSnapshot, user_lat: float, user_lng: float) -> Tuple:
+    """
+    Cache key for a recommendation request: user, preference version, location
+    quantized to RECOMMENDATION_CELL_SIZE_DEG and ATM data version
+    """
+    return (
+        user_id,
+        preferences.version if preferences else None,
+        math.floor(user_lat / RECOMMENDATION_CELL_SIZE_DEG),
+        math.floor(user_lng / RECOMMENDATION_CELL_SIZE_DEG),
+        snapshot.version
+    )
+
+def recommendation_cache_stats() -> Dict[str, Any]:
+    return _recommendation_cache.stats()
 
 
 # Flask route integration function
 def get_atm_recommendations_for_user(user_id: int, user_lat: float, user_lng: float) -> List[Dict[str, Any]]:
     """
-    Convenience function to get ATM recommendations for Flask routes
+    Convenience function to get ATM recommendations for Flask routes.
+    Results are cached per user, location cell and data version; a hit returns
+    the ranking computed for the first request made from that cell. Callers get
+    their own copy, so changing a result never changes the cached ranking
     """
+    preferences = get_compiled_preferences(user_id)
+    snapshot = get_atm_snapshot()
+    key = recommendation_cache_key(user_id, preferences, snapshot, user_lat, user_lng)
+    
+    recommendations = _recommendation_cache.get(key)
+    if recommendations is not None:
+        return copy.deepcopy(recommendations)
+    
     engine = ATMRecommendationEngine()
-    return engine.get_recommendations(user_id, user_lat, user_lng, limit=3)
\ No newline at end of file
+    recommendations = engine.get_recommendations(user_id, user_lat, user_lng, limit=3,
+                                                 preferences=preferences, snapshot=snapshot)
+    
+    # Empty results may come from a transient error, so only rankings are cached
+    if recommendations:
+        _recommendation_cache.set(key, copy.deepcopy(recommendations))
+    
+    return recommendations
@@ -1,10 +1,20 @@
 import requests
 import logging
 import os
-from datetime import datetime
+import json
+import hashlib
 from apscheduler.schedulers.background import BackgroundScheduler
 from models import ATM, SessionLocal
-from geocoding import geocode_location, retry_failed_geocoding
+from geocode_queue import (GEOCODE_DRAIN_SECONDS, drain_geocode_queue, enqueue_geocode_jobs,
+                          pending_geocode_atm_ids)
+from banks import classify_bank
+from atm_snapshot import ATM_DATA_VERSION, bump_data_version, invalidate_atm_snapshot, lock_data_version
+from atm_changes import (CHANGE_ADDED, CHANGE_UPDATED, TRACKED_FIELDS, record_atm_changes,
+                         prune_atm_changes, tracked_state)
+from sqlalchemy import func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from requests.auth import HTTPBasicAuth
 
 # Set up logging
@@ -16,6 +26,18 @@ API_URL = "https://sbj-atmp-dev.pre-prod.ch.sagicor.com/api/v1/status"
 API_USERNAME = os.getenv('API_USERNAME')
 API_PASSWORD = os.getenv('API_PASSWORD')
 
+# Feed records written per upsert statement (and looked up per IN query)
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', '500'))
+
+# Columns taken from the feed when an ATM already exists. Coordinates are only
+# written on insert; after that they belong to the geocode queue, and a run that
+# read them before a drain committed must not put the old values back
+UPSERT_COLUMNS = ('location', 'bank', 'parish', 'deposit_available', 'status', 'last_used',
+                  'content_hash')
+
+# Feed-derived columns covered by ATM.content_hash
+FINGERPRINT_COLUMNS = ('location', 'bank', 'parish', 'deposit_available', 'status', 'last_used')
+
 def fetch_atm_data():
     """Fetch ATM data from external API"""
     try:
@@ -47,103 +69,196 @@ def fetch_atm_data():
         logger.error(f"Error fetching ATM data: {e}")
         return None
 
+def parse_atm_record(atm_record):
+    """Feed record as ATM column values, plus the unprefixed location used for geocoding"""
+    atm_id = atm_record.get('ATM_Id')
+    if not atm_id:
+        raise ValueError("record has no ATM_Id")
+    
+    original_location = atm_record.get('Location')
+    
+    # Add "sbj_" prefix to location before storing
+    location = f"sbj_{original_location}"
+    
+    values = {
+        'atm_id': atm_id,
+        'location': location,
+        'bank': classify_bank(location),
+        'parish': atm_record.get('Parish'),
+        'deposit_available': atm_record.get('Deposit', 'N') == 'Y',
+        'status': atm_record.get('Status', 'UNKNOWN'),
+        'last_used': atm_record.get('Last_Used')
+    }
+    return values, original_location
+
+def content_fingerprint(values):
+    """Hash of an ATM's feed-derived columns, stored to spot unchanged records cheaply"""
+    content = json.dumps([values[column] for column in FINGERPRINT_COLUMNS], separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def load_existing_atms(db, atm_ids):
+    """Stored fingerprint, id and tracked fields of the given feed ids, keyed by atm_id, in a few IN queries"""
+    columns = [ATM.id, ATM.atm_id, ATM.content_hash] + [getattr(ATM, field) for field in TRACKED_FIELDS]
+    atm_ids = list(atm_ids)
+    existing = {}
+    for start in range(0, len(atm_ids), INGEST_CHUNK_SIZE):
+        chunk = atm_ids[start:start + INGEST_CHUNK_SIZE]
+        for atm in db.query(*columns).filter(ATM.atm_id.in_(chunk)):
+            existing[atm.atm_id] = atm
+    return existing
+
+def upsert_atms_statement(dialect_name, rows):
+    """Multi-row INSERT that updates the feed columns of ATMs that already exist"""
+    if dialect_name == 'mysql':
+        stmt = mysql_insert(ATM).values(rows)
+        updates = {column: stmt.inserted[column] for column in UPSERT_COLUMNS}
+        updates['updated_at'] = func.now()
+        return stmt.on_duplicate_key_update(updates)
+    
+    # SQLite and PostgreSQL (benchmarks, local development)
+    insert = postgresql_insert if dialect_name == 'postgresql' else sqlite_insert
+    stmt = insert(ATM).values(rows)
+    updates = {column: stmt.excluded[column] for column in UPSERT_COLUMNS}
+    updates['updated_at'] = func.now()
+    return stmt.on_conflict_do_update(index_elements=['atm_id'], set_=updates)
+
+def write_atm_chunk(db, rows, changes):
+    """
+    Upsert rows and record their changes inside a savepoint, so a failure
+    only undoes this chunk. changes maps atm_id to (change_type, ATM.id or None for new ATMs)
+    """
+    with db.begin_nested():
+        db.execute(upsert_atms_statement(db.get_bind().dialect.name, rows))
+        
+        chunk_changes = [changes[row['atm_id']] for row in rows if row['atm_id'] in changes]
+        new_atm_ids = [row['atm_id'] for row in rows
+                       if row['atm_id'] in changes and changes[row['atm_id']][1] is None]
+        if new_atm_ids:
+            added = [atm_id for atm_id, in db.query(ATM.id).filter(ATM.atm_id.in_(new_atm_ids))]
+            record_atm_changes(db, added, CHANGE_ADDED)
+        record_atm_changes(db, [atm_id for change_type, atm_id in chunk_changes
+                                if change_type == CHANGE_UPDATED], CHANGE_UPDATED)
+
 def process_atm_data(api_data):
-    """Process API data and update database"""
+    """
+    Process API data and update database. Only ATMs whose content changed are
+    written. Returns the run's diff summary (added / changed / unchanged /
+    removed from the feed / failed, and written rows), or None if nothing ran
+    """
     if not api_data:
         logger.warning("No API data to process")
-        return
+        return None
+    
+    summary = {'added': 0, 'changed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0, 'written': 0}
+    
+    # Parse the whole feed first; a later record for the same ATM wins
+    records = {}
+    for atm_record in api_data:
+        try:
+            values, original_location = parse_atm_record(atm_record)
+            records[values['atm_id']] = (values, original_location)
+        except Exception as e:
+            logger.error(f"Error processing ATM record {atm_record}: {e}")
+            summary['failed'] += 1
     
     db = SessionLocal()
     try:
-        processed_count = 0
-        geocoded_count = 0
+        existing_atms = load_existing_atms(db, records)
+        
+        # Stored ATMs the feed no longer lists (they are kept, only counted)
+        summary['removed'] = db.query(func.count(ATM.id)).scalar() - len(existing_atms)
         
-        for atm_record in api_data:
+        # Coordinates are looked up by the geocode queue workers after this commits,
+        # so a slow geocoder never holds up status updates
+        queued_geocodes = pending_geocode_atm_ids(db)
+        geocode_jobs = []
+        
+        # Work out the rows that changed in memory, then write them in chunks
+        rows = []
+        changes = {}  # atm_id -> (change_type, ATM.id or None for new ATMs)
+        for atm_id, (values, original_location) in records.items():
+            existing_atm = existing_atms.get(atm_id)
+            values['content_hash'] = content_fingerprint(values)
+            
+            if existing_atm:
+                # Queue for geocoding if coordinates are missing or geocoding previously failed
+                # Jobs carry the original location (without prefix)
+                needs_geocoding = (existing_atm.latitude is None or existing_atm.longitude is None or
+                                   existing_atm.geocoding_failed)
+                # Only compared below; the upsert leaves stored coordinates alone
+                values['latitude'] = existing_atm.latitude
+                values['longitude'] = existing_atm.longitude
+                values['geocoding_failed'] = existing_atm.geocoding_failed
+            else:
+                # Shown on the map once the geocode queue has placed it
+                needs_geocoding = True
+                values['latitude'] = None
+                values['longitude'] = None
+                values['geocoding_failed'] = False
+            
+            if needs_geocoding and atm_id not in queued_geocodes:
+                geocode_jobs.append((atm_id, original_location, values['parish']))
+            
+            if existing_atm and values['content_hash'] == existing_atm.content_hash:
+                summary['unchanged'] += 1
+                continue
+            
+            # Only real field changes go into the change feed
+            if existing_atm is None:
+                changes[atm_id] = (CHANGE_ADDED, None)
+            elif tuple(values[field] for field in TRACKED_FIELDS) != tracked_state(existing_atm):
+                changes[atm_id] = (CHANGE_UPDATED, existing_atm.id)
+            else:
+                summary['unchanged'] += 1  # Same content, fingerprint not stored yet
+            
+            rows.append(values)
+        
+        def written(chunk):
+            summary['written'] += len(chunk)
+            for row in chunk:
+                change = changes.get(row['atm_id'])
+                if change is not None:
+                    summary['added' if change[0] == CHANGE_ADDED else 'changed'] += 1
+        
+        if rows:
+            # Geocode queue drains wait until this run commits its changes
+            lock_data_version(db, ATM_DATA_VERSION)
+        
+        for start in range(0, len(rows), INGEST_CHUNK_SIZE):
+            chunk = rows[start:start + INGEST_CHUNK_SIZE]
             try:
-                atm_id = atm_record.get('ATM_Id')
-                original_location = atm_record.get('Location')
-                parish = atm_record.get('Parish')
-                
-                # Add "sbj_" prefix to location before storing
-                location = f"sbj_{original_location}"
-                
-                deposit = atm_record.get('Deposit', 'N') == 'Y'
-                status = atm_record.get('Status', 'UNKNOWN')
-                last_used = atm_record.get('Last_Used')
-                timestamp_str = atm_record.get('TimeStamp')
-                
-                # Parse timestamp
-                try:
-                    timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                except:
-                    timestamp = datetime.utcnow()
-                
-                # Check if ATM already exists
-                existing_atm = db.query(ATM).filter(ATM.atm_id == atm_id).first()
-                
-                if existing_atm:
-                    # Update existing ATM
-                    existing_atm.location = location  # Now with sbj_ prefix
-                    existing_atm.parish = parish
-                    existing_atm.deposit_available = deposit
-                    existing_atm.status = status
-                    existing_atm.last_used = last_used
-                    existing_atm.timestamp = timestamp
-                    existing_atm.updated_at = datetime.utcnow()
-                    
-                    # Geocode if coordinates are missing or geocoding previously failed
-                    # Use original location (without prefix) for geocoding
-                    if (existing_atm.latitude is None or existing_atm.longitude is None or 
-                        existing_atm.geocoding_failed):
-                        
-                        lat, lng, failed = geocode_location(original_location, parish, atm_id)
-                        existing_atm.latitude = lat
-                        existing_atm.longitude = lng
-                        existing_atm.geocoding_failed = failed
-                        
-                        if not failed:
-                            geocoded_count += 1
-                    
-                    logger.debug(f"Updated ATM {atm_id} with location: {location}")
-                    
-                else:
-                    # Geocode new ATM location using original location (without prefix)
-                    lat, lng, geocoding_failed = geocode_location(original_location, parish, atm_id)
-                    
-                    # Create new ATM record with prefixed location
-                    new_atm = ATM(
-                        atm_id=atm_id,
-                        location=location,  # Stored with sbj_ prefix
-                        parish=parish,
-                        latitude=lat,
-                        longitude=lng,
-                        deposit_available=deposit,
-                        status=status,
-                        last_used=last_used,
-                        timestamp=timestamp,
-                        geocoding_failed=geocoding_failed
-                    )
-                    
-                    db.add(new_atm)
-                    
-                    if not geocoding_failed:
-                        geocoded_count += 1
-                    
-                    logger.debug(f"Created new ATM {atm_id} with location: {location}")
-                
-                processed_count += 1
-                
+                write_atm_chunk(db, chunk, changes)
+                written(chunk)
             except Exception as e:
-                logger.error(f"Error processing ATM record {atm_record}: {e}")
-                continue
+                # Find the bad record(s) instead of losing the whole chunk
+                logger.error(f"Error writing {len(chunk)} ATM records, retrying one at a time: {e}")
+                for row in chunk:
+                    try:
+                        write_atm_chunk(db, [row], changes)
+                        written([row])
+                    except Exception as e:
+                        logger.error(f"Error writing ATM record {row}: {e}")
+                        summary['failed'] += 1
         
+        geocodes_queued = enqueue_geocode_jobs(db, geocode_jobs)
+        
+        if summary['written']:
+            prune_atm_changes(db)
+            
+            # Tell every process that its ATM snapshot is out of date
+            bump_data_version(db, ATM_DATA_VERSION)
         db.commit()
-        logger.info(f"Successfully processed {processed_count} ATM records. "
-                   f"Geocoded {geocoded_count} locations.")
+        
+        logger.info(f"Processed {len(records)} ATM records: {summary['added']} added, "
+                    f"{summary['changed']} changed, {summary['unchanged']} unchanged, "
+                    f"{summary['removed']} missing from feed, {summary['failed']} failed. "
+                    f"Queued {geocodes_queued} ATMs for geocoding.")
+        return summary
         
     except Exception as e:
         logger.error(f"Error processing ATM data: {e}")
         db.rollback()
+        return None
     finally:
         db.close()
 
@@ -155,10 +270,11 @@ def scheduled_data_update():
     api_data = fetch_atm_data()
     
     # Process and store data
-    process_atm_data(api_data)
+    summary = process_atm_data(api_data)
     
-    # Retry failed geocoding
-    retry_failed_geocoding()
+    # Pick up the new data version in this process without waiting for the next check
+    if summary and summary['written']:
+        invalidate_atm_snapshot()
     
     logger.info("Scheduled ATM data update completed")
 
@@ -176,6 +292,17 @@ def start_scheduler():
         replace_existing=True
     )
     
+    # Look up coordinates for queued ATMs (new, or whose geocoding failed)
+    scheduler.add_job(
+        func=drain_geocode_queue,
+        trigger="interval",
+        seconds=GEOCODE_DRAIN_SECONDS,
+        id='geocode_queue_drain',
+        name='Geocode queued ATMs',
+        max_instances=1,
+        replace_existing=True
+    )
+    
     scheduler.start()
     logger.info("Scheduler started - will update ATM data every 10 minutes")
     
@@ -0,0 +1,156 @@
+# spatial_index.py - In-memory spatial index for ATM radius and nearest-ATM queries
+
+import math
+import numpy as np
+from typing import Tuple
+
+EARTH_RADIUS_KM = 6371
+
+# Roughly 5.5km of latitude per cell, a few city blocks' worth of ATMs in Kingston
+DEFAULT_CELL_SIZE_DEG = 0.05
+
+
+def haversine_km(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """
+    Great circle distance in kilometers from one point to arrays of points
+    using the haversine formula
+    """
+    lat1_rad = math.radians(lat)
+    lng1_rad = math.radians(lng)
+    lat2_rad = np.radians(lats)
+    lng2_rad = np.radians(lngs)
+
+    dlat = lat2_rad - lat1_rad
+    dlng = lng2_rad - lng1_rad
+
+    a = (np.sin(dlat/2)**2 +
+         math.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlng/2)**2)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+    return EARTH_RADIUS_KM * c
+
+
+class GridIndex:
+    """
+    Uniform latitude/longitude bucket index over a set of points.
+
+    Queries return positions into the arrays the index was built from, sorted
+    ascending, so callers can use them directly against their own columns.
+    Points with missing (NaN) coordinates are never returned.
+    """
+
+    def __init__(self, lats: np.ndarray, lngs: np.ndarray, cell_size_deg: float = DEFAULT_CELL_SIZE_DEG):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.cell_size_deg = cell_size_deg
+
+        located = np.flatnonzero(np.isfinite(self.lats) & np.isfinite(self.lngs))
+        rows = np.floor(self.lats[located] / cell_size_deg).astype(np.int64)
+        cols = np.floor(self.lngs[located] / cell_size_deg).astype(np.int64)
+
+        # Group positions by cell; a stable sort keeps positions ascending inside each bucket
+        order = np.lexsort((cols, rows))
+        rows, cols, located = rows[order], cols[order], located[order]
+        boundaries = np.flatnonzero((np.diff(rows) != 0) | (np.diff(cols) != 0)) + 1
+        starts = np.concatenate(([0], boundaries)) if len(located) else np.array([], dtype=np.int64)
+        ends = np.concatenate((boundaries, [len(located)])) if len(located) else np.array([], dtype=np.int64)
+
+        self.buckets = {
+            (int(rows[start]), int(cols[start])): located[start:end]
+            for start, end in zip(starts, ends)
+        }
+        self.size = len(located)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _cell_range(self, min_lat: float, max_lat: float, min_lng: float, max_lng: float) -> np.ndarray:
+        """Positions of every point in the cells overlapping a lat/lng rectangle"""
+        min_row = math.floor(min_lat / self.cell_size_deg)
+        max_row = math.floor(max_lat / self.cell_size_deg)
+        min_col = math.floor(min_lng / self.cell_size_deg)
+        max_col = math.floor(max_lng / self.cell_size_deg)
+
+        cell_count = (max_row - min_row + 1) * (max_col - min_col + 1)
+        if cell_count <= len(self.buckets):
+            keys = ((row, col) for row in range(min_row, max_row + 1)
+                    for col in range(min_col, max_col + 1))
+            parts = [self.buckets[key] for key in keys if key in self.buckets]
+        else:
+            # Huge rectangles are cheaper to answer by walking the occupied cells
+            parts = [positions for (row, col), positions in self.buckets.items()
+                     if min_row <= row <= max_row and min_col <= col <= max_col]
+
+        if not parts:
+            return np.array([], dtype=np.int64)
+        return np.sort(np.concatenate(parts))
+
+    def within_radius(self, lat: float, lng: float, radius_km: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Points within radius_km of (lat, lng).
+        Returns (positions, distances_km), positions sorted ascending
+        """
+        if radius_km < 0 or not self.size:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        angular_radius = radius_km / EARTH_RADIUS_KM
+        lat_span = math.degrees(angular_radius)
+        min_lat = lat - lat_span
+        max_lat = lat + lat_span
+
+        # Widest longitude offset of a spherical cap; covers everything near the poles
+        cos_lat = math.cos(math.radians(lat))
+        if max_lat >= 90 or min_lat <= -90 or math.sin(angular_radius) >= cos_lat:
+            min_lng, max_lng = -180.0, 180.0
+        else:
+            lng_span = math.degrees(math.asin(math.sin(angular_radius) / cos_lat))
+            min_lng, max_lng = lng - lng_span, lng + lng_span
+
+        # A small margin keeps floating point error on the box edges from dropping points
+        margin = 1e-6
+        candidates = self._cell_range(min_lat - margin, max_lat + margin, min_lng - margin, max_lng + margin)
+        distances = haversine_km(lat, lng, self.lats[candidates], self.lngs[candidates])
+        keep = distances <= radius_km
+
+        return candidates[keep], distances[keep]
+
+    def within_bbox(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> np.ndarray:
+        """Points inside a lat/lng bounding box, positions sorted ascending"""
+        candidates = self._cell_range(min_lat, max_lat, min_lng, max_lng)
+        lats = self.lats[candidates]
+        lngs = self.lngs[candidates]
+        keep = (lats >= min_lat) & (lats <= max_lat) & (lngs >= min_lng) & (lngs <= max_lng)
+        return candidates[keep]
+
+    def nearest(self, lat: float, lng: float, k: int, max_radius_km: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The k points closest to (lat, lng), optionally bounded by max_radius_km.
+        Returns (positions, distances_km) ordered by distance, closest first
+        """
+        if k <= 0 or not self.size:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+        # Widen a square of cells until it holds k points; the k-th of those bounds the answer
+        row = math.floor(lat / self.cell_size_deg)
+        col = math.floor(lng / self.cell_size_deg)
+        ring = 0
+        while True:
+            candidates = self._cell_range(
+                (row - ring) * self.cell_size_deg, (row + ring + 1) * self.cell_size_deg,
+                (col - ring) * self.cell_size_deg, (col + ring + 1) * self.cell_size_deg
+            )
+            if len(candidates) >= k or ring * self.cell_size_deg > 360:
+                break
+            ring = ring * 2 + 1
+
+        distances = haversine_km(lat, lng, self.lats[candidates], self.lngs[candidates])
+        if len(candidates) >= k:
+            bound = np.partition(distances, k - 1)[k - 1]
+        else:
+            bound = float(distances.max()) if len(distances) else 0.0
+        if max_radius_km is not None:
+            bound = min(bound, max_radius_km)
+
+        positions, distances = self.within_radius(lat, lng, bound)
+        order = np.argsort(distances, kind='stable')[:k]
+        return positions[order], distances[order]
@@ -0,0 +1,40 @@
+# conftest.py - Shared test setup: backend modules on the path and an in-memory database
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read at import time by geocoding.py and auth.py; the tests never call out with them
+os.environ.setdefault('GOOGLE_MAPS_API_KEY', 'AIza-test-key-not-used-by-the-tests')
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+import models
+import atm_snapshot
+import preferences
+
+
+@pytest.fixture
+def db_engine(monkeypatch):
+    """
+    Point SessionLocal at a fresh in-memory SQLite database for one test,
+    with no ATM snapshot or preferences cached from an earlier database
+    """
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    models.Base.metadata.create_all(engine)
+    monkeypatch.setattr(atm_snapshot, '_snapshot', None)
+    preferences._cache.clear()
+    previous = models.SessionLocal.kw['bind']
+    models.SessionLocal.configure(bind=engine)
+    yield engine
+    models.SessionLocal.configure(bind=previous)
+    engine.dispose()
+
+@pytest.fixture
+def db(db_engine):
+    session = models.SessionLocal()
+    yield session
+    session.close()
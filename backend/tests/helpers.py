@@ -0,0 +1,15 @@
+# helpers.py - Builders shared by the tests
+
+from banks import classify_bank
+from atm_snapshot import ATMRecord, parse_time_of_day
+
+
+def make_record(id, location, latitude, longitude, status='WORKING', deposit_available=True,
+                last_used=None, geocoding_failed=False):
+    return ATMRecord(
+        id=id, atm_id=f'A{id}', location=location, parish='Kingston',
+        deposit_available=deposit_available, status=status, last_used=last_used,
+        latitude=latitude, longitude=longitude, geocoding_failed=geocoding_failed,
+        bank=classify_bank(location), created_at=None, updated_at=None,
+        last_used_seconds=parse_time_of_day(last_used)
+    )
@@ -0,0 +1,67 @@
+import atm_changes
+from atm_changes import CHANGE_ADDED, CHANGE_UPDATED, changes_since, prune_atm_changes, record_atm_changes
+from atm_snapshot import load_atm_snapshot
+from models import ATM
+
+
+def add_atms(db, *atm_ids):
+    atms = [ATM(atm_id=atm_id, location=f'sbj_{atm_id}', status='WORKING') for atm_id in atm_ids]
+    db.add_all(atms)
+    db.flush()
+    record_atm_changes(db, [atm.id for atm in atms], CHANGE_ADDED)
+    db.commit()
+    return atms
+
+def set_status(db, atm, status):
+    atm.status = status
+    record_atm_changes(db, [atm.id], CHANGE_UPDATED)
+    db.commit()
+
+
+def test_changes_within_the_stored_range(db):
+    a1, a2, a3 = add_atms(db, 'A1', 'A2', 'A3')
+    since = load_atm_snapshot(db).change_seq
+    set_status(db, a1, 'DOWN')
+    a4, = add_atms(db, 'A4')
+    set_status(db, a4, 'DOWN')  # Added and updated within the range: still added
+    db.delete(a3)
+    db.commit()
+    snapshot = load_atm_snapshot(db)
+
+    delta = changes_since(db, snapshot, since)
+
+    assert delta['seq'] == snapshot.change_seq == since + 3
+    assert not delta['resync']
+    assert [atm.id for atm in delta['added']] == [a4.id]
+    assert [atm.id for atm in delta['updated']] == [a1.id]
+    assert [atm.status for atm in delta['updated']] == ['DOWN']
+    assert delta['removed'] == []
+
+    # Removed ATMs are the ones changed in the range that the snapshot no longer has
+    delta = changes_since(db, snapshot, 0)
+    assert [atm.id for atm in delta['added']] == [a1.id, a2.id, a4.id]
+    assert delta['removed'] == [a3.id]
+
+def test_client_at_the_latest_seq_gets_an_empty_delta(db):
+    add_atms(db, 'A1')
+    snapshot = load_atm_snapshot(db)
+
+    assert changes_since(db, snapshot, snapshot.change_seq) == {
+        'seq': snapshot.change_seq, 'resync': False, 'added': [], 'updated': [], 'removed': []}
+
+def test_cursor_older_than_retention_resyncs(db, monkeypatch):
+    monkeypatch.setattr(atm_changes, 'ATM_CHANGES_RETENTION', 2)
+    a1, a2 = add_atms(db, 'A1', 'A2')
+    set_status(db, a1, 'DOWN')
+    set_status(db, a2, 'DOWN')
+    prune_atm_changes(db)
+    db.commit()
+    snapshot = load_atm_snapshot(db)
+
+    assert snapshot.change_floor == snapshot.change_seq - 2
+    assert changes_since(db, snapshot, snapshot.change_floor - 1) == {'seq': snapshot.change_seq, 'resync': True}
+    assert changes_since(db, snapshot, snapshot.change_seq + 1) == {'seq': snapshot.change_seq, 'resync': True}
+
+    delta = changes_since(db, snapshot, snapshot.change_floor)
+    assert not delta['resync']
+    assert [atm.id for atm in delta['updated']] == [a1.id, a2.id]
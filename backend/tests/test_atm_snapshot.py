@@ -0,0 +1,26 @@
+from models import DataVersion, SessionLocal
+from atm_snapshot import bump_data_version, lock_data_version, read_data_version
+
+
+def test_lock_creates_a_missing_version_row(db):
+    lock_data_version(db, 'atms')
+    db.commit()
+
+    assert read_data_version(db, 'atms') == 0
+    assert db.query(DataVersion).count() == 1
+
+def test_lock_keeps_an_existing_version(db):
+    for _ in range(2):
+        bump_data_version(db, 'atms')
+        db.commit()
+
+    other = SessionLocal()
+    try:
+        lock_data_version(other, 'atms')
+        bump_data_version(other, 'atms')
+        other.commit()
+    finally:
+        other.close()
+
+    assert read_data_version(db, 'atms') == 3
+    assert db.query(DataVersion).count() == 1
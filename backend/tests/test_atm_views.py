@@ -0,0 +1,86 @@
+import random
+import pytest
+from models import UserPreferences
+from atm_snapshot import ATMSnapshot
+from preferences import compile_preferences
+from recommendation import get_atm_fleet
+from atm_views import MATCH_TIERS, match_preferences
+from helpers import make_record
+
+USER_LAT, USER_LNG = 18.0, -76.8
+
+
+def multi_pass_match(fleet, preferences, user_lat, user_lng):
+    """
+    The filtering match_preferences replaced: one pass per tier, first
+    non-empty tier wins. Returns (tier name, ATM ids)
+    """
+    atms = fleet.atms
+    has_location = bool(user_lat and user_lng)
+    nearby = set()
+    if has_location:
+        positions, _ = fleet.index.within_radius(user_lat, user_lng, preferences.max_radius_km)
+        nearby = set(positions.tolist()) | {i for i, located in enumerate(fleet.has_coordinates) if not located}
+
+    def transaction_match(atm):
+        return bool(atm.deposit_available) if preferences.deposit_only else True
+
+    currency_match = preferences.preferred_currency == 'JMD'
+    passes = [
+        lambda i, atm: has_location and preferences.matches_bank(atm.bank) and transaction_match(atm)
+                       and i in nearby and currency_match,
+        lambda i, atm: has_location and preferences.matches_bank(atm.bank) and i in nearby,
+        lambda i, atm: preferences.matches_bank(atm.bank) and transaction_match(atm),
+        lambda i, atm: preferences.matches_bank(atm.bank),
+        lambda i, atm: has_location and i in nearby,
+    ]
+    for tier, matches in zip(MATCH_TIERS, passes):
+        ids = [atm.id for i, atm in enumerate(atms) if matches(i, atm)]
+        if ids:
+            return tier, ids
+    return 'all', [atm.id for atm in atms]
+
+def fleet_of(locations, deposit_rate=0.4, seed=3):
+    rng = random.Random(seed)
+    records = [
+        make_record(id, location, USER_LAT + rng.uniform(-0.3, 0.3), USER_LNG + rng.uniform(-0.3, 0.3),
+                    deposit_available=rng.random() < deposit_rate)
+        for id, location in enumerate(locations, start=1)
+    ]
+    records.append(make_record(len(records) + 1, locations[0], None, None, deposit_available=False))
+    return get_atm_fleet(ATMSnapshot(1, records))
+
+MIXED = ['NCB Half Way Tree', 'Scotiabank Papine', 'JMMB Branch', 'Sagicor Mall', 'Corner shop'] * 40
+
+
+@pytest.mark.parametrize('banks, transaction_types, radius, location, locations, deposit_rate, tier', [
+    ('["Any"]', '["both"]', 10, True, MIXED, 0.4, 'exact match'),
+    ('["NCB"]', '["deposit"]', 10, True, MIXED, 0.4, 'exact match'),
+    ('["NCB", "JMMB"]', '["withdrawal"]', 5, True, MIXED, 0.4, 'exact match'),
+    ('["NCB"]', '["deposit"]', 10, True, MIXED, 0.0, 'bank + radius match'),
+    ('["NCB", "Sagicor"]', '["deposit"]', 10, False, MIXED, 0.4, 'bank + transaction match'),
+    ('["Sagicor"]', '["deposit"]', 10, False, MIXED, 0.0, 'bank match only'),
+    ('["FCIB"]', '["both"]', 10, True, MIXED, 0.4, 'radius only'),
+    ('["FCIB"]', '["both"]', 10, False, MIXED, 0.4, 'all'),
+])
+def test_single_pass_matches_multi_pass(banks, transaction_types, radius, location, locations, deposit_rate, tier):
+    preferences = compile_preferences(UserPreferences(
+        user_id=1, preferred_banks=banks, transaction_types=transaction_types,
+        max_radius_km=radius, preferred_currency='JMD'))
+    fleet = fleet_of(locations, deposit_rate)
+    user_lat, user_lng = (USER_LAT, USER_LNG) if location else (None, None)
+
+    expected_tier, expected_ids = multi_pass_match(fleet, preferences, user_lat, user_lng)
+    actual_ids = [fleet.atms[i].id for i in match_preferences(fleet, preferences, user_lat, user_lng)]
+
+    assert expected_tier == tier
+    assert actual_ids == expected_ids
+
+def test_unknown_banks_only_match_any():
+    preferences = compile_preferences(UserPreferences(
+        user_id=1, preferred_banks='["NCB"]', transaction_types='["both"]',
+        max_radius_km=50, preferred_currency='JMD'))
+    fleet = fleet_of(['Corner shop', 'Gas station', 'NCB Half Way Tree'])
+
+    assert [fleet.atms[i].location for i in match_preferences(fleet, preferences, USER_LAT, USER_LNG)] == \
+        ['NCB Half Way Tree']
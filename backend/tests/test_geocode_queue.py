@@ -0,0 +1,23 @@
+from datetime import datetime
+import geocoding
+import geocode_queue
+from models import ATM, GeocodeJob
+
+
+def add_queued_atms(db, count):
+    for i in range(count):
+        db.add(ATM(atm_id=f'Q{i}', location=f'Street {i}', parish='Kingston', geocoding_failed=False))
+        db.add(GeocodeJob(atm_id=f'Q{i}', location=f'Street {i}', parish='Kingston',
+                          attempts=0, not_before=datetime.utcnow()))
+    db.commit()
+
+def test_drain_warms_cache_once_per_run(db, monkeypatch):
+    add_queued_atms(db, 120)
+    warms = []
+    monkeypatch.setattr(geocoding.coordinates_cache, 'warm', lambda: warms.append(1))
+    monkeypatch.setattr(geocoding.geocode_executor, 'geocoder', lambda location, parish, atm_id: (18.0, -76.8, False))
+
+    assert geocode_queue.drain_geocode_queue(limit=50) == 120
+    assert len(warms) == 1
+    assert db.query(GeocodeJob).count() == 0
+    assert {atm.latitude for atm in db.query(ATM)} == {18.0}
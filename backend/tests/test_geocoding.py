@@ -0,0 +1,72 @@
+import threading
+from models import GeocodingCache
+from geocoding import PARISH_DEFAULTS, CoordinatesCache, GeocodingExecutor, get_parish_default_coordinates
+
+
+def test_missing_parish_uses_st_andrew():
+    assert get_parish_default_coordinates(None) == PARISH_DEFAULTS['St Andrew']
+    assert get_parish_default_coordinates('  ') == PARISH_DEFAULTS['St Andrew']
+
+def test_known_parish():
+    assert get_parish_default_coordinates(' kingston ') == PARISH_DEFAULTS['Kingston']
+
+def test_failed_lookup_with_no_parish_gets_default():
+    def geocoder(location, parish, atm_id):
+        if atm_id == 'BAD':
+            raise RuntimeError("geocoder down")
+        return 18.0, -76.8, False
+
+    executor = GeocodingExecutor(geocoder=geocoder, workers=2)
+    results = executor.geocode_all([
+        ('Half Way Tree', 'St Andrew', 'A1'),
+        ('Nowhere', None, 'BAD'),
+        ('Liguanea', 'St Andrew', 'A2'),
+    ])
+
+    lat, lng = PARISH_DEFAULTS['St Andrew']
+    assert results == [(18.0, -76.8, False), (lat, lng, True), (18.0, -76.8, False)]
+
+
+def test_warmed_cache_answers_misses_without_queries(db):
+    db.add(GeocodingCache(location='Half Way Tree', parish='St Andrew', latitude=18.01, longitude=-76.79))
+    db.commit()
+
+    cache = CoordinatesCache(maxsize=10)
+    cache.warm()
+    assert cache.get('Half Way Tree', 'St Andrew') == (18.01, -76.79)
+    assert cache.get('Liguanea', 'St Andrew') is None
+    assert cache.stats()['db_lookups'] == 0
+
+def test_entry_evicted_after_warm_is_found_in_table(db):
+    db.add_all([
+        GeocodingCache(location='Half Way Tree', parish='St Andrew', latitude=18.01, longitude=-76.79),
+        GeocodingCache(location='Liguanea', parish='St Andrew', latitude=18.02, longitude=-76.77),
+    ])
+    db.commit()
+
+    cache = CoordinatesCache(maxsize=3)
+    cache.warm()
+    cache.add('Papine', 'St Andrew', 18.03, -76.74)
+    cache.add('Constant Spring', 'St Andrew', 18.05, -76.79)  # Evicts Half Way Tree
+
+    assert cache.get('Half Way Tree', 'St Andrew') == (18.01, -76.79)
+    assert cache.stats()['db_lookups'] == 1
+
+def test_failed_submits_release_their_slots():
+    executor = GeocodingExecutor(geocoder=lambda location, parish, atm_id: (18.0, -76.8, False),
+                                 workers=1, max_pending=2)
+    executor._get_pool().shutdown()
+
+    # More failures than max_pending; a leaked slot would block geocode_all forever
+    lookups = [(f'Street {i}', None, f'A{i}') for i in range(5)]
+    results = []
+    worker = threading.Thread(target=lambda: results.extend(executor.geocode_all(lookups)), daemon=True)
+    worker.start()
+    worker.join(timeout=5)
+
+    lat, lng = PARISH_DEFAULTS['St Andrew']
+    assert not worker.is_alive()
+    assert results == [(lat, lng, True)] * 5
+
+    executor._pool = None
+    assert executor.geocode_all([('Street 9', 'Kingston', 'A9')]) == [(18.0, -76.8, False)]
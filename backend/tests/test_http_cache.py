@@ -0,0 +1,72 @@
+import gzip
+import json
+import brotli
+import pytest
+from flask import Flask
+from http_cache import PreparedJSON, prepared_json_response
+
+DOCUMENT = [{'id': i, 'location': f'sbj_Street {i}', 'status': 'WORKING'} for i in range(200)]
+
+
+@pytest.fixture
+def prepared():
+    return PreparedJSON(DOCUMENT)
+
+@pytest.fixture
+def client(prepared):
+    app = Flask(__name__)
+
+    @app.route('/atms')
+    def atms():
+        return prepared_json_response(prepared, 'public, max-age=60')
+
+    return app.test_client()
+
+
+def test_matching_etag_gets_304_with_empty_body(client, prepared):
+    response = client.get('/atms', headers={'If-None-Match': f'"{prepared.etag}"'})
+
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == f'"{prepared.etag}"'
+
+@pytest.mark.parametrize('if_none_match', [
+    'W/"{etag}"',
+    '"stale", "{etag}-gzip"',
+    '"stale", W/"{etag}-br"',
+    '*',
+])
+def test_weak_and_listed_etags_match(client, prepared, if_none_match):
+    response = client.get('/atms', headers={'If-None-Match': if_none_match.format(etag=prepared.etag),
+                                            'Accept-Encoding': 'gzip'})
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_other_etag_gets_the_document(client):
+    response = client.get('/atms', headers={'If-None-Match': '"stale"'})
+
+    assert response.status_code == 200
+    assert response.get_json() == DOCUMENT
+
+def test_each_encoding_has_its_own_etag(client, prepared):
+    plain = client.get('/atms', headers={'Accept-Encoding': 'identity'})
+    gzipped = client.get('/atms', headers={'Accept-Encoding': 'gzip'})
+    brotlied = client.get('/atms', headers={'Accept-Encoding': 'gzip, br'})
+
+    assert gzipped.headers['Content-Encoding'] == 'gzip'
+    assert brotlied.headers['Content-Encoding'] == 'br'
+    assert json.loads(gzip.decompress(gzipped.data)) == DOCUMENT
+    assert json.loads(brotli.decompress(brotlied.data)) == DOCUMENT
+    assert len({plain.headers['ETag'], gzipped.headers['ETag'], brotlied.headers['ETag']}) == 3
+    for response in (plain, gzipped, brotlied):
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert response.headers['Cache-Control'] == 'public, max-age=60'
+
+def test_no_accept_encoding_is_not_compressed(client, prepared):
+    response = client.get('/atms')
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == prepared.body
+    assert response.headers['ETag'] == f'"{prepared.etag}"'
+    assert 'Accept-Encoding' in response.headers['Vary']
@@ -0,0 +1,116 @@
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+import pytest
+import mailer
+from mailer import Mailer
+
+
+class StubSMTP:
+    """Stands in for smtplib.SMTP; send_message raises whatever `failures` holds for that address, in turn"""
+
+    instances = []
+    failures = {}
+    gate = None
+
+    def __init__(self, host, port, timeout=None):
+        self.sent = []
+        self.attempts = []
+        self.closed = False
+        StubSMTP.instances.append(self)
+
+    def login(self, username, password):
+        pass
+
+    def send_message(self, msg):
+        if StubSMTP.gate is not None:
+            StubSMTP.gate.wait()
+        self.attempts.append((msg['To'], time.monotonic()))
+        pending = StubSMTP.failures.get(msg['To'])
+        if pending:
+            raise pending.pop(0)
+        self.sent.append(msg['To'])
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def smtp(monkeypatch):
+    monkeypatch.setattr(StubSMTP, 'instances', [])
+    monkeypatch.setattr(StubSMTP, 'failures', {})
+    monkeypatch.setattr(StubSMTP, 'gate', None)
+    monkeypatch.setattr(mailer.smtplib, 'SMTP', StubSMTP)
+    monkeypatch.setattr(mailer, 'MAIL_RETRY_BACKOFF', 0.1)
+    return StubSMTP
+
+def make_mailer():
+    return Mailer(host='localhost', port=1025, use_ssl=False, username=None, password=None, senders=1)
+
+def message(to):
+    msg = EmailMessage()
+    msg['Subject'] = 'Your OTP'
+    msg['From'] = 'app@example.com'
+    msg['To'] = to
+    msg.set_content('123456')
+    return msg
+
+
+def test_one_connection_carries_many_messages(smtp):
+    outbox = make_mailer()
+    for i in range(5):
+        assert outbox.enqueue(message(f'user{i}@example.com'))
+
+    assert outbox.wait_idle(timeout=5)
+    assert len(smtp.instances) == 1
+    assert smtp.instances[0].sent == [f'user{i}@example.com' for i in range(5)]
+    assert outbox.stats()['sent'] == 5
+
+def test_transient_failures_retry_with_backoff(smtp):
+    smtp.failures['flaky@example.com'] = [
+        smtplib.SMTPDataError(451, b'Try again later'),
+        smtplib.SMTPDataError(421, b'Service not available'),
+    ]
+    outbox = make_mailer()
+    outbox.enqueue(message('flaky@example.com'))
+
+    assert outbox.wait_idle(timeout=5)
+    attempts = [at for instance in smtp.instances for _, at in instance.attempts]
+    assert len(attempts) == 3
+    # Backoff doubles: 0.1s before the second attempt, 0.2s before the third
+    assert attempts[1] - attempts[0] >= 0.1
+    assert attempts[2] - attempts[1] >= 0.2
+    # Each failure drops the connection; the retry opens a new one
+    assert len(smtp.instances) == 3
+    assert smtp.instances[-1].sent == ['flaky@example.com']
+    stats = outbox.stats()
+    assert (stats['sent'], stats['retried'], stats['failed']) == (1, 2, 0)
+
+def test_permanent_errors_are_not_retried(smtp):
+    smtp.failures['gone@example.com'] = [
+        smtplib.SMTPRecipientsRefused({'gone@example.com': (550, b'No such user')}),
+    ]
+    outbox = make_mailer()
+    outbox.enqueue(message('gone@example.com'))
+    outbox.enqueue(message('here@example.com'))
+
+    assert outbox.wait_idle(timeout=5)
+    attempts = [to for instance in smtp.instances for to, _ in instance.attempts]
+    assert attempts == ['gone@example.com', 'here@example.com']
+    stats = outbox.stats()
+    assert (stats['sent'], stats['retried'], stats['failed']) == (1, 0, 1)
+
+def test_wait_idle_returns_once_the_queue_drains(smtp):
+    smtp.gate = threading.Event()
+    outbox = make_mailer()
+    for i in range(3):
+        outbox.enqueue(message(f'user{i}@example.com'))
+
+    assert not outbox.wait_idle(timeout=0.1)
+    smtp.gate.set()
+    assert outbox.wait_idle(timeout=5)
+    assert outbox.stats()['queued'] == 0
+    assert outbox.stats()['sent'] == 3
@@ -0,0 +1,61 @@
+import os
+import time
+import pytest
+import password_hashing
+from password_hashing import HashingBusy, HashingTimeout, PasswordHasher
+
+
+def die_once(marker, result):
+    """Kills the hashing process the first time it runs, then returns result"""
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os._exit(1)
+    return result
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    yield hasher
+    if hasher._pool is not None:
+        hasher._pool.shutdown(wait=True)
+
+def wait_for_pending(hasher, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while hasher.stats()['pending'] != count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return hasher.stats()['pending']
+
+
+def test_hash_and_verify(hasher):
+    password_hash = hasher.hash_password('correct horse')
+
+    assert hasher.verify_password(password_hash, 'correct horse')
+    assert not hasher.verify_password(password_hash, 'battery staple')
+    assert wait_for_pending(hasher, 0) == 0
+    assert hasher.stats()['completed'] == 3
+
+def test_broken_pool_is_replaced_and_the_hash_retried(hasher, tmp_path):
+    hasher.hash_password('warm up the pool')
+    broken_pool = hasher._pool
+
+    assert hasher._run(die_once, str(tmp_path / 'died'), 'hashed') == 'hashed'
+    assert hasher._pool is not broken_pool
+    # The broken future and the retry both released their slot
+    assert wait_for_pending(hasher, 0) == 0
+    assert hasher.stats()['completed'] == 3
+
+def test_timed_out_hash_counts_as_pending_until_it_finishes(hasher, monkeypatch):
+    monkeypatch.setattr(password_hashing, 'PASSWORD_HASH_TIMEOUT', 0.05)
+
+    with pytest.raises(HashingTimeout):
+        hasher._run(time.sleep, 0.5)
+    assert isinstance(HashingTimeout(), HashingBusy)  # Handlers answer both with 503 + Retry-After
+
+    # Still running in the pool, so it holds the only slot
+    assert hasher.stats()['pending'] == 1
+    with pytest.raises(HashingBusy):
+        hasher.hash_password('another password')
+    assert hasher.stats()['rejected'] == 1
+
+    assert wait_for_pending(hasher, 0) == 0
+    assert hasher.stats()['completed'] == 1
@@ -0,0 +1,148 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from models import UserPreferences
+from atm_snapshot import ATMSnapshot
+from preferences import compile_preferences
+import recommendation
+from recommendation import ATMRecommendationEngine, BatchTooLarge, get_atm_fleet
+from helpers import make_record
+
+USER_LAT, USER_LNG = 18.0, -76.8
+
+LOCATIONS = ['NCB Half Way Tree', 'sbj_Liguanea', 'Scotiabank Papine', 'JMMB Branch',
+             'CIBC Main', 'JN BANK Constant Spring', 'Sagicor Mall', 'Corner shop']
+
+
+def synthetic_snapshot(count=400, seed=7):
+    rng = random.Random(seed)
+    now = datetime.now()
+    records = []
+    for id in range(1, count + 1):
+        # Minutes since last use stay clear of the 10/30/60 minute wait thresholds
+        minutes_ago = rng.choice([None, 5, 20, 45, 90])
+        last_used = None if minutes_ago is None else (now - timedelta(minutes=minutes_ago)).strftime('%H:%M:%S')
+        records.append(make_record(
+            id, rng.choice(LOCATIONS),
+            USER_LAT + rng.uniform(-0.25, 0.25), USER_LNG + rng.uniform(-0.25, 0.25),
+            status=rng.choice(['WORKING', 'WORKING', 'DOWN', None]),
+            deposit_available=rng.random() < 0.5,
+            last_used=last_used,
+            geocoding_failed=rng.random() < 0.1
+        ))
+
+    # Zero or missing coordinates never get recommended
+    records.append(make_record(count + 1, 'NCB Zero', 0.0, 0.0))
+    records.append(make_record(count + 2, 'NCB Half Zero', USER_LAT, 0.0))
+    records.append(make_record(count + 3, 'NCB Missing', None, None))
+    return ATMSnapshot(1, records)
+
+def scalar_recommendations(engine, snapshot, preferences, limit):
+    """The per-ATM path that score_fleet replaced: calculate_atm_score for every eligible ATM in radius"""
+    max_radius = min(preferences.max_radius_km, 20)
+    scored = []
+    for atm in snapshot.atms:
+        if atm.latitude is None or atm.longitude is None or atm.geocoding_failed:
+            continue
+        if atm.status not in ('WORKING', None):
+            continue
+        if engine.haversine_distance(USER_LAT, USER_LNG, atm.latitude, atm.longitude) > max_radius:
+            continue
+
+        scores = engine.calculate_atm_score(atm, USER_LAT, USER_LNG, preferences)
+        scored.append({
+            'atm_id': atm.id,
+            'recommendation_score': scores['total_score'],
+            'distance_km': round(scores['distance_km'], 2),
+            'estimated_wait_people': scores['estimated_wait_people'],
+            'reasons': scores['reasons'],
+            'score_breakdown': {
+                'distance': round(scores['distance_score'], 2),
+                'bank_preference': round(scores['bank_preference_score'], 2),
+                'functionality': round(scores['functionality_score'], 2),
+                'deposit_availability': round(scores['deposit_availability_score'], 2),
+                'wait_time': round(scores['wait_time_score'], 2)
+            }
+        })
+    scored.sort(key=lambda r: (-r['recommendation_score'], r['distance_km']))
+    return scored[:limit]
+
+
+@pytest.mark.parametrize('banks, transaction_types, radius', [
+    ('["Any"]', '["both"]', 10),
+    ('["NCB", "Sagicor"]', '["withdrawal"]', 15),
+    ('["JMMB"]', '["deposit"]', 25),
+    ('["CIBC", "Unknown"]', '["deposit", "withdrawal"]', 5),
+])
+def test_vectorized_scores_match_scalar_path(banks, transaction_types, radius):
+    stored = UserPreferences(user_id=1, preferred_banks=banks, transaction_types=transaction_types,
+                             max_radius_km=radius, preferred_currency='JMD')
+    snapshot = synthetic_snapshot()
+    engine = ATMRecommendationEngine()
+
+    expected = scalar_recommendations(engine, snapshot, stored, limit=len(snapshot))
+    actual = engine.get_recommendations(1, USER_LAT, USER_LNG, limit=len(snapshot),
+                                        preferences=compile_preferences(stored), snapshot=snapshot)
+
+    assert expected
+    assert [{key: rec[key] for key in expected[0]} for rec in actual] == expected
+
+def test_scalar_score_takes_compiled_preferences():
+    stored = UserPreferences(user_id=1, preferred_banks='["NCB", "JMMB"]', transaction_types='["deposit"]',
+                             max_radius_km=10, preferred_currency='JMD')
+    engine = ATMRecommendationEngine()
+
+    for atm in synthetic_snapshot(count=50).atms[:50]:
+        assert engine.calculate_atm_score(atm, USER_LAT, USER_LNG, compile_preferences(stored)) == \
+            engine.calculate_atm_score(atm, USER_LAT, USER_LNG, stored)
+
+def test_top_n_order_matches_scalar_path():
+    stored = UserPreferences(user_id=1, preferred_banks='["NCB"]', transaction_types='["deposit"]',
+                             max_radius_km=10, preferred_currency='JMD')
+    snapshot = synthetic_snapshot(seed=11)
+    engine = ATMRecommendationEngine()
+
+    expected = [rec['atm_id'] for rec in scalar_recommendations(engine, snapshot, stored, limit=3)]
+    actual = [rec['atm_id'] for rec in engine.get_recommendations(
+        1, USER_LAT, USER_LNG, limit=3, preferences=compile_preferences(stored), snapshot=snapshot)]
+    assert actual == expected
+
+def test_atms_without_usable_coordinates_are_not_scored():
+    snapshot = synthetic_snapshot()
+    fleet = get_atm_fleet(snapshot)
+    stored = UserPreferences(user_id=1, preferred_banks='["Any"]', transaction_types='["both"]',
+                             max_radius_km=20, preferred_currency='JMD')
+    scores = ATMRecommendationEngine().score_fleet(fleet, USER_LAT, USER_LNG, compile_preferences(stored), 20)
+
+    scored_ids = {fleet.atms[i].id for i in scores['positions']}
+    assert not scored_ids & {len(snapshot) - 2, len(snapshot) - 1, len(snapshot)}
+
+def test_batch_matches_single_requests(db):
+    db.add_all([
+        UserPreferences(user_id=1, preferred_banks='["NCB"]', transaction_types='["deposit"]',
+                        max_radius_km=10, preferred_currency='JMD'),
+        UserPreferences(user_id=2, preferred_banks='["Any"]', transaction_types='["both"]',
+                        max_radius_km=25, preferred_currency='JMD'),
+        UserPreferences(user_id=3, preferred_banks='["JMMB", "CIBC"]', transaction_types='["withdrawal"]',
+                        max_radius_km=3, preferred_currency='JMD'),
+    ])
+    db.commit()
+    snapshot = synthetic_snapshot()
+    engine = ATMRecommendationEngine()
+    # User 4 has no stored preferences; user 1 asks from two places
+    requests = [(1, USER_LAT, USER_LNG), (2, USER_LAT + 0.1, USER_LNG - 0.05), (3, USER_LAT, USER_LNG),
+                (4, USER_LAT - 0.1, USER_LNG + 0.1), (1, USER_LAT + 0.2, USER_LNG + 0.2)]
+
+    batch = engine.get_batch_recommendations(requests, limit=5, snapshot=snapshot)
+    single = [engine.get_recommendations(user_id, lat, lng, limit=5, snapshot=snapshot)
+              for user_id, lat, lng in requests]
+
+    assert batch == single
+    assert all(batch)
+
+def test_oversized_batch_is_rejected(monkeypatch):
+    monkeypatch.setattr(recommendation, 'MAX_BATCH_SIZE', 2)
+
+    with pytest.raises(BatchTooLarge):
+        ATMRecommendationEngine().get_batch_recommendations([(1, USER_LAT, USER_LNG)] * 3,
+                                                            snapshot=synthetic_snapshot())
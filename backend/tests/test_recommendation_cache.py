@@ -0,0 +1,33 @@
+from models import ATM, UserPreferences
+import recommendation
+from recommendation import get_atm_recommendations_for_user
+
+
+def test_cache_hit_is_not_changed_by_callers(db):
+    db.add_all([
+        ATM(atm_id='A1', location='NCB Half Way Tree', parish='St Andrew', status='WORKING',
+            deposit_available=True, latitude=18.01, longitude=-76.79, geocoding_failed=False),
+        ATM(atm_id='A2', location='Scotiabank Liguanea', parish='St Andrew', status='WORKING',
+            deposit_available=False, latitude=18.02, longitude=-76.77, geocoding_failed=False),
+        UserPreferences(user_id=1, preferred_banks='["NCB"]', transaction_types='["both"]',
+                        max_radius_km=10, preferred_currency='JMD'),
+    ])
+    db.commit()
+    recommendation._recommendation_cache.clear()
+
+    first = get_atm_recommendations_for_user(1, 18.0, -76.8)
+    expected = [rec['atm_id'] for rec in first], first[0]['atm_data']['location'], list(first[0]['reasons'])
+
+    # What a route might do to the list it got back
+    first[0]['distance'] = f"{first[0].pop('distance_km')} km"
+    first[0]['atm_data']['location'] = 'changed'
+    first[0]['reasons'].clear()
+    first.reverse()
+
+    hit = get_atm_recommendations_for_user(1, 18.0, -76.8)
+    assert recommendation._recommendation_cache.stats()['hits'] == 1
+    assert ([rec['atm_id'] for rec in hit], hit[0]['atm_data']['location'], hit[0]['reasons']) == expected
+    assert 'distance_km' in hit[0]
+
+    hit[0]['atm_data']['location'] = 'changed again'
+    assert get_atm_recommendations_for_user(1, 18.0, -76.8)[0]['atm_data']['location'] == expected[1]
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+import scheduler
+from models import ATM, ATMChange
+from atm_snapshot import ATM_DATA_VERSION, read_data_version
+
+
+def feed_record(atm_id, location, status='WORKING', deposit='Y', parish='St Andrew', last_used='10:15:00'):
+    return {'ATM_Id': atm_id, 'Location': location, 'Parish': parish,
+            'Deposit': deposit, 'Status': status, 'Last_Used': last_used}
+
+def stored_atms(db):
+    db.expire_all()
+    return {atm.atm_id: atm for atm in db.query(ATM)}
+
+def count_writes(monkeypatch):
+    writes = []
+    write_atm_chunk = scheduler.write_atm_chunk
+    def counting_write(db, rows, changes):
+        writes.extend(row['atm_id'] for row in rows)
+        write_atm_chunk(db, rows, changes)
+    monkeypatch.setattr(scheduler, 'write_atm_chunk', counting_write)
+    return writes
+
+
+def test_summary_counts_inserts_updates_and_unchanged(db):
+    scheduler.process_atm_data([
+        feed_record('A1', 'Half Way Tree'),
+        feed_record('A2', 'Liguanea'),
+        feed_record('A3', 'Papine'),
+        feed_record('A4', 'Cross Roads'),
+    ])
+
+    summary = scheduler.process_atm_data([
+        feed_record('A1', 'Half Way Tree'),
+        feed_record('A2', 'Liguanea', status='DOWN'),
+        feed_record('A3', 'Papine', deposit='N'),
+        feed_record('A5', 'Constant Spring'),
+        {'Location': 'No id'},
+    ])
+
+    assert summary == {'added': 1, 'changed': 2, 'unchanged': 1, 'removed': 1, 'failed': 1, 'written': 3}
+    atms = stored_atms(db)
+    assert atms['A2'].status == 'DOWN'
+    assert atms['A3'].deposit_available is False
+    assert atms['A5'].location == 'sbj_Constant Spring'
+
+def test_bad_row_is_retried_alone_without_losing_other_chunks(db, db_engine, monkeypatch):
+    monkeypatch.setattr(scheduler, 'INGEST_CHUNK_SIZE', 2)
+    with db_engine.begin() as conn:
+        # Fails after the chunk's upsert has run, so only a savepoint can undo it
+        conn.exec_driver_sql(
+            "CREATE TRIGGER reject_bad_change BEFORE INSERT ON atm_changes "
+            "WHEN (SELECT atm_id FROM atms WHERE id = NEW.atm_id) = 'BAD' "
+            "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+
+    summary = scheduler.process_atm_data([
+        feed_record('A1', 'Half Way Tree'),
+        feed_record('A2', 'Liguanea'),
+        feed_record('A3', 'Papine'),
+        feed_record('BAD', 'Nowhere'),
+        feed_record('A5', 'Cross Roads'),
+        feed_record('A6', 'Constant Spring'),
+    ])
+
+    assert summary['added'] == 5
+    assert summary['failed'] == 1
+    assert set(stored_atms(db)) == {'A1', 'A2', 'A3', 'A5', 'A6'}
+    assert sorted(change_type for change_type, in db.query(ATMChange.change_type)) == ['added'] * 5
+
+def test_upsert_keeps_stored_coordinates(db, monkeypatch):
+    scheduler.process_atm_data([feed_record('A1', 'Half Way Tree')])
+    atm = db.query(ATM).filter(ATM.atm_id == 'A1').one()
+    atm.latitude, atm.longitude = 18.01, -76.79
+    db.commit()
+
+    # A run that read the ATM before a geocode drain committed its coordinates
+    load_existing_atms = scheduler.load_existing_atms
+    def stale_existing_atms(db, atm_ids):
+        return {atm_id: SimpleNamespace(**{**row._mapping, 'latitude': None, 'longitude': None})
+                for atm_id, row in load_existing_atms(db, atm_ids).items()}
+    monkeypatch.setattr(scheduler, 'load_existing_atms', stale_existing_atms)
+
+    summary = scheduler.process_atm_data([feed_record('A1', 'Half Way Tree', status='DOWN')])
+
+    assert summary['changed'] == 1
+    atm = stored_atms(db)['A1']
+    assert atm.status == 'DOWN'
+    assert (atm.latitude, atm.longitude) == (18.01, -76.79)
+
+def test_unchanged_record_is_not_written(db, monkeypatch):
+    feed = [feed_record('A1', 'Half Way Tree'), feed_record('A2', 'Liguanea')]
+    scheduler.process_atm_data(feed)
+    version = read_data_version(db, ATM_DATA_VERSION)
+    changes = db.query(ATMChange).count()
+    writes = count_writes(monkeypatch)
+
+    summary = scheduler.process_atm_data(feed)
+
+    assert summary['unchanged'] == 2
+    assert writes == []
+    assert db.query(ATMChange).count() == changes
+    assert read_data_version(db, ATM_DATA_VERSION) == version
+
+def test_changed_tracked_field_is_written(db, monkeypatch):
+    scheduler.process_atm_data([feed_record('A1', 'Half Way Tree'), feed_record('A2', 'Liguanea')])
+    version = read_data_version(db, ATM_DATA_VERSION)
+    last_seq = max(seq for seq, in db.query(ATMChange.seq))
+    writes = count_writes(monkeypatch)
+
+    summary = scheduler.process_atm_data([feed_record('A1', 'Half Way Tree', last_used='10:45:00'),
+                                          feed_record('A2', 'Liguanea')])
+
+    assert (summary['changed'], summary['unchanged']) == (1, 1)
+    assert writes == ['A1']
+    new_changes = db.query(ATMChange).filter(ATMChange.seq > last_seq).all()
+    assert [(change.atm_id, change.change_type) for change in new_changes] == [(stored_atms(db)['A1'].id, 'updated')]
+    assert read_data_version(db, ATM_DATA_VERSION) == version + 1
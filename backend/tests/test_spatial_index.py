@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from spatial_index import DEFAULT_CELL_SIZE_DEG, GridIndex, haversine_km
+
+CELL = DEFAULT_CELL_SIZE_DEG
+
+
+def kingston_points(count=2000, seed=5):
+    """Random points around Kingston, a lattice of points exactly on cell edges, and a few unlocated ones"""
+    rng = np.random.default_rng(seed)
+    lats = list(18.0 + rng.uniform(-0.4, 0.4, count))
+    lngs = list(-76.8 + rng.uniform(-0.4, 0.4, count))
+    for row in range(-4, 5):
+        for col in range(-4, 5):
+            lats.append(18.0 + row * CELL)
+            lngs.append(-76.8 + col * CELL)
+    lats += [np.nan, 18.0, np.nan]
+    lngs += [-76.8, np.nan, np.nan]
+    return np.array(lats), np.array(lngs)
+
+def brute_within_radius(lats, lngs, lat, lng, radius_km):
+    distances = haversine_km(lat, lng, lats, lngs)
+    positions = np.flatnonzero(distances <= radius_km)
+    return positions, distances[positions]
+
+QUERIES = [
+    (18.0123, -76.7891),
+    (18.0, -76.8),    # On a cell corner
+    (18.05, -76.77),  # On a cell edge
+    (17.99, -76.85),
+]
+
+
+@pytest.mark.parametrize('lat, lng', QUERIES)
+@pytest.mark.parametrize('radius_km', [0.0, 0.4, 2.5, 12.0, 60.0])
+def test_within_radius_matches_brute_force(lat, lng, radius_km):
+    lats, lngs = kingston_points()
+    index = GridIndex(lats, lngs)
+
+    positions, distances = index.within_radius(lat, lng, radius_km)
+    expected_positions, expected_distances = brute_within_radius(lats, lngs, lat, lng, radius_km)
+
+    assert positions.tolist() == expected_positions.tolist()
+    assert np.allclose(distances, expected_distances)
+
+def test_radius_reaching_exactly_to_a_cell_edge_point():
+    lats, lngs = kingston_points()
+    index = GridIndex(lats, lngs)
+    # The lattice point four cells north of the query
+    edge = int(np.flatnonzero((lats == 18.0 + 4 * CELL) & (lngs == -76.8))[0])
+
+    radius_km = float(haversine_km(18.0, -76.8, lats[edge:edge + 1], lngs[edge:edge + 1])[0])
+    positions, _ = index.within_radius(18.0, -76.8, radius_km)
+
+    assert edge in positions.tolist()
+    assert positions.tolist() == brute_within_radius(lats, lngs, 18.0, -76.8, radius_km)[0].tolist()
+
+@pytest.mark.parametrize('lat, lng', QUERIES + [(18.6, -77.4)])  # Last one is outside the points
+@pytest.mark.parametrize('k, max_radius_km', [(1, None), (7, None), (50, None), (50, 1.5), (5000, None)])
+def test_nearest_matches_brute_force(lat, lng, k, max_radius_km):
+    lats, lngs = kingston_points()
+    index = GridIndex(lats, lngs)
+
+    positions, distances = index.nearest(lat, lng, k, max_radius_km)
+
+    all_distances = haversine_km(lat, lng, lats, lngs)
+    located = np.flatnonzero(np.isfinite(all_distances))
+    expected = np.sort(all_distances[located])[:k]
+    if max_radius_km is not None:
+        expected = expected[expected <= max_radius_km]
+    assert np.allclose(distances, expected)
+    assert np.allclose(all_distances[positions], distances)
+    assert len(set(positions.tolist())) == len(positions)
+
+@pytest.mark.parametrize('min_lat, min_lng, max_lat, max_lng', [
+    (17.9, -76.9, 18.1, -76.7),            # Edges on cell boundaries and lattice points
+    (18.0, -76.8, 18.0, -76.8),            # A single lattice point
+    (17.95, -76.85, 18.0731, -76.6012),
+    (17.9101, -76.7999, 17.9102, -76.7998),  # Smaller than a cell
+    (-90.0, -180.0, 90.0, 180.0),
+])
+def test_within_bbox_matches_brute_force(min_lat, min_lng, max_lat, max_lng):
+    lats, lngs = kingston_points()
+    index = GridIndex(lats, lngs)
+
+    with np.errstate(invalid='ignore'):
+        expected = np.flatnonzero((lats >= min_lat) & (lats <= max_lat) & (lngs >= min_lng) & (lngs <= max_lng))
+    assert index.within_bbox(min_lat, min_lng, max_lat, max_lng).tolist() == expected.tolist()
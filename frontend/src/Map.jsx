@@ -2,6 +2,7 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { MapPin, Filter, X, DollarSign, Clock, Wifi, WifiOff, AlertTriangle, CheckCircle, RefreshCw, LogOut, User, Navigation, Settings, Target, Star, Info } from 'lucide-react';
 import { useAuth } from './AuthContext';
+import { applyAtmChanges } from './atmChanges';
 
 // RecommendationButton component embedded within the Map component
 const RecommendationButton = ({ 
@@ -344,6 +345,7 @@ const Map = ({ userEmail }) => {
   const leafletRef = useRef(null);
   const locationWatchRef = useRef(null);
   const accuracyCircleRef = useRef(null);
+  const changeSeqRef = useRef(null); // ATM change sequence the list is current to; streams resume from here
 
   // Static bank configurations
   const BANKS = {
@@ -581,6 +583,12 @@ const Map = ({ userEmail }) => {
       
       const data = await response.json();
       setAtms(data || []);
+      
+      // Where the change stream continues from (only the unfiltered list reports it)
+      const changeSeq = response.headers.get('X-ATM-Change-Seq');
+      if (changeSeq !== null) {
+        changeSeqRef.current = Number(changeSeq);
+      }
       setError(null);
       
       const now = new Date();
@@ -807,13 +815,82 @@ const Map = ({ userEmail }) => {
       await fetchATMs(activeFilter === 'USER_PREFERENCES');
     };
     
-    fetchData();
+    const usePreferences = activeFilter === 'USER_PREFERENCES';
     
-    const interval = setInterval(() => {
-      fetchATMs(activeFilter === 'USER_PREFERENCES');
+    const pollForChanges = () => setInterval(() => {
+      fetchATMs(usePreferences);
     }, 5 * 60 * 1000);
     
-    return () => clearInterval(interval);
+    // Fall back to polling where Server-Sent Events aren't available
+    if (typeof EventSource === 'undefined') {
+      fetchData();
+      const interval = pollForChanges();
+      
+      return () => clearInterval(interval);
+    }
+    
+    let stream = null;
+    let interval = null;
+    let closed = false;
+    
+    const openStream = () => {
+      // The server pushes ATM changes as they are ingested. Opened at the sequence
+      // of the ATMs just loaded, it first replays whatever was committed since;
+      // the browser reconnects by itself from the last event it received
+      let streamUrl = `${getApiBaseUrl()}/api/atms/stream`;
+      if (changeSeqRef.current !== null) {
+        streamUrl += `?last_event_id=${changeSeqRef.current}`;
+      }
+      stream = new EventSource(streamUrl);
+      
+      // Fresh connection: changes after this sequence will follow
+      stream.addEventListener('sync', (event) => {
+        changeSeqRef.current = JSON.parse(event.data).seq;
+      });
+      
+      stream.addEventListener('changes', (event) => {
+        const delta = JSON.parse(event.data);
+        changeSeqRef.current = delta.seq;
+        
+        if (usePreferences) {
+          // Filtered results depend on preferences and location, so ask the server again
+          fetchATMs(true);
+          return;
+        }
+        
+        setAtms(prev => applyAtmChanges(prev, delta));
+        setLastUpdated(new Date().toLocaleString());
+      });
+      
+      // Too far behind to patch; reload the full list
+      stream.addEventListener('resync', (event) => {
+        changeSeqRef.current = JSON.parse(event.data).seq;
+        fetchATMs(usePreferences);
+      });
+      
+      // Refused for good (e.g. the server is at its stream limit); poll instead
+      stream.onerror = () => {
+        if (stream.readyState === EventSource.CLOSED && interval === null) {
+          interval = pollForChanges();
+        }
+      };
+    };
+    
+    fetchData().then(() => {
+      if (!closed) {
+        openStream();
+      }
+    });
+    
+    return () => {
+      closed = true;
+      if (stream) {
+        stream.close();
+      }
+      if (interval !== null) {
+        clearInterval(interval);
+      }
+    };
   }, [userLocation, activeFilter]);
 
   // Update user location marker
@@ -0,0 +1,14 @@
+// atmChanges.js - Apply pushed ATM change deltas to the list loaded from /api/atms
+
+// Returns a new list with the delta's removed ATMs dropped, updated ATMs
+// replaced in place and added ATMs appended. Applying a delta twice is harmless.
+export const applyAtmChanges = (atms, delta) => {
+  const removed = new Set(delta.removed || []);
+  const changed = new Map([...(delta.added || []), ...(delta.updated || [])].map(atm => [atm.id, atm]));
+
+  const known = new Set(atms.map(atm => atm.id));
+  const next = atms
+    .filter(atm => !removed.has(atm.id))
+    .map(atm => changed.get(atm.id) || atm);
+  return next.concat([...changed.values()].filter(atm => !known.has(atm.id) && !removed.has(atm.id)));
+};
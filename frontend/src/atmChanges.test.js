@@ -0,0 +1,31 @@
+import { test } from 'node:test';
+import assert from 'node:assert/strict';
+import { applyAtmChanges } from './atmChanges.js';
+
+const atm = (id, status = 'Online') => ({ id, status, bank: 'NCB', parish: 'Kingston' });
+
+test('patches updated, removed and added ATMs', () => {
+  const atms = [atm(1), atm(2), atm(3)];
+  const next = applyAtmChanges(atms, {
+    seq: 7,
+    added: [atm(4)],
+    updated: [atm(2, 'Offline')],
+    removed: [3]
+  });
+
+  assert.deepEqual(next, [atm(1), atm(2, 'Offline'), atm(4)]);
+  assert.deepEqual(atms, [atm(1), atm(2), atm(3)]);
+});
+
+test('updates for ATMs the client has not loaded are added', () => {
+  const next = applyAtmChanges([atm(1)], { seq: 2, added: [], updated: [atm(5)], removed: [] });
+
+  assert.deepEqual(next, [atm(1), atm(5)]);
+});
+
+test('applying the same delta twice changes nothing more', () => {
+  const delta = { seq: 3, added: [atm(2)], updated: [atm(1, 'Offline')], removed: [9] };
+  const once = applyAtmChanges([atm(1), atm(9)], delta);
+
+  assert.deepEqual(applyAtmChanges(once, delta), once);
+});